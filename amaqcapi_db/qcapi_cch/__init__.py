@@ -2,4 +2,9 @@
 __version__ = "0.0.4"
 __author__ = "Philip Wu"
 
-from .qcxmain import startQCAPI
+## startQCAPI is imported on first use, qcapi_cch.qcdbfunc (used by amatools) does not need fastapi/uvicorn
+def __getattr__(name):
+    if name == 'startQCAPI':
+        from .qcxmain import startQCAPI
+        return startQCAPI
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
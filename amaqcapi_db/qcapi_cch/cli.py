@@ -1,6 +1,7 @@
 import argparse
 import os, shutil
 from .qcxmain import startQCAPI
+from .qcdbfunc import migrateQCxDB
 #from .qcxfuncs import startMonitorFolders
 
 def main():
@@ -22,3 +23,17 @@ def main():
     logfile = os.path.join(folder, fname)
     print(f'[INFO] logfile is {logfile}')
     startQCAPI(args.config, logfile)
+
+def migratedb():
+    parser = argparse.ArgumentParser(description='upgrade QCxURO/QCxTHY database files to the current schema')
+    parser.add_argument("dbfiles", nargs='+', help='sqlite3 database files (.db)')
+    args = parser.parse_args()
+
+    failed = 0
+    for dbfile in args.dbfiles:
+        if migrateQCxDB(dbfile):
+            print(f'[INFO] {dbfile} migrated')
+        else:
+            print(f'[ERROR] failed to migrate {dbfile}')
+            failed += 1
+    return 1 if failed else 0
@@ -1,4 +1,5 @@
 import os
+import sqlite3
 from loguru import logger
 
 class qcxQCDB:
@@ -26,74 +27,210 @@ class qcxQCDB:
 ## -------------------------------------------------------------- 
 ##  utilities: sqlite3 database operations for QC workflow
 ## -------------------------------------------------------------- 
+## schema version is kept in 'PRAGMA user_version'
+##   0/1: original tables, no index, slides looked up by full table scan
+##   2:   NOT NULL typed counts, UNIQUE index on (slidelabel, modelVersion)
+QCXDB_SCHEMA_VERSION = 2
+
+QCxURO_COLUMNS = ['slidelabel', 'zlayer', 'zfocus', 'similarity',
+                  'suspicious', 'atypical', 'degenerated', 'benign',
+                  's_avg_ncratio', 's_avg_nuclarea', 'a_avg_ncratio', 'a_avg_nuclarea',
+                  't_avg_ncratio', 't_avg_nuclarea',
+                  'modelProduct', 'modelVersion', 'medfname', 'medfpath']
+QCxTHY_COLUMNS = ['slidelabel', 'zlayer', 'zfocus', 'similarity'] + \
+                 [f'category{i}' for i in range(1, 7)] + \
+                 [f'trait{i}' for i in range(1, 21)] + \
+                 ['modelProduct', 'modelVersion', 'medfname', 'medfpath']
+
+def getQCxTableName(slide_type):
+    if slide_type.lower() in ['urine', 'aixuro']:
+        return 'QCxURO'
+    elif slide_type.lower() in ['thyroid', 'aixthy']:
+        return 'QCxTHY'
+    return None
+
+def getQCxColumnDefs(tblname):
+    ## [(column, type, default)]: default None is a nullable column, 'NOT NULL' is a required column without default
+    counts = ['suspicious', 'atypical', 'degenerated', 'benign'] if tblname == 'QCxURO' else \
+             [f'category{i}' for i in range(1, 7)] + [f'trait{i}' for i in range(1, 21)]
+    columns = [('slidelabel', 'TEXT', 'NOT NULL'), ('zlayer', 'INTEGER', '1'), ('zfocus', 'INTEGER', '0'),
+               ('similarity', 'REAL', '0.0')] + [(c, 'INTEGER', '0') for c in counts]
+    if tblname == 'QCxURO':
+        columns += [(c, 'REAL', None) for c in ['s_avg_ncratio', 's_avg_nuclarea', 'a_avg_ncratio', 'a_avg_nuclarea',
+                                                  't_avg_ncratio', 't_avg_nuclarea']]
+    columns += [('modelProduct', 'TEXT', 'NOT NULL'), ('modelVersion', 'TEXT', 'NOT NULL'),
+                ('medfname', 'TEXT', None), ('medfpath', 'TEXT', None)]
+    return columns
+
+def getQCxTableSchema(tblname):
+    ## column order is the same as the version 1 tables, positional readers keep working
+    coldefs = []
+    for column, coltype, default in getQCxColumnDefs(tblname):
+        if default is None:
+            coldefs.append(f'{column} {coltype}')
+        elif default == 'NOT NULL':
+            coldefs.append(f'{column} {coltype} NOT NULL')
+        else:
+            coldefs.append(f'{column} {coltype} NOT NULL DEFAULT {default}')
+    sql_str = f"CREATE TABLE IF NOT EXISTS {tblname} ({', '.join(coldefs)})"
+    sql_index = f"CREATE UNIQUE INDEX IF NOT EXISTS idx_{tblname.lower()}_slide ON {tblname} (slidelabel, modelVersion)"
+    return sql_str, sql_index
+
+def isLegacyQCxDB(dbconn):
+    ## schema version 0/1 with QC tables, has to be migrated by migrateQCxDB (qcapi-migratedb)
+    version = dbconn.execute('PRAGMA user_version').fetchone()[0]
+    tables = [row[0] for row in dbconn.execute("SELECT name FROM sqlite_master WHERE type='table' AND name IN ('QCxURO', 'QCxTHY')")]
+    return version < QCXDB_SCHEMA_VERSION and len(tables) > 0
+
+def prepareQCxTable(dbconn, tblname):
+    ## create 'tblname' with the current schema if it does not exist, returns True if the unique slide index exists
+    ## user_version is set only on a new database, a version 0/1 database is left as it is until migrated
+    legacy = isLegacyQCxDB(dbconn)
+    exists = dbconn.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?", (tblname,)).fetchone()
+    if legacy and exists:
+        logger.warning(f'{tblname} is schema version 1, please run qcapi-migratedb')
+        return dbconn.execute("SELECT name FROM sqlite_master WHERE type='index' AND name=?",
+                              (f'idx_{tblname.lower()}_slide',)).fetchone() is not None
+    sql_str, sql_index = getQCxTableSchema(tblname)
+    dbconn.execute(sql_str)
+    try:
+        dbconn.execute(sql_index)
+    except sqlite3.IntegrityError as e:
+        logger.error(f'{tblname} has duplicated slides, unique index was not created ({e}), please run qcapi-migratedb')
+        return False
+    if not legacy:
+        dbconn.execute(f'PRAGMA user_version = {QCXDB_SCHEMA_VERSION}')
+    return True
+
+def insertQCxRecords(dbconn, tblname, records):
+    ## parameterized bulk insert, a slide already analyzed by the same model version is skipped,
+    ## returns the number of inserted rows
+    columns = QCxURO_COLUMNS if tblname == 'QCxURO' else QCxTHY_COLUMNS
+    if prepareQCxTable(dbconn, tblname):
+        sql_str = f"INSERT INTO {tblname} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))}) \
+            ON CONFLICT(slidelabel, modelVersion) DO NOTHING"
+    else:
+        ## no unique index (duplicated slides in a version 1 table): check each slide before inserting
+        ilabel, iversion = columns.index('slidelabel'), columns.index('modelVersion')
+        sql_str = f"INSERT INTO {tblname} ({', '.join(columns)}) SELECT {', '.join('?' * len(columns))} \
+            WHERE NOT EXISTS (SELECT 1 FROM {tblname} WHERE slidelabel = ? AND modelVersion = ?)"
+        records = [tuple(r) + (r[ilabel], r[iversion]) for r in records]
+    before = dbconn.total_changes
+    dbconn.executemany(sql_str, records)
+    return dbconn.total_changes - before
+
+def openQCxDB(whichdb):
+    dbconn = sqlite3.connect(whichdb)
+    dbconn.row_factory = sqlite3.Row
+    return dbconn
 
 def createNewQCxDB(whichmodel, whichdb):
-    #if os.path.basename(whichdb) == 'demo_qcxuro.db':
-    if whichmodel.lower() == 'aixuro':
-        sql_str = "CREATE TABLE IF NOT EXISTS QCxURO ( \
-            slidelabel TEXT, zlayer INTEGER, zfocus INTEGER, similarity REAL, \
-            suspicious INTEGER, atypical INTEGER, degenerated INTEGER, benign INTEGER, \
-            s_avg_ncratio REAL, s_avg_nuclarea REAL, a_avg_ncratio REAL, a_avg_nuclarea REAL, \
-            t_avg_ncratio REAL, t_avg_nuclarea REAL, \
-            modelProduct TEXT, modelVersion TEXT, \
-            medfname TEXT, medfpath TEXT)"
-    #elif os.path.basename(whichdb) == 'demo_qcxthy.db':
-    elif whichmodel.lower() == 'aixthy':
-        sql_str = "CREATE TABLE IF NOT EXISTS QCxTHY ( \
-            slidelabel TEXT, zlayer INTEGER, zfocus INTEGER, similarity REAL, \
-            category1 INTEGER, category2 INTEGER, category3 INTEGER, category4 INTEGER, \
-            category5 INTEGER, category6 INTEGER, \
-            trait1 INTEGER, trait2 INTEGER, trait3 INTEGER, trait4 INTEGER, trait5 INTEGER, \
-            trait6 INTEGER, trait7 INTEGER, trait8 INTEGER, trait9 INTEGER, trait10 INTEGER, \
-            trait11 INTEGER, trait12 INTEGER, trait13 INTEGER, trait14 INTEGER, trait15 INTEGER, \
-            trait16 INTEGER, trait17 INTEGER, trait18 INTEGER, trait19 INTEGER, trait20 INTEGER, \
-            modelProduct TEXT, modelVersion TEXT, \
-            medfname TEXT, medfpath TEXT)"
+    tblname = getQCxTableName(whichmodel)
+    if not tblname:
+        logger.error(f'there is no database table for model {whichmodel}')
+        return
     try:
         with sqlite3.connect(whichdb) as dbconn:
-           cur = dbconn.cursor()
-           cur.execute(sql_str)
+           prepareQCxTable(dbconn, tblname)
            dbconn.commit()
            logger.trace(f'{os.path.basename(whichdb)} created!')
-    except sqlite3.OperationalError as e:
+    except sqlite3.Error as e:
         logger.error(f'create new database {whichdb} failed, {e}')
 
+##---------------------------------------------------------
+## migrate .db created by older versions to the current schema
+##---------------------------------------------------------
+def migrateQCxDB(whichdb):
+    if os.path.isfile(whichdb) == False:
+        logger.error(f'database {whichdb} does not exist')
+        return False
+    try:
+        dbconn = sqlite3.connect(whichdb, isolation_level=None)
+    except sqlite3.Error as e:
+        logger.error(f'unable to open database {whichdb}, {e}')
+        return False
+    isOK = True
+    try:
+        dbversion = dbconn.execute('PRAGMA user_version').fetchone()[0]
+        if dbversion >= QCXDB_SCHEMA_VERSION:
+            logger.trace(f'{os.path.basename(whichdb)} is already schema version {dbversion}')
+            return True
+        tables = [row[0] for row in dbconn.execute("SELECT name FROM sqlite_master WHERE type='table'")]
+        dbconn.execute('BEGIN IMMEDIATE')
+        for tblname in ['QCxURO', 'QCxTHY']:
+            if tblname not in tables:
+                continue
+            coldefs = getQCxColumnDefs(tblname)
+            columns = ', '.join(column for column, _, _ in coldefs)
+            ## NULL counts of version 1 rows get the column default, a NULL model product is known from the table
+            product = 'AIxURO' if tblname == 'QCxURO' else 'AIxTHY'
+            fill = {'modelProduct': f"'{product}'"}
+            values = ', '.join(f'COALESCE({column}, {fill.get(column, default)})' if default not in [None, 'NOT NULL'] or column in fill
+                               else column for column, _, default in coldefs)
+            sql_str, sql_index = getQCxTableSchema(tblname)
+            dbconn.execute(f'ALTER TABLE {tblname} RENAME TO {tblname}_v1')
+            ## the index (if any) moved with the renamed table, its name is needed for the new table
+            dbconn.execute(f'DROP INDEX IF EXISTS idx_{tblname.lower()}_slide')
+            dbconn.execute(sql_str)
+            dbconn.execute(sql_index)
+            ## the first record of a slide/model version wins, same rule as inserting;
+            ## only the UNIQUE conflict is ignored, any other constraint violation aborts the migration
+            cur = dbconn.execute(f'INSERT INTO {tblname} ({columns}) \
+                                   SELECT {values} FROM {tblname}_v1 \
+                                   WHERE slidelabel IS NOT NULL AND modelVersion IS NOT NULL ORDER BY rowid \
+                                   ON CONFLICT(slidelabel, modelVersion) DO NOTHING')
+            migrated = cur.rowcount
+            total = dbconn.execute(f'SELECT COUNT(*) FROM {tblname}_v1').fetchone()[0]
+            dbconn.execute(f'DROP TABLE {tblname}_v1')
+            if total != migrated:
+                logger.warning(f'{tblname}: {total-migrated} duplicated rows or rows without slidelabel/modelVersion were dropped while migrating')
+            logger.info(f'{tblname}: {migrated} rows migrated to schema version {QCXDB_SCHEMA_VERSION}')
+        dbconn.execute(f'PRAGMA user_version = {QCXDB_SCHEMA_VERSION}')
+        dbconn.execute('COMMIT')
+    except sqlite3.Error as e:
+        logger.error(f'failed to migrate database {whichdb}, {e}')
+        if dbconn.in_transaction:
+            dbconn.execute('ROLLBACK')
+        isOK = False
+    finally:
+        dbconn.close()
+    if isOK:
+        ## reclaim the space of the dropped tables
+        dbconn = sqlite3.connect(whichdb)
+        dbconn.execute('VACUUM')
+        dbconn.close()
+    return isOK
+
 def querySlideAnalyzedMetadata(slide_id, slide_type, thisdb):
-    if slide_type.lower() == 'urine':
-        #dbname = 'demo_qcxuro.db'
-        tblname = 'QCxURO'
-    elif slide_type.lower() == 'thyroid':
-        #dbname = 'demo_qcxthy.db'
-        tblname = 'QCxTHY'
-    #thisdb = os.path.join(qcxDBpath, dbname)
+    tblname = getQCxTableName(slide_type)
     metajson = []
     try:
-        with sqlite3.connect(thisdb) as dbconn:
+        with openQCxDB(thisdb) as dbconn:
             cur = dbconn.cursor()
-            cur.execute(f'SELECT * FROM {tblname} WHERE slidelabel = "{slide_id}"')
+            cur.execute(f'SELECT * FROM {tblname} WHERE slidelabel = ?', (slide_id,))
             rows = cur.fetchall()
             for row in rows:
                 thismeta = {}
                 if slide_type.lower() == 'urine':
-                    thismeta['suspicious'], thismeta['atypical'] = row[4], row[5]
-                    thismeta['TOP24_average_NC_ratio'] = row[12]
-                    thismeta['TOP24_average_Nucleus_Area'] = row[13]
-                    thismeta['model'] = f'{row[14]} {row[15]}'
-                    thismeta['filepath'] = os.path.join(row[17], row[16])
+                    thismeta['suspicious'], thismeta['atypical'] = row['suspicious'], row['atypical']
+                    thismeta['TOP24_average_NC_ratio'] = row['t_avg_ncratio']
+                    thismeta['TOP24_average_Nucleus_Area'] = row['t_avg_nuclarea']
+                    thismeta['model'] = f"{row['modelProduct']} {row['modelVersion']}"
+                    thismeta['filepath'] = os.path.join(row['medfpath'], row['medfname'])
                 elif slide_type.lower() == 'thyroid':
-                    thismeta['follicular'] = row[4]
-                    if '2024.2' in row[31]:     # model version
-                        thismeta['hurthle'] = row[5]
-                        thismeta['histiocytes'] = row[6]
-                        thismeta['lymphocytes'] = row[7]
-                        thismeta['colloid'] = row[8]
-                    elif '2025.2' in row[31]:
-                        thismeta['oncocytic'] = row[5]
-                        thismeta['lymphocytes'] = row[7]
-                        thismeta['histiocytes'] = row[8]
-                        thismeta['colloid'] = row[9]
-                    thismeta['model'] = f'{row[30]} {row[31]}'
-                    thismeta['filepath'] = os.path.join(row[33], row[32])
+                    thismeta['follicular'] = row['category1']
+                    if '2024.2' in row['modelVersion']:
+                        thismeta['hurthle'] = row['category2']
+                        thismeta['histiocytes'] = row['category3']
+                        thismeta['lymphocytes'] = row['category4']
+                        thismeta['colloid'] = row['category5']
+                    elif '2025.2' in row['modelVersion']:
+                        thismeta['oncocytic'] = row['category2']
+                        thismeta['lymphocytes'] = row['category4']
+                        thismeta['histiocytes'] = row['category5']
+                        thismeta['colloid'] = row['category6']
+                    thismeta['model'] = f"{row['modelProduct']} {row['modelVersion']}"
+                    thismeta['filepath'] = os.path.join(row['medfpath'], row['medfname'])
                 metajson.append(thismeta)
     except sqlite3.OperationalError as e:
         logger.error(f'something wrong when querying slide {slide_id}, {e}')
@@ -107,58 +244,36 @@ def saveInferenceMetadata2DB(medata, counts, tclist, dbname):
         return
     if os.path.isfile(dbname) == False:
         logger.warning(f'database {dbname} does not exist')
-        createNewQCxDB(medata['modeln'], dbname)
     labelname = medata['label']
     modelname, model_ver = medata['modeln'], medata['modelv']
     medfile, medpath = medata['medfile'], medata['medpath']
-    ## check if this slide already existed
-    if modelname.lower() == 'aixuro':
-        slidetype = 'urine'
-    elif modelname.lower() == 'aixthy':
-        slidetype = 'thyroid'
-    mdata = querySlideAnalyzedMetadata(labelname, slidetype)
-    if mdata != None:
-        for k in range(len(mdata)):
-            if mdata[k]['model'] == f'{modelname} {model_ver}':
-                logger.error(f'slide {labelname} already existed in database {dbname}')
-                return
-        logger.warning(f"slide {labelname} already existed in database {dbname}, but analyzed by {modelname} {model_ver} this time")
     ##
     if medata['modeln'].lower() == 'aixuro':
         s_avg_ncratio, s_avg_nuclarea, a_avg_ncratio, a_avg_nuclarea = getUROaverageOfSAcells(tclist)
         _, t_avg_ncratio, t_avg_nuclarea = getUROaverageOfTopCells(tclist)
-        sql_head = "INSERT INTO QCxURO \
-            (slidelabel, zlayer, zfocus, similarity, suspicious, atypical, degenerated, benign, \
-            s_avg_ncratio, s_avg_nuclarea, a_avg_ncratio, a_avg_nuclarea, \
-            t_avg_ncratio, t_avg_nuclarea, modelProduct, modelVersion, \
-            medfname, medfpath) VALUES "
-        sql_tail = f"('{labelname}', {medata['zlayer']}, {medata['zfocus']}, {medata['similarity']}, \
-            {counts[2]}, {counts[3]}, {counts[7]}, {counts[4]}, \
-            {s_avg_ncratio}, {s_avg_nuclarea}, {a_avg_ncratio}, {a_avg_nuclarea}, \
-            {t_avg_ncratio}, {t_avg_nuclarea}, \
-            '{modelname}', '{model_ver}', '{medfile}', '{medpath}')"
+        tblname = 'QCxURO'
+        values = [labelname, medata['zlayer'], medata['zfocus'], medata['similarity'],
+                  counts[2], counts[3], counts[7], counts[4],
+                  s_avg_ncratio, s_avg_nuclarea, a_avg_ncratio, a_avg_nuclarea,
+                  t_avg_ncratio, t_avg_nuclarea,
+                  modelname, model_ver, medfile, medpath]
     elif medata['modeln'].lower() == 'aixthy':
         thistrait = countNumberOfTHYtraits(tclist, 20)
-        sql_head = "INSERT INTO QCxTHY \
-            (slidelabel, zlayer, zfocus, similarity, \
-            category1, category2, category3, category4, category5, category6, \
-            trait1, trait2, trait3, trait4, trait5, trait6, trait7, trait8, trait9, trait10, \
-            trait11, trait12, trait13, trait14, trait15, trait16, trait17, trait18, trait19, trait20, \
-            modelProduct, modelVersion, medfname, medfpath) VALUES "
-        sql_tail = f"('{labelname}', {medata['zlayer']}, {medata['zfocus']}, {medata['similarity']}, \
-            {counts[1]}, {counts[2]}, {counts[3]}, {counts[4]}, {counts[5]}, {counts[6]}, \
-            {thistrait[0]}, {thistrait[1]}, {thistrait[2]}, {thistrait[3]}, {thistrait[4]}, \
-            {thistrait[5]}, {thistrait[6]}, {thistrait[7]}, {thistrait[8]}, {thistrait[9]}, \
-            {thistrait[10]}, {thistrait[11]}, {thistrait[12]}, {thistrait[13]}, {thistrait[14]}, \
-            {thistrait[15]}, {thistrait[16]}, {thistrait[17]}, {thistrait[18]}, {thistrait[19]}, \
-            '{modelname}', '{model_ver}', '{medfile}', '{medpath}')"
-    sql_str = sql_head + sql_tail
+        tblname = 'QCxTHY'
+        values = [labelname, medata['zlayer'], medata['zfocus'], medata['similarity']] + \
+                 [counts[j] for j in range(1, 7)] + list(thistrait[:20]) + \
+                 [modelname, model_ver, medfile, medpath]
+    else:
+        logger.error(f'there is no database table for model {modelname}')
+        return
     try:
         with sqlite3.connect(dbname) as dbconn:
-            cur = dbconn.cursor()
-            cur.execute(sql_str)
+            inserted = insertQCxRecords(dbconn, tblname, [values])
             dbconn.commit()
-        logger.info(f'{os.path.basename(dbname)} updated!')
-    except sqlite3.OperationalError as e:
+        if inserted:
+            logger.info(f'{os.path.basename(dbname)} updated!')
+        else:
+            ## UNIQUE(slidelabel, modelVersion)
+            logger.error(f'slide {labelname} analyzed by {modelname} {model_ver} already existed in database {dbname}')
+    except sqlite3.Error as e:
         logger.error(f'save inference metadata to database {dbname} failed, {e}')
-
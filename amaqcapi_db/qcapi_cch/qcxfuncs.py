@@ -7,8 +7,9 @@ import time
 import gzip
 import platform
 import subprocess
+import sqlite3
 import shapely
-from .qcdbfunc import saveInferenceMetadata2DB
+from .qcdbfunc import saveInferenceMetadata2DB, getQCxTableName, openQCxDB
 
 ## -------------------------------------------------------------- 
 ##  global preset working folders 
@@ -270,16 +271,14 @@ def countNumberOfTHYtraits(tclist, maxTraits, threshold=0.4):
 def queryAllSlideName(slide_type, thisdb=None):
     namelist = []
     if thisdb:
-        if slide_type.lower() == 'urine':
-            tblname = 'QCxURO'
-        elif slide_type.lower() == 'thyroid':
-            tblname = 'QCxTHY'
+        tblname = getQCxTableName(slide_type)
         logger.trace(f'[queryAllSlideName] {thisdb}: {tblname}')
         t0 = time.perf_counter()
         try:
             with sqlite3.connect(thisdb) as dbconn:
                 cur = dbconn.cursor()
-                cur.execute(f'SELECT slidelabel FROM {tblname}')
+                ## walks the (slidelabel, modelVersion) index, no table scan
+                cur.execute(f'SELECT DISTINCT slidelabel FROM {tblname} ORDER BY slidelabel')
                 rows = cur.fetchall()
                 for row in rows:
                     namelist.append(row[0])
@@ -362,51 +361,45 @@ def queryQCresultfromDB(slide_type, slide_id, thisdb):
     ## magic number for urine criteria 
     magic_suspicious, magic_atypical = 6, 8
     ##
-    if slide_type.lower() == 'urine':
-        #dbname = 'demo_qcxuro.db'
-        tblname = 'QCxURO'
-    elif slide_type.lower() == 'thyroid':
-        #dbname = 'demo_qcxthy.db'
-        tblname = 'QCxTHY'
-    #thisdb = os.path.join(qcxDBpath, dbname)
+    tblname = getQCxTableName(slide_type)
     metajson = []
     try:
-        with sqlite3.connect(thisdb) as dbconn:
+        with openQCxDB(thisdb) as dbconn:
             cur = dbconn.cursor()
-            cur.execute(f'SELECT * FROM {tblname} WHERE slidelabel = "{slide_id}"')
+            cur.execute(f'SELECT * FROM {tblname} WHERE slidelabel = ?', (slide_id,))
             rows = cur.fetchall()
             for row in rows:
                 thismeta = {}
                 if slide_type.lower() == 'urine':
-                    thismeta['medname'] = row[16]
-                    thismeta['medpath'] = row[17]
-                    thismeta['aixdata'] = f'{row[4]} suspicious cells, {row[5]} atypical cells'
-                    if row[4] >= magic_suspicious:
-                        if row[5] >= magic_atypical:
+                    thismeta['medname'] = row['medfname']
+                    thismeta['medpath'] = row['medfpath']
+                    thismeta['aixdata'] = f"{row['suspicious']} suspicious cells, {row['atypical']} atypical cells"
+                    if row['suspicious'] >= magic_suspicious:
+                        if row['atypical'] >= magic_atypical:
                             thismeta['qcalert1'], thismeta['qcalert2'] = 'red', 'red'
                             thismeta['interpretation'] = 'High likelihood of SHGUC or HGUC diagnosis'
                         else:
                             thismeta['qcalert1'], thismeta['qcalert2'] = 'red', 'green'
                             thismeta['interpretation'] = 'Extreme and rare case, less likely in real world'
                     else:
-                        if row[5] >= magic_atypical:
+                        if row['atypical'] >= magic_atypical:
                             thismeta['qcalert1'], thismeta['qcalert2'] = 'green', 'red'
                             thismeta['interpretation'] = 'Possible diagnosis of AUC; clinical information may be referenced to support the diagnosis'
                         else:
                             thismeta['qcalert1'], thismeta['qcalert2'] = 'green', 'green'
                             thismeta['interpretation'] = 'Likely benign (NHGUC); may be excluded from further review'
                 elif slide_type.lower() == 'thyroid':
-                    sum_of_follicular = sum(row[j] for j in range(4, 10))
-                    percentage_of_follicular = 0.0 if sum_of_follicular == 0 else row[4] / sum_of_follicular
-                    thismeta['medname'] = row[32]
-                    thismeta['medpath'] = row[33]
-                    thismeta['aixdata'] = f'{row[10]} follicular cells: {row[11]} ontocytic/hurthle cells; '
-                    if '2024.2' in row[31]:     # model version
-                        traits_criteria = row[10] > 0 and row[11] > 0
-                        thismeta['aixdata'] += f'hyperchromasia: {row[10]}, clumpedchromtin: {row[11]}'
-                    elif '2025.2' in row[31]:
-                        traits_criteria = row[12] > 0
-                        thismeta['aixdata'] += f'Microfollicles: {row[12]}'
+                    sum_of_follicular = sum(row[f'category{j}'] for j in range(1, 7))
+                    percentage_of_follicular = 0.0 if sum_of_follicular == 0 else row['category1'] / sum_of_follicular
+                    thismeta['medname'] = row['medfname']
+                    thismeta['medpath'] = row['medfpath']
+                    thismeta['aixdata'] = f"{row['trait1']} follicular cells: {row['trait2']} ontocytic/hurthle cells; "
+                    if '2024.2' in row['modelVersion']:
+                        traits_criteria = row['trait1'] > 0 and row['trait2'] > 0
+                        thismeta['aixdata'] += f"hyperchromasia: {row['trait1']}, clumpedchromtin: {row['trait2']}"
+                    elif '2025.2' in row['modelVersion']:
+                        traits_criteria = row['trait3'] > 0
+                        thismeta['aixdata'] += f"Microfollicles: {row['trait3']}"
                     if percentage_of_follicular > 0.7 and traits_criteria:
                         thismeta['qcalert1'], thismeta['qcalert2'] = 'red', 'green'
                     else:
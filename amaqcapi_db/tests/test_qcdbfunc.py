@@ -0,0 +1,65 @@
+## qcapi_cch.qcdbfunc: schema version 1 -> 2 migration, one row per slide and model version on re-ingest
+##
+import sqlite3
+import pytest
+from qcapi_cch.qcdbfunc import (QCXDB_SCHEMA_VERSION, QCxURO_COLUMNS, createNewQCxDB, insertQCxRecords,
+                                migrateQCxDB)
+
+def uroRecord(label, version='2.1.0', suspicious=3):
+    return (label, 1, 0, 0.95, suspicious, 5, 1, 100, 0.5, 40.0, 0.4, 35.0, 0.6, 45.0,
+            'AIxURO', version, f'{label}.med', 'D:\\done')
+
+@pytest.fixture
+def v1db(tmp_path):
+    ## version 1 table: same columns, untyped, no constraints and no index
+    dbname = str(tmp_path / 'qcxuro.db')
+    dbconn = sqlite3.connect(dbname)
+    dbconn.execute(f"CREATE TABLE QCxURO ({', '.join(QCxURO_COLUMNS)})")
+    rows = [uroRecord('S001'), uroRecord('S002'), uroRecord('S001', suspicious=9),
+            uroRecord('S002', version='2.2.0')]
+    rows.append(tuple(None if c == 'suspicious' else v for c, v in zip(QCxURO_COLUMNS, uroRecord('S003'))))
+    rows.append(tuple(None if c == 'slidelabel' else v for c, v in zip(QCxURO_COLUMNS, uroRecord('S004'))))
+    dbconn.executemany(f"INSERT INTO QCxURO VALUES ({', '.join('?' * len(QCxURO_COLUMNS))})", rows)
+    dbconn.commit()
+    dbconn.close()
+    return dbname
+
+def readSlides(dbname):
+    dbconn = sqlite3.connect(dbname)
+    rows = dbconn.execute('SELECT slidelabel, modelVersion, suspicious FROM QCxURO ORDER BY slidelabel, modelVersion').fetchall()
+    version = dbconn.execute('PRAGMA user_version').fetchone()[0]
+    dbconn.close()
+    return rows, version
+
+def test_migrate_v1_twice(v1db):
+    assert migrateQCxDB(v1db)
+    rows, version = readSlides(v1db)
+    ## the first row of a slide/model version wins, NULL counts get the default, rows without slidelabel are dropped
+    assert rows == [('S001', '2.1.0', 3), ('S002', '2.1.0', 3), ('S002', '2.2.0', 3), ('S003', '2.1.0', 0)]
+    assert version == QCXDB_SCHEMA_VERSION
+    assert migrateQCxDB(v1db)
+    assert readSlides(v1db) == (rows, version)
+
+def test_migrate_missing_db(tmp_path):
+    assert not migrateQCxDB(str(tmp_path / 'none.db'))
+
+def test_dedup_on_reingest(tmp_path):
+    dbname = str(tmp_path / 'qcxuro.db')
+    createNewQCxDB('aixuro', dbname)
+    with sqlite3.connect(dbname) as dbconn:
+        assert insertQCxRecords(dbconn, 'QCxURO', [uroRecord('S001'), uroRecord('S002')]) == 2
+    with sqlite3.connect(dbname) as dbconn:
+        ## same slides again (e.g. the done folder scanned after a restart), one new model version
+        assert insertQCxRecords(dbconn, 'QCxURO', [uroRecord('S001', suspicious=9), uroRecord('S002'),
+                                                   uroRecord('S001', version='2.2.0')]) == 1
+    rows, version = readSlides(dbname)
+    assert rows == [('S001', '2.1.0', 3), ('S001', '2.2.0', 3), ('S002', '2.1.0', 3)]
+    assert version == QCXDB_SCHEMA_VERSION
+
+def test_dedup_on_v1_db_before_migration(v1db):
+    ## no unique index yet, every slide is checked before inserting
+    with sqlite3.connect(v1db) as dbconn:
+        assert insertQCxRecords(dbconn, 'QCxURO', [uroRecord('S001'), uroRecord('S005')]) == 1
+    rows, version = readSlides(v1db)
+    assert [r for r in rows if r[0] in ['S001', 'S005']] == [('S001', '2.1.0', 3), ('S001', '2.1.0', 9), ('S005', '2.1.0', 3)]
+    assert version == 0
@@ -2,7 +2,18 @@
 __version__ = "0.0.5"
 __author__ = "Philip Wu"
 
-from .modelWSI import cmdModelInference, getCellsInfoFromAIX
-from .amaconfig import initLogger
-from .queryMED import getMetadataFromMED, cropTileFromMLayerOfMED
-from .queryMED import extractOneLayerFromMED
+## public functions are imported on first use, so light modules (e.g. amatools.folderwatch, amatools.decartpool)
+## can be imported without the inference stack (numpy, openslide, pywin32, ...)
+_LAZY = {'cmdModelInference': 'modelWSI', 'getCellsInfoFromAIX': 'modelWSI',
+         'initLogger': 'amaconfig',
+         'getMetadataFromMED': 'queryMED', 'cropTileFromMLayerOfMED': 'queryMED',
+         'extractOneLayerFromMED': 'queryMED'}
+
+def __getattr__(name):
+    if name in _LAZY:
+        import importlib
+        return getattr(importlib.import_module(f'.{_LAZY[name]}', __name__), name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+def __dir__():
+    return sorted(list(globals()) + list(_LAZY))
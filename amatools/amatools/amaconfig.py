@@ -5,7 +5,18 @@
 import os, sys
 import json
 from loguru import logger
-import wmi, GPUtil, platform
+import platform
+## Windows-only hardware query, amatools modules are imported on other platforms too (e.g. folderwatch, tests)
+try:
+    import wmi
+    HAS_WMI = True
+except ImportError:
+    HAS_WMI = False
+try:
+    import GPUtil
+    HAS_GPUTIL = True
+except ImportError:
+    HAS_GPUTIL = False
 
 ## ---------- ---------- ---------- ----------
 ## 📋 initiate Loguru.Logger
@@ -31,21 +42,23 @@ def initLogger(level=None, logpath=None):
 ## ⚙️ HW components: OS, CPU, GPU, RAM
 ## ---------- ---------- ---------- ----------
 def getMSinfo():
-    thispc = wmi.WMI()
-    ## OS
-    winos = thispc.Win32_OperatingSystem()
-    hw_os = winos[0].Caption if len(winos) > 0 else ''
-    ## CPU
-    cpu = thispc.Win32_Processor()
-    hw_cpu = cpu[0].Name.strip() if len(cpu) > 0 else ''
-    ## RAM
-    ram = thispc.Win32_PhysicalMemory()
-    ram_mb = 0
-    for i in range(len(ram)):
-        ram_mb += int(ram[i].Capacity)/1048576
-    hw_ram = f'{round(ram_mb/1024)}GB'
+    hw_os, hw_cpu, hw_ram = '', platform.processor(), ''
+    if HAS_WMI:
+        thispc = wmi.WMI()
+        ## OS
+        winos = thispc.Win32_OperatingSystem()
+        hw_os = winos[0].Caption if len(winos) > 0 else ''
+        ## CPU
+        cpu = thispc.Win32_Processor()
+        hw_cpu = cpu[0].Name.strip() if len(cpu) > 0 else ''
+        ## RAM
+        ram = thispc.Win32_PhysicalMemory()
+        ram_mb = 0
+        for i in range(len(ram)):
+            ram_mb += int(ram[i].Capacity)/1048576
+        hw_ram = f'{round(ram_mb/1024)}GB'
     ## GPU 
-    gpu = GPUtil.getGPUs()
+    gpu = GPUtil.getGPUs() if HAS_GPUTIL else []
     hw_gpu = gpu[0].name if len(gpu) > 0 else ''
 
     thisos = platform.platform()
@@ -74,9 +87,14 @@ class pcENV:
             self.envConfig['decart_exe'] = os.path.join(self.envConfig['decartpath'], 'decart.exe')
             self.envConfig['decart_ver'] = param.get('version', '2.7.4')
             self.envConfig['decartyaml'] = param.get('config', 'c:\\ProgramData\\DeCart\\config.yaml')
+            self.envConfig['decart_workers'] = param.get('workers', 1)      ## concurrent DeCart processes on this host
+            self.envConfig['decart_timeout'] = param.get('timeout', None)   ## seconds per slide, None: by file size
+            self.envConfig['decart_stall'] = param.get('stall', None)       ## seconds without DeCart output, then DeCart is killed
             param = dictconfig.get('metadata', {})
             self.envConfig['dbmeta_uro'] = param.get('db_uro', 'metadataURO.db')
             self.envConfig['dbmeta_thy'] = param.get('db_thy', 'metadataTHY.db')
+            self.envConfig['metadata_workers'] = param.get('workers', 2)    ## processes collecting .med/.aix metadata
+            self.envConfig['rundb'] = param.get('db_runs', None)            ## inference run database, None: %LOCALAPPDATA%\amatools
             self.envConfig['hw_os'], _, self.envConfig['hw_cpu'], self.envConfig['hw_gpu'], self.envConfig['hw_ram'] = getMSinfo()
         else:
             logger.error(f'[pcENV] {jsonfile} not found!')
@@ -89,8 +107,13 @@ class pcENV:
         self.envConfig['decartpath'] = f"c:\\bin\\DeCart\\decart{self.envConfig['decart_ver']}"
         self.envConfig['decart_exe'] = os.path.join(self.envConfig['decartpath'], 'decart.exe')
         self.envConfig['decartyaml'] = 'c:\\ProgramData\\DeCart\\config.yaml'
+        self.envConfig['decart_workers'] = 1
+        self.envConfig['decart_timeout'] = None
+        self.envConfig['decart_stall'] = None
         self.envConfig['dbmeta_uro'] = 'metadataURO.db'
         self.envConfig['dbmeta_thy'] = 'metadataTHY.db'
+        self.envConfig['metadata_workers'] = 2
+        self.envConfig['rundb'] = None
         #self.envConfig['hw_os']  = 'Windows11 Pro 24H2' 
         #self.envConfig['hw_cpu'] = 'Ryzen 7 7700X'
         #self.envConfig['hw_gpu'] = 'RTX 4060 Ti'
@@ -5,38 +5,58 @@
 import os, glob
 import shutil
 import csv
+import sqlite3
+import time
+import threading
 import pandas as pd
 from collections import Counter
 from datetime import datetime, timedelta
 from loguru import logger
 from tqdm import tqdm
 from .amaconfig import getMSinfo
+from .amautility import openReadOnlyDB
+try:
+    from qcapi_cch.qcdbfunc import insertQCxRecords
+    HAS_QCAPI = True
+except ImportError:
+    HAS_QCAPI = False
 
 ##---------------------------------------------------------
 ## special case for category name
 ##---------------------------------------------------------
-def getCategoryNamebyID(whichmodel, whichversion, category, noModelArch=None):
-    uroTypeName = ['background', 'nuclei', 'suspicious', 'atypical', 'benign',
-                   'other', 'tissue', 'degenerated']
-    thy2024Name = ['background', 'follicular', 'hurthle', 'histiocytes', 'lymphocytes',
-                   'colloid', 'multinucleatedGaint', 'psammomaBodies']
-    thy2025Name = ['background', 'follicular', 'oncocytic', 'epithelioid',
-                   'lymphocytes', 'histiocytes', 'colloid']
+uroTypeName = ['background', 'nuclei', 'suspicious', 'atypical', 'benign',
+               'other', 'tissue', 'degenerated']
+thy2024Name = ['background', 'follicular', 'hurthle', 'histiocytes', 'lymphocytes',
+               'colloid', 'multinucleatedGaint', 'psammomaBodies']
+thy2025Name = ['background', 'follicular', 'oncocytic', 'epithelioid',
+               'lymphocytes', 'histiocytes', 'colloid']
+## special case for decart 2.0.x ad 2.1.x (AIxURO only)
+uroNoArchName = ['benign', 'atypical', 'suspicious', 'nuclei']
+
+def getCategoryNameList(whichmodel, whichversion, noModelArch=None):
+    ## lookup table: category id -> category name
     if whichmodel == 'AIxURO':
-        if noModelArch:
-            ## special case for decart 2.0.x ad 2.1.x (AIxURO only)
-            categoryname = ['benign', 'atypical', 'suspicious', 'nuclei']
-            typename = 'unknown' if category > 3 else categoryname[category]
-        else:
-            typename = uroTypeName[category] 
+        return uroNoArchName if noModelArch else uroTypeName
     elif whichmodel == 'AIxTHY':
         if whichversion[:6] in ['2025.2']:
-            typename = thy2025Name[category]
+            return thy2025Name
         else:   ## modelversion: 2024.2-0625
-            typename = thy2024Name[category]
-    else:
+            return thy2024Name
+    return None
+
+def getCategoryNameOf(names, category):
+    ## names from getCategoryNameList(); category ids out of the list (or not an id) are 'unknown'
+    return names[category] if names and isinstance(category, int) and 0 <= category < len(names) else 'unknown'
+
+def getCategoryNamebyID(whichmodel, whichversion, category, noModelArch=None):
+    categoryname = getCategoryNameList(whichmodel, whichversion, noModelArch)
+    if categoryname is None:
         typename = 'unknown'
         logger.error(f'incorrect model:{whichmodel} in getCategoryNamebyID()')
+    elif noModelArch and whichmodel == 'AIxURO':
+        typename = 'unknown' if category > 3 else categoryname[category]
+    else:
+        typename = categoryname[category]
     return typename
 
 ##---------------------------------------------------------
@@ -128,6 +148,15 @@ def saveInferenceResult2CSV(infdata, infpath):
             csvwriter.writerow(thisrow)
     logger.trace(f'Inference result saved to {os.path.basename(outcsv)} completed.')
 
+##---------------------------------------------------------
+## write a cell table (list of rows) to CSV in one bulk operation
+##---------------------------------------------------------
+def writeTCellsTable2CSV(outcsv, fields, rows):
+    ## rows are plain lists in 'fields' order, one writerows() call instead of a DictWriter row per cell
+    ww = csv.writer(outcsv)
+    ww.writerow(fields)
+    ww.writerows(rows)
+
 ##---------------------------------------------------------
 ## save target cells metadata of a slide to CSV file
 ##---------------------------------------------------------
@@ -135,6 +164,9 @@ def saveTCellsMetadata2CSV(aixfname, allcells, aixmodel, modelver):
     if len(allcells) == 0:
         logger.error(f'empty analysis metadata in {aixfname}')
         return
+    if aixmodel not in ['AIxURO', 'AIxTHY']:
+        logger.error(f'incorrect model:{aixmodel} in saveTCellsMetadata2CSV()')
+        return
     # sort by category
     allcells.sort(key=lambda x: x['category'])
     #
@@ -164,25 +196,177 @@ def saveTCellsMetadata2CSV(aixfname, allcells, aixmodel, modelver):
             else:
                 tagscols = ['microfollicles', 'papillae', 'palenuclei', 'grooving', 'pseudoinclusions', 'marginallyplaced', 'plasmacytoid', 'saltandpepper' ]
         fields = headcols+tagscols 
-        ww = csv.DictWriter(outcsv, fieldnames=fields)
-        ww.writeheader()
-        for thiscell in allcells:
-            thisrow = {}
-            thisrow['cellname']        = thiscell['cellname']
-            thisrow['category']        = getCategoryNamebyID(aixmodel, modelver, thiscell['category'])
-            thisrow['probability']     = thiscell['probability']
-            thisrow['score']           = thiscell['score']
-            if aixmodel == 'AIxURO':
-                thisrow['ncratio']     = thiscell['ncratio']
-                thisrow['cellarea']    = thiscell['cellarea']
-                thisrow['nucleusarea'] = thiscell['nucleiarea']
-            elif aixmodel == 'AIxTHY':
-                thisrow['cellarea']    = thiscell['cellarea']
-            for j in range(len(thiscell['traits'])):
-                thisrow[tagscols[j]] = thiscell['traits'][j] 
-            ww.writerow(thisrow)
+        ## category names resolved from one lookup list per slide, 'unknown' as getCategoryNamebyID()
+        names = getCategoryNameList(aixmodel, modelver)
+        categoryName = lambda k: getCategoryNameOf(names, k)
+        ## cells with fewer traits than columns get empty fields, as csv.DictWriter did;
+        ## extra traits have no column (DictWriter raised ValueError), they are dropped with a warning
+        ntags = len(tagscols)
+        padtags = [''] * ntags
+        extra = sum(1 for c in allcells if len(c['traits']) > ntags)
+        if extra:
+            logger.warning(f'{extra} cells of {file_aix} have more than {ntags} traits of {aixmodel} {modelver}, extra traits not saved')
+        if aixmodel == 'AIxURO':
+            rows = [[c['cellname'], categoryName(c['category']), c['probability'], c['score'],
+                     c['ncratio'], c['cellarea'], c['nucleiarea']] + list(c['traits'][:ntags]) + padtags[len(c['traits']):]
+                    for c in allcells]
+        else:
+            rows = [[c['cellname'], categoryName(c['category']), c['probability'], c['score'],
+                     c['cellarea']] + list(c['traits'][:ntags]) + padtags[len(c['traits']):]
+                    for c in allcells]
+        writeTCellsTable2CSV(outcsv, fields, rows)
     logger.trace(f'metadata of target cells saved to {os.path.basename(csvfname)} completed.')
 
+##---------------------------------------------------------
+## save target cells metadata of a slide to the cell store
+##   sqlite3: one database, slides + cells tables (cells.slide_id -> slides.id)
+##   parquet: one file per slide, partitioned by model=<model>/version=<ver>
+##---------------------------------------------------------
+NUM_CELL_TRAITS = 20
+
+def createCellStoreDB(dbname):
+    traits = ', '.join(f'trait{i} REAL' for i in range(1, NUM_CELL_TRAITS+1))
+    dbconn = sqlite3.connect(dbname)
+    try:
+        dbconn.execute("CREATE TABLE IF NOT EXISTS slides ( \
+            id INTEGER PRIMARY KEY, slidename TEXT NOT NULL, aixfname TEXT, \
+            modelProduct TEXT NOT NULL, modelVersion TEXT NOT NULL, numcells INTEGER NOT NULL DEFAULT 0, \
+            UNIQUE (slidename, modelProduct, modelVersion))")
+        dbconn.execute(f"CREATE TABLE IF NOT EXISTS cells ( \
+            slide_id INTEGER NOT NULL REFERENCES slides(id) ON DELETE CASCADE, \
+            cellname TEXT, category INTEGER NOT NULL, categoryname TEXT, \
+            probability REAL, score REAL, ncratio REAL, cellarea REAL, nucleusarea REAL, \
+            {traits})")
+        ## 'all suspicious cells with score > 0.9' is answered from idx_cells_category_score
+        dbconn.execute("CREATE INDEX IF NOT EXISTS idx_cells_category_score ON cells (categoryname, score)")
+        dbconn.execute("CREATE INDEX IF NOT EXISTS idx_cells_slide ON cells (slide_id)")
+        dbconn.commit()
+    finally:
+        dbconn.close()
+
+def getCellStoreRows(allcells, aixmodel, modelver):
+    names = getCategoryNameList(aixmodel, modelver)
+    rows = []
+    for thiscell in allcells:
+        traits = list(thiscell['traits'][:NUM_CELL_TRAITS])
+        traits += [None] * (NUM_CELL_TRAITS - len(traits))
+        rows.append([thiscell['cellname'], thiscell['category'],
+                     getCategoryNameOf(names, thiscell['category']),
+                     thiscell['probability'], thiscell['score'],
+                     thiscell.get('ncratio'), thiscell.get('cellarea'), thiscell.get('nucleiarea')] + traits)
+    return rows
+
+def saveTCellsMetadata2DB(aixfname, allcells, aixmodel, modelver, dbname):
+    if len(allcells) == 0:
+        logger.error(f'empty analysis metadata in {aixfname}')
+        return
+    createCellStoreDB(dbname)
+    shortname = os.path.splitext(os.path.basename(aixfname))[0]
+    rows = getCellStoreRows(allcells, aixmodel, modelver)
+    cols = ['slide_id', 'cellname', 'category', 'categoryname', 'probability', 'score',
+            'ncratio', 'cellarea', 'nucleusarea'] + [f'trait{i}' for i in range(1, NUM_CELL_TRAITS+1)]
+    dbconn = None
+    try:
+        dbconn = sqlite3.connect(dbname)
+        dbconn.execute('PRAGMA foreign_keys = ON')
+        with dbconn:
+            ## re-analyzing a slide with the same model version replaces its cells
+            dbconn.execute('DELETE FROM slides WHERE slidename=? AND modelProduct=? AND modelVersion=?',
+                           (shortname, aixmodel, modelver))
+            cur = dbconn.execute('INSERT INTO slides (slidename, aixfname, modelProduct, modelVersion, numcells) VALUES (?, ?, ?, ?, ?)',
+                                 (shortname, aixfname, aixmodel, modelver, len(rows)))
+            slide_id = cur.lastrowid
+            dbconn.executemany(f"INSERT INTO cells ({', '.join(cols)}) VALUES ({', '.join('?' * len(cols))})",
+                               ([slide_id] + row for row in rows))
+        logger.trace(f'metadata of {len(rows)} target cells of {shortname} saved to {os.path.basename(dbname)}')
+    except sqlite3.Error as e:
+        logger.error(f'save cells metadata of {shortname} to {dbname} failed, {e}')
+    finally:
+        if dbconn:
+            dbconn.close()
+
+def saveTCellsMetadata2Parquet(aixfname, allcells, aixmodel, modelver, storepath):
+    if len(allcells) == 0:
+        logger.error(f'empty analysis metadata in {aixfname}')
+        return
+    shortname = os.path.splitext(os.path.basename(aixfname))[0]
+    cols = ['cellname', 'category', 'categoryname', 'probability', 'score',
+            'ncratio', 'cellarea', 'nucleusarea'] + [f'trait{i}' for i in range(1, NUM_CELL_TRAITS+1)]
+    df = pd.DataFrame(getCellStoreRows(allcells, aixmodel, modelver), columns=cols)
+    df.insert(0, 'slidename', shortname)
+    partpath = os.path.join(storepath, f'model={aixmodel}', f'version={modelver}')
+    os.makedirs(partpath, exist_ok=True)
+    try:
+        df.to_parquet(os.path.join(partpath, f'{shortname}.parquet'), index=False)
+    except ImportError as e:
+        logger.error(f'parquet cell store needs pyarrow (pip install pyarrow): {e}')
+
+def saveTCellsMetadata2Store(aixfname, allcells, aixmodel, modelver, cellstore):
+    ## cellstore: *.db/*.sqlite file -> sqlite3, otherwise a folder for parquet files
+    if os.path.splitext(cellstore)[1].lower() in ['.db', '.sqlite', '.sqlite3']:
+        saveTCellsMetadata2DB(aixfname, allcells, aixmodel, modelver, cellstore)
+    else:
+        saveTCellsMetadata2Parquet(aixfname, allcells, aixmodel, modelver, cellstore)
+
+def queryCellsFromStore(cellstore, categoryname=None, min_score=None, modelname=None, modelver=None):
+    ## e.g. queryCellsFromStore(db, 'suspicious', 0.9): all suspicious cells with score > 0.9 in the study
+    ## cellstore as saveTCellsMetadata2Store(), returns a list of dict (slidename, modelProduct, modelVersion, cell columns)
+    if os.path.splitext(cellstore)[1].lower() in ['.db', '.sqlite', '.sqlite3']:
+        return queryCellsFromDB(cellstore, categoryname, min_score, modelname, modelver)
+    return queryCellsFromParquet(cellstore, categoryname, min_score, modelname, modelver)
+
+def queryCellsFromParquet(storepath, categoryname=None, min_score=None, modelname=None, modelver=None):
+    ## model/version are selected by the partition folders, category/score are filtered per slide file
+    pattern = os.path.join(storepath, f'model={modelname or "*"}', f'version={modelver or "*"}', '*.parquet')
+    cells = []
+    for pqfile in sorted(glob.glob(pattern)):
+        partpath = os.path.dirname(pqfile)
+        try:
+            df = pd.read_parquet(pqfile)
+        except ImportError as e:
+            logger.error(f'parquet cell store needs pyarrow (pip install pyarrow): {e}')
+            return []
+        except (OSError, ValueError) as e:
+            logger.error(f'query cells from {pqfile} failed, {e}')
+            continue
+        if categoryname:
+            df = df[df['categoryname'] == categoryname]
+        if min_score is not None:
+            df = df[df['score'] > min_score]
+        df.insert(1, 'modelProduct', os.path.basename(os.path.dirname(partpath)).split('=', 1)[1])
+        df.insert(2, 'modelVersion', os.path.basename(partpath).split('=', 1)[1])
+        cells.extend(df.to_dict('records'))
+    return cells
+
+def queryCellsFromDB(dbname, categoryname=None, min_score=None, modelname=None, modelver=None):
+    conds, params = [], []
+    if categoryname:
+        conds.append('c.categoryname = ?')
+        params.append(categoryname)
+    if min_score is not None:
+        conds.append('c.score > ?')
+        params.append(min_score)
+    if modelname:
+        conds.append('s.modelProduct = ?')
+        params.append(modelname)
+    if modelver:
+        conds.append('s.modelVersion = ?')
+        params.append(modelver)
+    sql_str = 'SELECT s.slidename, s.modelProduct, s.modelVersion, c.* FROM cells c JOIN slides s ON s.id = c.slide_id'
+    if conds:
+        sql_str += ' WHERE ' + ' AND '.join(conds)
+    dbconn = None
+    try:
+        dbconn = openReadOnlyDB(dbname)
+        dbconn.row_factory = sqlite3.Row
+        return [dict(row) for row in dbconn.execute(sql_str, params)]
+    except sqlite3.Error as e:
+        logger.error(f'query cells from {dbname} failed, {e}')
+        return []
+    finally:
+        if dbconn:
+            dbconn.close()
+
 ## ---------- ---------- ---------- ----------
 ##  save summary of analysis metadata to CSV
 ## ---------- ---------- ---------- ----------
@@ -338,62 +522,69 @@ def saveTraitsSummary2CSV(whichmodel, modelver, aixlist, taglist):
 ## ---------- ---------- ---------- ----------
 ## 🩻 save model inference metadata to Sqlite3 database
 ## ---------- ---------- ---------- ----------
-def insertAnalyzedMetadata2DB(medata, dbname):
-    if os.path.isfile(dbname) == False:
-        logger.warning(f'database {dbname} does not exist')
-        createNewQCxDB(medata['modeln'].lower(), dbname)
+## row order of buildQCxRecord(), same as the QC tables (qcapi_cch.qcdbfunc QCxURO_COLUMNS/QCxTHY_COLUMNS)
+QCxURO_RECORD = ['slidelabel', 'zlayer', 'zfocus', 'similarity',
+                 'suspicious', 'atypical', 'degenerated', 'benign',
+                 's_avg_ncratio', 's_avg_nuclarea', 'a_avg_ncratio', 'a_avg_nuclarea',
+                 't_avg_ncratio', 't_avg_nuclarea',
+                 'modelProduct', 'modelVersion', 'medfname', 'medfpath']
+QCxTHY_RECORD = ['slidelabel', 'zlayer', 'zfocus', 'similarity'] + \
+                [f'category{i}' for i in range(1, 7)] + [f'trait{i}' for i in range(1, 21)] + \
+                ['modelProduct', 'modelVersion', 'medfname', 'medfpath']
+
+def insertQCxRecordsLocal(dbconn, tblname, records):
+    ## fallback without qcapi_cch.qcdbfunc (amaqcapi_db not installed): the QC table is created by qcapi-cch,
+    ## rows are inserted unless the slide was already analyzed by the same model version
+    found = dbconn.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?", (tblname,)).fetchone()
+    if not found:
+        raise sqlite3.OperationalError(f'no table {tblname}, the QC database has to be created by qcapi-cch first')
+    columns = QCxURO_RECORD if tblname == 'QCxURO' else QCxTHY_RECORD
+    ilabel, iversion = columns.index('slidelabel'), columns.index('modelVersion')
+    sql_str = f"INSERT INTO {tblname} ({', '.join(columns)}) SELECT {', '.join('?' * len(columns))} \
+        WHERE NOT EXISTS (SELECT 1 FROM {tblname} WHERE slidelabel = ? AND modelVersion = ?)"
+    before = dbconn.total_changes
+    dbconn.executemany(sql_str, [tuple(r) + (r[ilabel], r[iversion]) for r in records])
+    return dbconn.total_changes - before
+
+def buildQCxRecord(medata):
+    ## medata -> row tuple in QCxURO_RECORD/QCxTHY_RECORD order
     labelname = medata['label']
     modelname, model_ver = medata['modeln'], medata['modelv']
     medfile, medpath = medata['medfile'], medata['medpath']
-    ## check if this slide already existed
     if modelname.lower() == 'aixuro':
-        slidetype = 'urine'
-    elif modelname.lower() == 'aixthy':
-        slidetype = 'thyroid'
-    mdata = queryAnalyzedMetadataFromDB(dbname, labelname, slidetype)
-    if len(mdata):
-        for k in range(len(mdata)):
-            if mdata[k]['model'] == f'{modelname} {model_ver}':
-                logger.error(f'slide {labelname} already existed in database {dbname}')
-                return
-        logger.warning(f"slide {labelname} already existed in database {dbname}, but analyzed by {modelname} {model_ver} this time")
-    ##
-    if medata['modeln'].lower() == 'aixuro':
-        sql_head = "INSERT INTO QCxURO \
-            (slidelabel, zlayer, zfocus, similarity, suspicious, atypical, degenerated, benign, \
-            s_avg_ncratio, s_avg_nuclarea, a_avg_ncratio, a_avg_nuclarea, \
-            t_avg_ncratio, t_avg_nuclarea, modelProduct, modelVersion, \
-            medfname, medfpath) VALUES "
-        sql_tail = f"('{labelname}', {medata['zlayer']}, {medata['zfocus']}, {medata['similarity']}, \
-            {medata['suspicious']}, {medata['atypical']}, {medata['degenerated']}, {medata['benign']}, \
-            {medata['s_avg_ncratio']}, {medata['s_avg_nucarea']}, \
-            {medata['a_avg_ncratio']}, {medata['a_avg_nucarea']}, \
-            {medata['t_avg_ncratio']}, {medata['t_avg_nucarea']}, \
-            '{modelname}', '{model_ver}', '{medfile}', '{medpath}')"
-    elif medata['modeln'].lower() == 'aixthy':
-        sql_head = "INSERT INTO QCxTHY \
-            (slidelabel, zlayer, zfocus, similarity, \
-            category1, category2, category3, category4, category5, category6, \
-            trait1, trait2, trait3, trait4, trait5, trait6, trait7, trait8, trait9, trait10, \
-            trait11, trait12, trait13, trait14, trait15, trait16, trait17, trait18, trait19, trait20, \
-            modelProduct, modelVersion, medfname, medfpath) VALUES "
-        sql_tail = f"('{labelname}', {medata['zlayer']}, {medata['zfocus']}, {medata['similarity']}, \
-            {medata['category'][1]}, {medata['category'][2]}, {medata['category'][3]}, \
-            {medata['category'][4]}, {medata['category'][5]}, {medata['category'][6]}, \
-            {medata['traits'][0]}, {medata['traits'][1]}, {medata['traits'][2]}, {medata['traits'][3]}, \
-            {medata['traits'][4]}, {medata['traits'][5]}, {medata['traits'][6]}, {medata['traits'][7]}, \
-            {medata['traits'][8]}, {medata['traits'][9]}, {medata['traits'][10]}, {medata['traits'][11]}, \
-            {medata['traits'][12]}, {medata['traits'][13]}, {medata['traits'][14]}, {medata['traits'][15]}, \
-            {medata['traits'][16]}, {medata['traits'][17]}, {medata['traits'][18]}, {medata['traits'][19]}, \
-            '{modelname}', '{model_ver}', '{medfile}', '{medpath}')"
-
-    sql_str = sql_head + sql_tail
+        return (labelname, medata['zlayer'], medata['zfocus'], medata['similarity'],
+                medata['suspicious'], medata['atypical'], medata['degenerated'], medata['benign'],
+                medata['s_avg_ncratio'], medata['s_avg_nucarea'],
+                medata['a_avg_ncratio'], medata['a_avg_nucarea'],
+                medata['t_avg_ncratio'], medata['t_avg_nucarea'],
+                modelname, model_ver, medfile, medpath)
+    traits = list(medata['traits'][:20]) + [0] * (20 - len(medata['traits'][:20]))
+    return tuple([labelname, medata['zlayer'], medata['zfocus'], medata['similarity']] +
+                 [medata['category'][k] for k in range(1, 7)] + traits +
+                 [modelname, model_ver, medfile, medpath])
+
+def upsertAnalyzedMetadata2DB(records, whichmodel, dbname):
+    ## one connection, one transaction; a slide already analyzed by the same model version is kept as is
+    ## the QC tables are defined in qcapi_cch.qcdbfunc only, the QC API reads these tables
+    if len(records) == 0:
+        return 0
+    if not HAS_QCAPI:
+        logger.warning('qcapi_cch.qcdbfunc (amaqcapi_db) is not installed, insert into the existing QC table only')
+    tblname = {'urine': 'QCxURO', 'aixuro': 'QCxURO', 'thyroid': 'QCxTHY', 'aixthy': 'QCxTHY'}.get(whichmodel.lower())
+    if not tblname:
+        logger.error(f'there is no database table for model {whichmodel}')
+        return 0
+    if os.path.isfile(dbname) == False:
+        logger.warning(f'database {dbname} does not exist')
+    dbconn = None
+    inserted = 0
     try:
-        with sqlite3.connect(dbname) as dbconn:
-            cur = dbconn.cursor()
-            cur.execute(sql_str)
-            dbconn.commit()
-        logger.info(f'{os.path.basename(dbname)} updated!')
+        dbconn = sqlite3.connect(dbname)
+        with dbconn:
+            inserted = insertQCxRecords(dbconn, tblname, records) if HAS_QCAPI else insertQCxRecordsLocal(dbconn, tblname, records)
+        if inserted < len(records):
+            logger.warning(f'{len(records)-inserted} slide(s) already existed in database {os.path.basename(dbname)}, skipped')
+        logger.info(f'{os.path.basename(dbname)} updated, {inserted} slide(s) inserted')
     except sqlite3.OperationalError as e:
         logger.error(f'save inference metadata to database {dbname} failed, {e}')
     except sqlite3.Error as e:
@@ -401,11 +592,139 @@ def insertAnalyzedMetadata2DB(medata, dbname):
     finally:
         if dbconn:
             dbconn.close()
+    return inserted
+
+def insertAnalyzedMetadata2DB(medata, dbname):
+    upsertAnalyzedMetadata2DB([buildQCxRecord(medata)], medata['modeln'], dbname)
+
+## ---------- ---------- ---------- ----------
+## 💾 online backup of the QC database (sqlite3 backup API)
+## ---------- ---------- ---------- ----------
+## backup when enough new slides are pending, or some are pending and the last backup is too old
+QCXDB_BACKUP_INSERTS = 200
+QCXDB_BACKUP_SECONDS = 3600
+QCXDB_BACKUP_CHECK_SECONDS = 600
+
+def getQCxBackupDB(thisdb, backuppath=None):
+    if not backuppath:
+        backuppath = os.path.join(os.getenv('localappdata', os.path.expanduser('~')), 'ama_qc')
+    return os.path.join(backuppath, os.path.basename(thisdb))
+
+def countQCxSlides(dbname):
+    ## None if the database can not be read
+    if os.path.isfile(dbname) == False:
+        return 0
+    dbconn = None
+    try:
+        dbconn = openReadOnlyDB(dbname)
+        total = 0
+        for tblname in ['QCxURO', 'QCxTHY']:
+            found = dbconn.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?", (tblname,)).fetchone()
+            if found:
+                total += dbconn.execute(f'SELECT COUNT(*) FROM {tblname}').fetchone()[0]
+        return total
+    except sqlite3.Error as e:
+        logger.error(f'failed to count slides in {dbname}, {e}')
+        return None
+    finally:
+        if dbconn:
+            dbconn.close()
+
+def needQCxDBBackup(thisdb, backdb, min_inserts=QCXDB_BACKUP_INSERTS, max_age=QCXDB_BACKUP_SECONDS):
+    if os.path.isfile(thisdb) == False:
+        return False
+    if os.path.isfile(backdb) == False:
+        return True
+    ## QC tables are append-only, the row count difference is the number of slides not yet backed up
+    thiscount, backcount = countQCxSlides(thisdb), countQCxSlides(backdb)
+    if thiscount is None:
+        return False
+    if backcount is None:   ## unreadable backup, replace it
+        return True
+    pending = thiscount - backcount
+    if pending == 0:
+        return False
+    if pending >= min_inserts or pending < 0:
+        return True
+    return time.time() - os.path.getmtime(backdb) >= max_age
+
+def backupQCxDB(thisdb, backdb, pages=256, step_sleep=0.01):
+    ## copy in small page steps so QC API readers only wait for one step at a time,
+    ## write to a temp file and replace the old backup only after integrity_check passes
+    os.makedirs(os.path.dirname(backdb), exist_ok=True)
+    tmpdb = f'{backdb}.tmp'
+    def progress(status, remaining, total):
+        logger.trace(f'backup {os.path.basename(thisdb)}: {total-remaining}/{total} pages')
+        time.sleep(step_sleep)
+    srcconn, dstconn = None, None
+    try:
+        srcconn = sqlite3.connect(thisdb)
+        dstconn = sqlite3.connect(tmpdb)
+        srcconn.backup(dstconn, pages=pages, progress=progress)
+        result = dstconn.execute('PRAGMA integrity_check').fetchone()[0]
+        dstconn.close()
+        dstconn = None
+        if result != 'ok':
+            logger.error(f'backup of {os.path.basename(thisdb)} failed integrity check: {result}')
+            os.remove(tmpdb)
+            return False
+        os.replace(tmpdb, backdb)
+        logger.info(f'{os.path.basename(thisdb)} backed up to {backdb}')
+        return True
+    except sqlite3.Error as e:
+        logger.error(f'backup {thisdb} to {backdb} failed, {e}')
+        return False
+    finally:
+        if srcconn:
+            srcconn.close()
+        if dstconn:
+            dstconn.close()
+
+def checkQCxDBBackup(thisdb, backdb, forceBackup=False):
+    if forceBackup or needQCxDBBackup(thisdb, backdb):
+        return backupQCxDB(thisdb, backdb)
+    logger.trace(f'backup of {os.path.basename(thisdb)} is up to date')
+    return True
+
+class QCxDBBackupTimer:
+    ## checks the backup every 'interval' seconds in a daemon thread, also while no slide is ingested,
+    ## so a few pending slides are backed up once the backup is older than QCXDB_BACKUP_SECONDS
+    def __init__(self, thisdb, backdb=None, interval=QCXDB_BACKUP_CHECK_SECONDS):
+        self.thisdb = thisdb
+        self.backdb = backdb if backdb else getQCxBackupDB(thisdb)
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = None
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='qcxdb-backup', daemon=True)
+        self.thread.start()
+        logger.info(f'check backup of {os.path.basename(self.thisdb)} every {self.interval} seconds')
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                checkQCxDBBackup(self.thisdb, self.backdb)
+            except (sqlite3.Error, OSError) as e:
+                logger.error(f'backup check of {self.thisdb} failed, {e}')
+    def stop(self):
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+
+_BACKUP_TIMERS = {}
+
+def startQCxDBBackupTimer(thisdb, backdb=None, interval=QCXDB_BACKUP_CHECK_SECONDS):
+    ## one timer per database for the life of this process, started by the first write
+    key = os.path.abspath(thisdb)
+    if key not in _BACKUP_TIMERS:
+        _BACKUP_TIMERS[key] = QCxDBBackupTimer(thisdb, backdb, interval)
+        _BACKUP_TIMERS[key].start()
+    return _BACKUP_TIMERS[key]
 
 ## ---------- ---------- ---------- ----------
 ## 🗄️ update analyzed metadata to Sqlite3 database
 ## ---------- ---------- ---------- ----------
-def updateAnalyzedMetadata2DB(aixmeta, thismodel, qcxDBpath, dbname):
+def updateAnalyzedMetadata2DB(aixmeta, thismodel, qcxDBpath, dbname, path_medaix='', forceBackup=False):
     if len(aixmeta) == 0:
         logger.error('no analyzed metadata!')
         return
@@ -413,8 +732,9 @@ def updateAnalyzedMetadata2DB(aixmeta, thismodel, qcxDBpath, dbname):
     modelVersion = aixmeta[0]['modelversion']
 
     thisdb = os.path.join(qcxDBpath, dbname)
-    backdb = os.path.join(os.getenv('localappdata'), 'ama_qc', dbname)
-    ## insert analyzed metadata into database for QC
+    backdb = getQCxBackupDB(thisdb)
+    ## build all rows first, then insert analyzed metadata into database for QC in one transaction
+    records = []
     for ii in range(len(aixmeta)):
         thisdata = {}
         thisdata['label'] = os.path.splitext(aixmeta[ii]['wsifname'])[0]
@@ -439,7 +759,11 @@ def updateAnalyzedMetadata2DB(aixmeta, thismodel, qcxDBpath, dbname):
         else:
             thisdata['category'] = aixmeta[ii]['cellCount']
             thisdata['traits']   = aixmeta[ii]['traits']
+        records.append(buildQCxRecord(thisdata))
 
-        insertInferenceMetadata2DB(thisdata, thisdb)
-    ## backup updated database 
-    shutil.copy(thisdb, backdb)
+    upsertAnalyzedMetadata2DB(records, modelProduct, thisdb)
+    ## backup updated database (online backup, only when enough changes are pending),
+    ## QCxDBBackupTimer or 'ama-go -o backup' (scheduled task) covers the time between ingests
+    checkQCxDBBackup(thisdb, backdb, forceBackup)
+    ## a long-running writer keeps checking between ingests, a one-shot run relies on 'ama-go -o backup'
+    startQCxDBBackupTimer(thisdb, backdb)
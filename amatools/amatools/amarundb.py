@@ -0,0 +1,167 @@
+## amatools.amarundb:
+##   (1) record every command-line inference run (per-stage timing) in a local sqlite3 time-series store
+##   (2) throughput percentiles by DeCart version / model / SizeZ, queue drain estimate
+##   (3) regression detection between two DeCart versions
+##
+import os
+import sqlite3
+import platform
+from datetime import datetime
+from loguru import logger
+from .amautility import openReadOnlyDB
+
+RUNDB_NAME = 'inference_runs.db'
+REGRESSION_RATIO = 1.2      ## candidate median 20% slower than baseline is a regression
+REGRESSION_MIN_RUNS = 5
+
+## ---------- ---------- ---------- ----------
+## 🗃️ inference run database
+## ---------- ---------- ---------- ----------
+def getDefaultRunDB():
+    return os.path.join(os.getenv('LOCALAPPDATA', os.path.expanduser('~')), 'amatools', RUNDB_NAME)
+
+def createInferenceRunDB(dbname):
+    dbconn = sqlite3.connect(dbname)
+    try:
+        dbconn.execute("CREATE TABLE IF NOT EXISTS runs ( \
+            id INTEGER PRIMARY KEY, execution_date INTEGER NOT NULL, host TEXT NOT NULL, \
+            hw_cpu TEXT, hw_gpu TEXT, decart_version TEXT NOT NULL, \
+            model TEXT NOT NULL, modelVersion TEXT, sizez INTEGER, scanner TEXT, \
+            wsifname TEXT, wsifsize REAL, medfsize REAL, width INTEGER, height INTEGER, \
+            convert_seconds REAL, inference_seconds REAL, analysis_seconds REAL)")
+        dbconn.execute("CREATE INDEX IF NOT EXISTS idx_runs_version_model ON runs (decart_version, model, sizez)")
+        dbconn.execute("CREATE INDEX IF NOT EXISTS idx_runs_date ON runs (execution_date)")
+        dbconn.commit()
+    finally:
+        dbconn.close()
+
+def recordInferenceRuns(metaRecords, dbname=None, envConfig=None):
+    ## metaRecords: metadata of gotoModelInference, returns the number of recorded runs
+    if len(metaRecords) == 0:
+        return 0
+    dbname = dbname if dbname else getDefaultRunDB()
+    envConfig = envConfig if envConfig else {}
+    if os.path.isdir(os.path.dirname(dbname) or '.') == False:
+        os.makedirs(os.path.dirname(dbname))
+    createInferenceRunDB(dbname)
+    host = platform.node()
+    rows = [(int(m.get('execution_date', 0)), host, envConfig.get('hw_cpu'), envConfig.get('hw_gpu'),
+             m.get('decart_version', ''), m.get('modelname', ''), m.get('modelversion'), m.get('sizez'),
+             m.get('scanner'), m.get('wsifname'), m.get('wsifsize'), m.get('medfsize'), m.get('width'), m.get('height'),
+             m.get('convert_timestamp'), m.get('inference_timestamp'), m.get('analysis_timestamp')) for m in metaRecords]
+    dbconn = sqlite3.connect(dbname)
+    try:
+        with dbconn:
+            dbconn.executemany("INSERT INTO runs (execution_date, host, hw_cpu, hw_gpu, decart_version, model, modelVersion, \
+                sizez, scanner, wsifname, wsifsize, medfsize, width, height, convert_seconds, inference_seconds, analysis_seconds) \
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+    except sqlite3.Error as e:
+        logger.error(f'failed to record inference runs to {dbname}: {e}')
+        return 0
+    finally:
+        dbconn.close()
+    logger.trace(f'{len(rows)} inference runs recorded in {dbname}')
+    return len(rows)
+
+def queryInferenceRuns(dbname, model=None, decart_version=None, host=None, since=None):
+    conds, params = [], []
+    for col, value in [('model', model), ('decart_version', decart_version), ('host', host)]:
+        if value:
+            conds.append(f'{col} = ?')
+            params.append(value)
+    if since:
+        conds.append('execution_date >= ?')
+        params.append(int(since.timestamp()) if isinstance(since, datetime) else int(since))
+    sql_str = 'SELECT * FROM runs'
+    if conds:
+        sql_str += ' WHERE ' + ' AND '.join(conds)
+    dbconn = None
+    try:
+        dbconn = openReadOnlyDB(dbname)
+        dbconn.row_factory = sqlite3.Row
+        return [dict(row) for row in dbconn.execute(sql_str + ' ORDER BY execution_date', params)]
+    except sqlite3.Error as e:
+        logger.error(f'query inference runs from {dbname} failed, {e}')
+        return []
+    finally:
+        if dbconn:
+            dbconn.close()
+
+## ---------- ---------- ---------- ----------
+## 📈 throughput percentiles and regressions
+## ---------- ---------- ---------- ----------
+def percentile(values, q):
+    ## linear interpolation, q in [0, 100]
+    values = sorted(v for v in values if v is not None)
+    if len(values) == 0:
+        return None
+    pos = (len(values) - 1) * q / 100
+    lo = int(pos)
+    hi = min(lo + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (pos - lo)
+
+def summarizeInferenceRuns(runs, groupby=('decart_version', 'model', 'sizez')):
+    groups = {}
+    for run in runs:
+        groups.setdefault(tuple(run[k] for k in groupby), []).append(run)
+    summary = []
+    for key, group in sorted(groups.items(), key=lambda kv: [(k is None, k) for k in kv[0]]):
+        seconds = [r['analysis_seconds'] for r in group]
+        mbps = [r['wsifsize']/r['analysis_seconds'] for r in group if r['wsifsize'] and r['analysis_seconds']]
+        thisrow = dict(zip(groupby, key))
+        thisrow['runs'] = len(group)
+        for q in [50, 90, 95]:
+            thisrow[f'p{q}'] = percentile(seconds, q)
+        thisrow['convert_p50'] = percentile([r['convert_seconds'] for r in group], 50)
+        thisrow['inference_p50'] = percentile([r['inference_seconds'] for r in group], 50)
+        thisrow['mb_per_second'] = percentile(mbps, 50)
+        thisrow['slides_per_hour'] = 3600 / thisrow['p50'] if thisrow['p50'] else None
+        summary.append(thisrow)
+    return summary
+
+def detectRegressions(runs, baseline, candidate, ratio=REGRESSION_RATIO, min_runs=REGRESSION_MIN_RUNS):
+    ## compare median analysis time per (model, sizez) between two DeCart versions
+    base = {(s['model'], s['sizez']): s for s in summarizeInferenceRuns([r for r in runs if r['decart_version'] == baseline], ('model', 'sizez'))}
+    cand = {(s['model'], s['sizez']): s for s in summarizeInferenceRuns([r for r in runs if r['decart_version'] == candidate], ('model', 'sizez'))}
+    regressions = []
+    for key in sorted(set(base) & set(cand), key=str):
+        b, c = base[key], cand[key]
+        if b['runs'] < min_runs or c['runs'] < min_runs or not b['p50'] or not c['p50']:
+            continue
+        if c['p50'] / b['p50'] >= ratio:
+            regressions.append({'model': key[0], 'sizez': key[1], 'baseline_p50': b['p50'], 'candidate_p50': c['p50'],
+                                'ratio': c['p50'] / b['p50'], 'baseline_runs': b['runs'], 'candidate_runs': c['runs']})
+    return regressions
+
+def estimateDrainSeconds(runs, pending_sizez, decart_version=None, model=None, workers=1):
+    ## pending_sizez: [SizeZ of each queued slide], unknown SizeZ uses the median of all runs
+    runs = [r for r in runs if (not decart_version or r['decart_version'] == decart_version) and (not model or r['model'] == model)]
+    bysizez = {s['sizez']: s['p50'] for s in summarizeInferenceRuns(runs, ('sizez',))}
+    fallback = percentile([r['analysis_seconds'] for r in runs], 50) or 0
+    return sum(bysizez.get(z, fallback) or fallback for z in pending_sizez) / max(workers, 1)
+
+def reportInferenceRuns(dbname=None, model=None, baseline=None, candidate=None):
+    dbname = dbname if dbname else getDefaultRunDB()
+    if os.path.isfile(dbname) == False:
+        logger.error(f'{dbname} does not exist, no inference run was recorded')
+        return
+    runs = queryInferenceRuns(dbname, model=model)
+    if len(runs) == 0:
+        logger.warning(f'no inference runs{f" of {model}" if model else ""} in {dbname}')
+        return
+    fmt = lambda v: '-' if v is None else f'{v:,.1f}'
+    print('-'*100)
+    print(f"{'decart':<10}{'model':<8}{'SizeZ':>6}{'runs':>6}{'p50(s)':>10}{'p90(s)':>10}{'p95(s)':>10}"
+          f"{'conv p50':>10}{'infer p50':>10}{'MB/s':>8}{'slides/h':>10}")
+    for s in summarizeInferenceRuns(runs):
+        print(f"{s['decart_version']:<10}{s['model']:<8}{str(s['sizez']):>6}{s['runs']:>6}{fmt(s['p50']):>10}{fmt(s['p90']):>10}"
+              f"{fmt(s['p95']):>10}{fmt(s['convert_p50']):>10}{fmt(s['inference_p50']):>10}{fmt(s['mb_per_second']):>8}"
+              f"{fmt(s['slides_per_hour']):>10}")
+    print('-'*100)
+    if baseline and candidate:
+        regressions = detectRegressions(runs, baseline, candidate)
+        if len(regressions) == 0:
+            logger.info(f'no regression from decart{baseline} to decart{candidate}')
+        for r in regressions:
+            logger.warning(f"regression {r['model']} SizeZ={r['sizez']}: decart{baseline} {r['baseline_p50']:,.0f}s -> "
+                           f"decart{candidate} {r['candidate_p50']:,.0f}s (x{r['ratio']:.2f})")
@@ -1,8 +1,17 @@
 import os
 import yaml
+import sqlite3
+import pathlib
 from datetime import datetime, timedelta
 from loguru import logger
 
+##---------------------------------------------------------
+## open sqlite3 database read-only, e.g. while another process is writing it
+##---------------------------------------------------------
+def openReadOnlyDB(dbname):
+    ## file: URI from pathlib, Windows drive letters, UNC paths, spaces and '?'/'#' in names are escaped
+    return sqlite3.connect(f'{pathlib.Path(dbname).resolve().as_uri()}?mode=ro', uri=True)
+
 ##---------------------------------------------------------
 ## change model product in config.yaml
 ##---------------------------------------------------------
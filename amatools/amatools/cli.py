@@ -6,6 +6,8 @@ from .modelWSI import cmdModelInference
 from .amaconfig import initLogger, pcENV
 from .amautility import updateDeCartConfig
 from .parseAIX import retrieveAnalysisMetadata
+from .amarundb import reportInferenceRuns
+from .amacsvdb import checkQCxDBBackup, getQCxBackupDB
 from .queryMED import extractSingleLayersFromMultiLayersMED
 
 def stopThisTask(taskname):
@@ -33,14 +35,17 @@ def stopThisTask(taskname):
 
 def main():
     parser = argparse.ArgumentParser()
+    parser.add_argument("-b", "--baseline", help='baseline decart version for regression report')
     parser.add_argument("-d", "--destpath", help="destination path")
-    parser.add_argument("-f", "--wsipath", help="wsi file or wsi folder or med/aix folder", required=True)
+    parser.add_argument("-f", "--wsipath", help="wsi file or wsi folder or med/aix folder, or inference run .db (report), or QC .db (backup)", required=True)
     parser.add_argument("-j", "--configjson", help="configuration settings")
     parser.add_argument("-l", "--layers", help='[i, j]: from layer-i to layer-j')
     parser.add_argument("-m", "--modelname", help='model product name')
     parser.add_argument("-o", "--option", default="inference", required=True)
     parser.add_argument("-p", "--decartpath", help='decart folder')
+    parser.add_argument("-s", "--cellstore", help='cell store for analysis: .db file (sqlite3) or folder (parquet)')
     parser.add_argument("-v", "--decartversion", help='decart version')
+    parser.add_argument("-w", "--workers", type=int, help='number of concurrent DeCart processes')
     args = parser.parse_args()
     # initiate Logger
     initLogger()
@@ -50,9 +55,13 @@ def main():
     # actions
     action = args.option.lower()
     if action == 'inference':
-        cmdModelInference(args.wsipath, model_name=args.modelname, decart_version=args.decartversion, config_file=args.configjson)
+        cmdModelInference(args.wsipath, model_name=args.modelname, decart_version=args.decartversion, config_file=args.configjson, workers=args.workers)
     elif action == 'analysis':
-        retrieveAnalysisMetadata(args.wsipath)
+        retrieveAnalysisMetadata(args.wsipath, cellstore=args.cellstore)
+    elif action == 'report':
+        reportInferenceRuns(args.wsipath, model=args.modelname, baseline=args.baseline, candidate=args.decartversion)
+    elif action == 'backup':
+        checkQCxDBBackup(args.wsipath, getQCxBackupDB(args.wsipath, args.destpath))
     elif action == 'extract':
         layer_range = args.layers
         zrange = []     ## default: best-z only
@@ -76,10 +85,18 @@ def main():
         usage_example = '''Usage:
           [option='inference'] for running model inference
             ama-go -o inference -f d:\workfolder\inference\test -m AIxURO -v 2.7.4
+            ama-go -o inference -f d:\workfolder\inference\test -m AIxURO -v 2.7.4 -w 2
           [option='analysis'] for analyzing metadata from .aix folder
             ama-go -o analysis -f d:\workfolder\inference\test
+            ama-go -o analysis -f d:\workfolder\inference\test -s d:\workfolder\cells.db
           [option='extract'] for extract single layer images from .med file
             ama-go -o extarct -f multiple_layers.med -d dest_folder_path -l 0-4
+          [option='report'] for throughput percentiles of recorded inference runs (and regressions between decart versions)
+            ama-go -o report -f %LOCALAPPDATA%\amatools\inference_runs.db -m AIxURO
+            ama-go -o report -f %LOCALAPPDATA%\amatools\inference_runs.db -m AIxURO -b 2.7.4 -v 2.8.1
+          [option='backup'] for online backup of the QC database if slides are pending, e.g. as a scheduled task
+            ama-go -o backup -f d:\qcapi\dbmeta\qc_uro.db
+            schtasks /create /tn ama-qc-backup /sc minute /mo 10 /tr "ama-go -o backup -f d:\qcapi\dbmeta\qc_uro.db"
         '''
         print('-'*80)
         print(usage_example)
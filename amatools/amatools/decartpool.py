@@ -0,0 +1,203 @@
+## amatools.decartpool:
+##   (1) run N DeCart command-line processes concurrently (worker pool), N is configured per host
+##   (2) per-slide timeout estimated from the slide file size, instead of one 24-hour timeout for all slides
+##   (3) retry transient failures (non-zero exit code, timeout, .med/.aix not written)
+##   (4) DeCart -verbose output is parsed while streaming, live progress, a stalled DeCart is killed early
+##
+import os
+import re
+import time
+import threading
+import subprocess
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from loguru import logger
+
+DECART_TIMEOUT_MIN = 1800           ## at least 30 minutes per slide
+DECART_SECONDS_PER_GB = 3600        ## 21-layer slides take about 1 hour per GB
+DECART_TIMEOUT_MAX = 86400
+DECART_STALL_SECONDS = 900          ## no output for 15 minutes: DeCart hangs
+PROGRESS_EVERY = 60                 ## seconds between progress reports of a slide
+TIME_FORMAT = '%Y-%m-%dT%H:%M:%S'
+RE_TILES = re.compile(r'tiles?\D{0,8}(\d+)', re.IGNORECASE)
+
+## ---------- ---------- ---------- ----------
+## slide file size and timeout
+## ---------- ---------- ---------- ----------
+def getSlideFileSize(wsf):
+    ## .mrxs: sum of the files in the data folder, others: size of the file
+    workpath, wsifname = os.path.split(wsf)
+    shortname, extension = os.path.splitext(wsifname)
+    if extension.lower() == '.mrxs':
+        mrxspath = os.path.join(workpath, shortname)
+        if os.path.isdir(mrxspath):
+            return sum(entry.stat().st_size for entry in os.scandir(mrxspath) if entry.is_file())
+        return 0
+    return os.path.getsize(wsf) if os.path.isfile(wsf) else 0
+
+def slideTimeout(wsf, timeout=None):
+    if timeout:
+        return timeout
+    seconds = getSlideFileSize(wsf) / 2**30 * DECART_SECONDS_PER_GB
+    return int(min(max(DECART_TIMEOUT_MIN, seconds), DECART_TIMEOUT_MAX))
+
+## ---------- ---------- ---------- ----------
+## one DeCart process for one slide
+## ---------- ---------- ---------- ----------
+class DeCartProgress:
+    ## incremental parsing of DeCart -verbose output, same markers as parseDeCartLog:
+    ##   'convert ' / 'processed' lines -> start of conversion, start of inference, inference done
+    STAGES = ['start', 'convert', 'inference', 'done']
+    def __init__(self, wsf, onprogress=None, report_every=PROGRESS_EVERY):
+        self.wsf = wsf
+        self.fname = os.path.basename(wsf)
+        self.onprogress = onprogress    ## onprogress(event), event: {'wsf', 'stage', 'elapsed', 'tiles'}
+        self.report_every = report_every
+        self.t0 = time.perf_counter()
+        self.lastoutput = self.t0
+        self.lastreport = self.t0
+        self.first_ts = None
+        self.ts = []
+        self.tiles = 0
+        self.lines = []
+    def stage(self):
+        return self.STAGES[min(len(self.ts), len(self.STAGES)-1)]
+    def lineTimestamp(self, line):
+        try:
+            return datetime.strptime(line[5:24], TIME_FORMAT).timestamp()
+        except ValueError:
+            return None
+    def feed(self, line):
+        self.lastoutput = time.perf_counter()
+        if not line:
+            return
+        self.lines.append(line)
+        logger.info(f'[{self.fname}] {line}')
+        if self.first_ts is None:
+            self.first_ts = self.lineTimestamp(line)
+        changed = False
+        if ('convert ' in line) or ('processed' in line):
+            ts = self.lineTimestamp(line)
+            if ts:
+                self.ts.append(ts)
+                changed = True
+        found = RE_TILES.search(line)
+        if found:
+            self.tiles = max(self.tiles, int(found.group(1)))
+        if changed or self.lastoutput - self.lastreport >= self.report_every:
+            self.report()
+    def report(self):
+        self.lastreport = time.perf_counter()
+        event = {'wsf': self.wsf, 'stage': self.stage(), 'elapsed': self.lastreport - self.t0, 'tiles': self.tiles}
+        if self.onprogress:
+            self.onprogress(event)
+        else:
+            logger.info(f"{self.fname}: {event['stage']}, {event['elapsed']:,.0f} seconds, {event['tiles']:,} tiles")
+    def timestamps(self):
+        ## (conversion seconds, inference seconds), as parseDeCartLog
+        if len(self.ts) == 3:
+            return self.ts[1]-self.ts[0], self.ts[2]-self.ts[1]
+        if len(self.ts) == 1 and self.first_ts:     ## inference .med file
+            return 0, self.ts[0]-self.first_ts
+        return 0, 0
+    def stdout(self):
+        return '\n'.join(self.lines)
+
+class DeCartResult:
+    def __init__(self, wsf):
+        self.wsf = wsf
+        self.ok = False
+        self.returncode = None
+        self.stdout = ''
+        self.convert_timestamp = 0
+        self.inference_timestamp = 0
+        self.sdt = None
+        self.edt = None
+        self.attempts = 0
+
+def runDeCart(bin_decart, wsf, timeout, env=None, stall=DECART_STALL_SECONDS, onprogress=None):
+    ## returns (returncode, DeCartProgress), returncode is None if DeCart was killed (timeout or stalled)
+    progress = DeCartProgress(wsf, onprogress)
+    try:
+        proc = subprocess.Popen([bin_decart, "-verbose", "-w", wsf], stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                text=True, errors='replace', env=env)
+    except OSError as e:
+        logger.error(f'failed to run {bin_decart}: {e}')
+        return None, progress
+    def readOutput():
+        for line in proc.stdout:
+            progress.feed(line.rstrip('\r\n'))
+    reader = threading.Thread(target=readOutput, name=f'decart-{progress.fname}', daemon=True)
+    reader.start()
+    killed = None
+    while True:
+        try:
+            proc.wait(timeout=1)
+            break
+        except subprocess.TimeoutExpired:
+            now = time.perf_counter()
+            if now - progress.t0 > timeout:
+                killed = f'exceeds {timeout:,} seconds'
+            elif stall and now - progress.lastoutput > stall:
+                killed = f'no output for {stall:,} seconds ({progress.stage()})'
+            if killed:
+                logger.error(f'model inference of {progress.fname} {killed}, DeCart was killed')
+                proc.kill()
+                proc.wait()
+                break
+    reader.join(5)
+    return (None if killed else proc.returncode), progress
+
+## ---------- ---------- ---------- ----------
+## worker pool
+## ---------- ---------- ---------- ----------
+class DeCartPool:
+    def __init__(self, bin_decart, doneFolder='done', workers=1, timeout=None, retries=2, retry_wait=30,
+                 stall=DECART_STALL_SECONDS, onprogress=None):
+        self.bin_decart = bin_decart
+        self.doneFolder = doneFolder
+        self.workers = max(int(workers), 1)
+        self.timeout = timeout      ## seconds per slide, None: estimated from file size
+        self.retries = retries
+        self.retry_wait = retry_wait
+        self.stall = stall
+        self.onprogress = onprogress
+    def outputsOf(self, wsf):
+        workpath, wsifname = os.path.split(wsf)
+        shortname = os.path.splitext(wsifname)[0]
+        return [os.path.join(workpath, self.doneFolder, f'{shortname}.{ext}') for ext in ['med', 'aix']]
+    def slideEnv(self, wsf):
+        ## environment of each DeCart process, os.environ of this process is not changed
+        env = dict(os.environ)
+        env.pop('DC_SINGLE_PLANE', None)
+        if os.path.splitext(wsf)[1].lower() in ['.tif', '.tiff']:
+            env['DC_EXTENDED_FORMAT'] = '1'
+        return env
+    def runSlide(self, wsf, order=''):
+        result = DeCartResult(wsf)
+        timeout = slideTimeout(wsf, self.timeout)
+        while result.attempts <= self.retries:
+            result.attempts += 1
+            result.sdt = datetime.now()
+            logger.info(f"start model inference for {wsf} {order}from {result.sdt.strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]} (timeout {timeout:,} seconds) ...")
+            result.returncode, progress = runDeCart(self.bin_decart, wsf, timeout, self.slideEnv(wsf), self.stall, self.onprogress)
+            result.stdout = progress.stdout()
+            result.convert_timestamp, result.inference_timestamp = progress.timestamps()
+            result.edt = datetime.now()
+            result.ok = result.returncode == 0 and all(os.path.exists(f) for f in self.outputsOf(wsf))
+            if result.ok:
+                logger.info(f'finish model inference for {wsf} at {result.edt.strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]}...')
+                break
+            if result.attempts <= self.retries:
+                logger.warning(f'model inference of {os.path.basename(wsf)} failed (exit code {result.returncode}), '
+                               f'retry {result.attempts}/{self.retries} in {self.retry_wait} seconds')
+                time.sleep(self.retry_wait)
+        if not result.ok:
+            logger.error(f'failed while inference {os.path.basename(wsf)} after {result.attempts} attempts')
+        return result
+    def run(self, wsifiles):
+        ## yields DeCartResult in order of completion
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='decart') as executor:
+            futures = [executor.submit(self.runSlide, wsf, f'({ii+1} of {len(wsifiles)}) ') for ii, wsf in enumerate(wsifiles)]
+            for future in as_completed(futures):
+                yield future.result()
@@ -0,0 +1,148 @@
+## amatools.folderwatch: watch scanner folders for new WSI files, shared by watchwsi and watchwsi_cmd
+##   (1) event-driven, watchdog observer (inotify / ReadDirectoryChangesW) if watchdog is installed
+##   (2) polling fallback, network shares (SMB) usually do not emit change events
+##   a WSI file is reported only after its size/mtime stayed the same for 'settle' seconds
+##   each folder is listed once per cycle by os.scandir() (FolderSnapshot), DirEntry stat data is reused
+##   and only entries added/changed since the previous snapshot are processed
+##
+import os
+import time
+import threading
+from loguru import logger
+try:
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+    HAS_WATCHDOG = True
+except ImportError:
+    HAS_WATCHDOG = False
+    FileSystemEventHandler = object
+
+class _WakeUpHandler(FileSystemEventHandler):
+    def __init__(self, wakeup):
+        self.wakeup = wakeup
+    def on_any_event(self, event):
+        self.wakeup.set()
+
+class FolderSnapshot:
+    ## one os.scandir() pass over a folder: path -> (size, mtime_ns) of the files with given extensions
+    ## on Windows DirEntry.is_file()/stat() come with the directory listing, no extra SMB round trip per file
+    def __init__(self, folder, extensions=None):
+        self.folder = folder
+        self.taken = time.monotonic()
+        self.files = {}
+        self.ok = True
+        try:
+            with os.scandir(folder) as entries:
+                for entry in entries:
+                    if extensions is not None and os.path.splitext(entry.name)[1].lower()[1:] not in extensions:
+                        continue
+                    try:
+                        if entry.is_file():
+                            st = entry.stat()
+                            self.files[entry.path] = (st.st_size, st.st_mtime_ns)
+                    except OSError:
+                        continue
+        except OSError as e:
+            logger.warning(f'can not list {folder}: {e}')
+            self.ok = False
+    def diff(self, previous):
+        ## (added or changed paths, removed paths) since the previous snapshot
+        if previous is None:
+            return list(self.files), []
+        changed = [path for path, sig in self.files.items() if previous.files.get(path) != sig]
+        removed = [path for path in previous.files if path not in self.files]
+        return changed, removed
+    def __len__(self):
+        return len(self.files)
+
+class FolderWatcher:
+    def __init__(self, folders, extensions, settle=5.0, poll_interval=30.0, use_events=True, rescan=1.0):
+        self.folders = list(folders)
+        self.extensions = [ext.lower() for ext in extensions]
+        self.settle = settle
+        self.poll_interval = poll_interval
+        self.rescan = rescan    ## a snapshot younger than 'rescan' seconds is reused, e.g. waitForWSI() then listStableWSI()
+        self.use_events = use_events and HAS_WATCHDOG
+        self.wakeup = threading.Event()
+        self.observer = None
+        self.snapshots = {}     ## folder -> FolderSnapshot
+        self.seen = {}          ## path -> monotonic time of the last size/mtime change
+        self.reported = set()   ## stable files already returned by waitForWSI()
+    def start(self):
+        if not self.use_events:
+            logger.info(f'watching {self.folders} by polling every {self.poll_interval} seconds')
+            return
+        try:
+            self.observer = Observer()
+            handler = _WakeUpHandler(self.wakeup)
+            for folder in self.folders:
+                if os.path.isdir(folder):
+                    self.observer.schedule(handler, folder, recursive=False)
+            self.observer.start()
+            logger.info(f'watching {self.folders} by file system events (polling every {self.poll_interval} seconds as fallback)')
+        except Exception as e:
+            logger.warning(f'file system events unavailable ({e}), fallback to polling every {self.poll_interval} seconds')
+            self.observer = None
+    def stop(self):
+        if self.observer:
+            self.observer.stop()
+            self.observer.join()
+            self.observer = None
+    def isWSI(self, fname):
+        return os.path.splitext(fname)[1].lower()[1:] in self.extensions
+    def snapshot(self, folder):
+        ## latest snapshot of a watched folder, listed again if older than 'rescan' seconds
+        previous = self.snapshots.get(folder)
+        if previous is not None and time.monotonic() - previous.taken < self.rescan:
+            return previous
+        current = FolderSnapshot(folder, self.extensions)
+        if not current.ok:
+            return current
+        changed, removed = current.diff(previous)
+        for path in changed:
+            self.seen[path] = current.taken
+        ## forget files which were moved away
+        for path in removed:
+            self.seen.pop(path, None)
+            self.reported.discard(path)
+        self.snapshots[folder] = current
+        return current
+    def scanFolder(self, folder):
+        ## return (stable, pending) WSI files in this folder
+        current = self.snapshot(folder)
+        stable, pending = [], []
+        for path in current.files:
+            if current.taken - self.seen[path] >= self.settle:
+                stable.append(path)
+            else:
+                pending.append(path)
+        return sorted(stable), pending
+    def listStableWSI(self, folder):
+        stable, _ = self.scanFolder(folder)
+        return stable
+    def waitForWSI(self, timeout):
+        ## block until a new stable WSI file shows up in any folder, or timeout
+        deadline = time.monotonic() + timeout
+        while True:
+            newfound, anypending = False, False
+            for folder in self.folders:
+                stable, pending = self.scanFolder(folder)
+                if len(pending):
+                    anypending = True
+                for path in stable:
+                    if path not in self.reported:
+                        self.reported.add(path)
+                        newfound = True
+            if newfound:
+                return True
+            remain = deadline - time.monotonic()
+            if remain <= 0:
+                return False
+            ## files still being written are re-checked after 'settle', otherwise wait for an event or next poll
+            wait_seconds = min(remain, self.settle if anypending else self.poll_interval)
+            if self.wakeup.wait(wait_seconds):
+                self.wakeup.clear()
+                ## debounce: scanner writes a file in many chunks, wait till the folder is quiet
+                quiet_until = time.monotonic() + self.poll_interval
+                while time.monotonic() < min(quiet_until, deadline) and self.wakeup.wait(self.settle):
+                    self.wakeup.clear()
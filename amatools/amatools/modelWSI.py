@@ -6,13 +6,15 @@ import glob
 import subprocess
 import time
 from datetime import datetime, timedelta
+from concurrent.futures import ProcessPoolExecutor
 from loguru import logger
-from func_timeout import func_set_timeout, FunctionTimedOut
 from tqdm import tqdm
 from .amaconfig import pcENV
-from .amautility import updateDeCartConfig, replaceSpace2underscore, parseDeCartLog
+from .amautility import updateDeCartConfig, replaceSpace2underscore
 from .amautility import dumpMetadata2stdout
 from .amacsvdb import saveInferenceResult2CSV
+from .amarundb import recordInferenceRuns
+from .decartpool import DeCartPool, getSlideFileSize, DECART_STALL_SECONDS
 from .queryMED import getMetadataFromMED
 from .parseAIX import getCellsInfoFromAIX
 from .parseAIX import getUROaverageOfSAcells, getUROaverageOfTopCells
@@ -75,71 +77,65 @@ def collectAnalysisMetadata(whichWSI):
 ## ---------- ---------- ---------- ----------
 ## 🖥️ command-line run model inference
 ## ---------- ---------- ---------- ----------
-@func_set_timeout(86400)    ## in case of model inference takes too long time for more than 11 layers
-def gotoModelInference(wsifiles, bin_decart, doneFolder, metaRecords, bVer1Model=False):
-    if os.environ.get('DC_SINGLE_PLANE', None) != None:
-        os.environ.pop('DC_SINGLE_PLANE')
+def harvestSlideMetadata(wsf, doneFolder, decart_version, timestamps):
+    ## runs in a worker process: decompress .aix, areas/traits, file sizes
+    workpath, wsifname = os.path.split(wsf)
+    shortname = os.path.splitext(wsifname)[0]
+    medfile = os.path.join(workpath, doneFolder, f'{shortname}.med')
+    aixfile = os.path.join(workpath, doneFolder, f'{shortname}.aix')
+    ## collect model analysis metadata
+    thismeta = collectAnalysisMetadata(os.path.splitext(medfile)[0])
+    #### filesize
+    wsifsize = round(getSlideFileSize(wsf)/(1024*1024), 4)     ## in MB
+    medfsize = round((os.path.getsize(medfile)+os.path.getsize(aixfile))/(1024*1024), 4)     ## in MB
+    thismeta['wsifname'] = wsifname
+    thismeta['wsifsize'] = wsifsize
+    thismeta['medfsize'] = medfsize
+    thismeta['decart_version'] = decart_version
+    thismeta.update(timestamps)
+    return thismeta
+
+def gotoModelInference(wsifiles, bin_decart, doneFolder, metaRecords, bVer1Model=False, workers=1, timeout=None, harvesters=2, stall=None):
     spos = bin_decart.index('decart')
     decart_version = os.path.split(bin_decart)[0][spos+6:]
-    #if bVer1Model == False:
-    #    bin_decart += ' -verbose -w'
-    for ii, wsf in enumerate(wsifiles):
+    if bVer1Model:
+        ## DeCart of version 1 models has no -verbose -w, nothing is run
+        for wsf in wsifiles:
+            logger.info(f'{bin_decart} {wsf}')
+        return
+    ## 'workers' DeCart processes run concurrently, each slide has its own timeout
+    pool = DeCartPool(bin_decart, doneFolder, workers=workers, timeout=timeout, stall=stall or DECART_STALL_SECONDS)
+    harvester = ProcessPoolExecutor(max_workers=max(int(harvesters), 1))
+    harvests = []
+    for result in pool.run(wsifiles):
+        wsf = result.wsf
         workpath, wsifname = os.path.split(wsf)
         shortname, extension = os.path.splitext(wsifname)
-        if extension.lower() in ['.tif', '.tiff']:
-            os.environ['DC_EXTENDED_FORMAT'] = '1'
-        #cmd_decart = f'{bin_decart} {wsf}'
-        #logger.info(cmd_decart)
-        sdt = datetime.now()
-        logger.info(f"start model inference for {wsf} ({ii+1} of {len(wsifiles)}) from {sdt.strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]} ...")
-        #os.system(cmd_decart)
-        try:
-            if bVer1Model == False:
-                logger.info(f'{bin_decart} -verbose -w {wsf}')
-                decartlog = subprocess.run([bin_decart, "-verbose", "-w", wsf], capture_output=True, text=True)
-            else:
-                logger.info(f'{bin_decart} {wsf}')
-        except subprocess.CalledProcessError as e:
-            logger.error(f'failed while inference {os.path.basename(wsf)}, error: {e}')
-            continue
-        edt = datetime.now()
-        logger.info(f'finish model inference for {wsf} at {edt.strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]}...')
-        analysis_timestamp = edt.timestamp() - sdt.timestamp()
+        analysis_timestamp = result.edt.timestamp() - result.sdt.timestamp()
         ##
-        convert_timestamp, inference_timestamp = parseDeCartLog(decartlog.stdout)
-        lines = decartlog.stdout.split('\n')
-        for _, line in enumerate(lines):
-            if line:
-                logger.info(f'{line}')
+        ## DeCart output was logged and parsed while it was running
+        convert_timestamp, inference_timestamp = result.convert_timestamp, result.inference_timestamp
         if convert_timestamp == 0 and inference_timestamp == 0:
             logger.warning(f'something wrong happened while model inference {os.path.basename(wsf)}')
         ## check .med file
         medfile = os.path.join(workpath, doneFolder, f'{shortname}.med')
         aixfile = os.path.join(workpath, doneFolder, f'{shortname}.aix')
         if not os.path.exists(medfile) or not os.path.exists(aixfile):
-            logger.error(f'{medfile} does not exist!', 'ERROR')
-            return
-        ## collect model analysis metadata
-        thismeta = collectAnalysisMetadata(os.path.splitext(medfile)[0])
-        #### filesize
-        if extension.lower() == '.mrxs':
-            mrxspath = os.path.join(workpath, shortname)
-            totalfsize = sum(os.path.getsize(f'{mrxspath}\\{fd}') for fd in os.listdir(mrxspath) if os.path.isfile(f'{mrxspath}\\{fd}'))
-        else:
-            totalfsize = os.path.getsize(wsf)
-        wsifsize = round(totalfsize/(1024*1024), 4)     ## in MB
-        medfsize = round((os.path.getsize(medfile)+os.path.getsize(aixfile))/(1024*1024), 4)     ## in MB
-        thismeta['wsifname'] = wsifname
-        thismeta['wsifsize'] = wsifsize
-        thismeta['medfsize'] = medfsize
-        thismeta['decart_version'] = decart_version
-        thismeta['execution_date'] = int(sdt.timestamp())
-        thismeta['convert_timestamp'] = convert_timestamp
-        thismeta['inference_timestamp'] = inference_timestamp
-        thismeta['analysis_timestamp'] = analysis_timestamp
-        metaRecords.append(thismeta)
+            logger.error(f'{medfile} does not exist!')
+            continue
+        ## post-processing in background, the next DeCart process starts immediately
+        timestamps = {'execution_date': int(result.sdt.timestamp()), 'convert_timestamp': convert_timestamp,
+                      'inference_timestamp': inference_timestamp, 'analysis_timestamp': analysis_timestamp}
+        harvests.append(harvester.submit(harvestSlideMetadata, wsf, doneFolder, decart_version, timestamps))
+    ## join metadata of all slides for saveInferenceResult2CSV
+    for future in harvests:
+        try:
+            metaRecords.append(future.result())
+        except Exception as e:
+            logger.error(f'failed to collect analysis metadata: {e}')
+    harvester.shutdown()
 
-def cmdModelInference(wsipath, model_name=None, decart_version=None, config_file=None):
+def cmdModelInference(wsipath, model_name=None, decart_version=None, config_file=None, workers=None):
     # configuration
     PC_ARGS.loadConfigJson(config_file) if config_file else PC_ARGS.defaultConfig()
     modelname = model_name if model_name else 'AIxURO'
@@ -163,6 +159,10 @@ def cmdModelInference(wsipath, model_name=None, decart_version=None, config_file
         return
     doneFolder = '' if decart_ver[:5] in ['2.7.3', '2.7.4', '2.7.5'] else 'done'
     cmd_decart = decart_exe
+    decart_workers = workers if workers else PC_ARGS.envConfig.get('decart_workers', 1)
+    decart_timeout = PC_ARGS.envConfig.get('decart_timeout', None)
+    decart_stall = PC_ARGS.envConfig.get('decart_stall', None)
+    metadata_workers = PC_ARGS.envConfig.get('metadata_workers', 2)
     medaix_metadata = []    ## metadata of model inference analysis results
     ## get the list of WSI files to be processed
     t0 = time.perf_counter()
@@ -191,21 +191,23 @@ def cmdModelInference(wsipath, model_name=None, decart_version=None, config_file
     howmanywsi = len(wsifiles)
     if howmanywsi > 0:
         logger.trace(f'➡️ model inference using decart{decart_ver} model:{modelname} for {howmanywsi} WSI files...')
-        gotoModelInference(wsifiles, cmd_decart, doneFolder, medaix_metadata)
+        gotoModelInference(wsifiles, cmd_decart, doneFolder, medaix_metadata, workers=decart_workers, timeout=decart_timeout, harvesters=metadata_workers, stall=decart_stall)
     howmanyzip = len(zipfiles)
     if howmanyzip > 0:
         logger.trace(f'🔄 model inference using decart{decart_ver} model:{modelname} for {howmanyzip} ZIP files...')
-        gotoModelInference(zipfiles, cmd_decart, doneFolder, medaix_metadata)
+        gotoModelInference(zipfiles, cmd_decart, doneFolder, medaix_metadata, workers=decart_workers, timeout=decart_timeout, harvesters=metadata_workers, stall=decart_stall)
     howmanymed = len(medfiles)
     if howmanymed > 0:
         logger.trace(f'🔁 model inference using decart{decart_ver} model:{modelname} for {howmanymed} MED files...')
-        gotoModelInference(medfiles, cmd_decart, doneFolder, medaix_metadata)
+        gotoModelInference(medfiles, cmd_decart, doneFolder, medaix_metadata, workers=decart_workers, timeout=decart_timeout, harvesters=metadata_workers, stall=decart_stall)
     consumed_time = f'{timedelta(seconds=time.perf_counter()-t0)}'
     logger.info(f'processed {howmanywsi+howmanyzip+howmanyzip} slides with {consumed_time[:-3]}')
     logger.info(f'{modelname} model inference {wsipath} completed!')
     ## save metadata of model inference analysis results
     if len(medaix_metadata):
         saveInferenceResult2CSV(medaix_metadata, wsipath)
+        ## per-stage timing of every run, for ama-go -o report
+        recordInferenceRuns(medaix_metadata, PC_ARGS.envConfig.get('rundb'), PC_ARGS.envConfig)
         ## dump partial metadata to stdout
         dumpMetadata2stdout(medaix_metadata)
     logger.trace(f'[inference] {modelname} model inference {wsipath} completed!')
@@ -6,7 +6,7 @@ import shapely.geometry
 from loguru import logger
 from tqdm import tqdm
 from .queryMED import getMetadataFromMED
-from .amacsvdb import saveTCellsMetadata2CSV, saveTraitsSummary2CSV
+from .amacsvdb import saveTCellsMetadata2CSV, saveTCellsMetadata2Store, saveTraitsSummary2CSV
 from .amacsvdb import saveAnalysisMetadata2CSV
 
 ##---------------------------------------------------------
@@ -370,7 +370,7 @@ def getCategoryName(whichmodel, whichversion, category, noModelArch=None):
 ##  cli.py option='analysis'
 ##  utilities for analyzing group of .aix files 
 ## -------------------------------------------------------------- 
-def retrieveAnalysisMetadata(workpath, thismpp=None):
+def retrieveAnalysisMetadata(workpath, thismpp=None, cellstore=None):
     if not thismpp:
         medlist = glob.glob(os.path.join(workpath, '*.med'))
         if len(medlist) > 0:
@@ -412,6 +412,8 @@ def retrieveAnalysisMetadata(workpath, thismpp=None):
             cellmeta.append(thismeta)
             #### save metadata to CSV
             saveTCellsMetadata2CSV(aixfile, cellslist, modelname, modelversion)
+            if cellstore:
+                saveTCellsMetadata2Store(aixfile, cellslist, modelname, modelversion, cellstore)
             ## collect traits information
             if modelname == 'AIxURO':
                 thistrait = countNumberOfUROtraits(cellslist, CRITERA_TRAIT)
@@ -0,0 +1,124 @@
+## amatools.decartpool against a stub DeCart executable:
+##   the stub prints -verbose style lines, then acts by the slide name
+##   ok_*: writes done/<slide>.med/.aix, fail_*: exit code 1, nooutput_*: exit code 0 without outputs,
+##   hang_*: no output for a long time, every run appends 'start end' to <slide folder>/runs.log
+##
+import os
+import sys
+import time
+import stat
+import pytest
+from amatools.decartpool import DeCartPool
+
+STUB_DECART = '''
+import os, sys, time
+from datetime import datetime
+wsf = sys.argv[-1]
+workpath, wsifname = os.path.split(wsf)
+shortname = os.path.splitext(wsifname)[0]
+t0 = time.time()
+print(f"[I] {datetime.now().strftime('%Y-%m-%dT%H:%M:%S')} convert {wsifname}", flush=True)
+if shortname.startswith('hang_'):
+    time.sleep(60)
+time.sleep(float(os.environ.get('STUB_DECART_SECONDS', '0.2')))
+with open(os.path.join(workpath, 'runs.log'), 'a') as fh:
+    fh.write(f'{t0} {time.time()}\\n')
+if shortname.startswith('fail_'):
+    sys.exit(1)
+if shortname.startswith('ok_'):
+    os.makedirs(os.path.join(workpath, 'done'), exist_ok=True)
+    for ext in ['med', 'aix']:
+        with open(os.path.join(workpath, 'done', f'{shortname}.{ext}'), 'w') as fh:
+            fh.write(ext)
+print(f"[I] {datetime.now().strftime('%Y-%m-%dT%H:%M:%S')} processed 100 tiles", flush=True)
+'''
+
+@pytest.fixture
+def decart(tmp_path):
+    script = tmp_path / 'stub_decart.py'
+    script.write_text(STUB_DECART)
+    if os.name == 'nt':
+        exe = tmp_path / 'decart.cmd'
+        exe.write_text(f'@"{sys.executable}" "{script}" %*\n')
+    else:
+        exe = tmp_path / 'decart'
+        exe.write_text(f'#!/bin/sh\nexec "{sys.executable}" "{script}" "$@"\n')
+        exe.chmod(exe.stat().st_mode | stat.S_IXUSR)
+    return str(exe)
+
+def makeSlides(folder, names):
+    folder.mkdir(exist_ok=True)
+    slides = []
+    for name in names:
+        wsf = folder / f'{name}.svs'
+        wsf.write_bytes(b'II*\x00' + b'\x00' * 1024)
+        slides.append(str(wsf))
+    return slides
+
+def readRuns(folder):
+    runsfile = folder / 'runs.log'
+    if not runsfile.exists():
+        return []
+    return [tuple(float(t) for t in line.split()) for line in runsfile.read_text().splitlines() if line]
+
+def test_successful_slides(decart, tmp_path):
+    slides = makeSlides(tmp_path / 'wsi', ['ok_a', 'ok_b'])
+    pool = DeCartPool(decart, 'done', workers=2, timeout=30, retries=0)
+    results = {os.path.basename(r.wsf): r for r in pool.run(slides)}
+    assert sorted(results) == ['ok_a.svs', 'ok_b.svs']
+    for result in results.values():
+        assert result.ok and result.returncode == 0 and result.attempts == 1
+        assert 'processed 100 tiles' in result.stdout
+        assert all(os.path.isfile(f) for f in pool.outputsOf(result.wsf))
+
+def test_failure_is_retried(decart, tmp_path):
+    slides = makeSlides(tmp_path / 'wsi', ['fail_a'])
+    pool = DeCartPool(decart, 'done', workers=1, timeout=30, retries=2, retry_wait=0)
+    result = next(pool.run(slides))
+    assert not result.ok
+    assert result.returncode == 1
+    assert result.attempts == 3
+    assert len(readRuns(tmp_path / 'wsi')) == 3
+
+def test_missing_outputs_is_failure(decart, tmp_path):
+    slides = makeSlides(tmp_path / 'wsi', ['nooutput_a'])
+    pool = DeCartPool(decart, 'done', workers=1, timeout=30, retries=0)
+    result = next(pool.run(slides))
+    assert result.returncode == 0
+    assert not result.ok
+
+def test_per_slide_timeout(decart, tmp_path):
+    ## the hanging slide is killed after its own timeout, the other slide is not affected
+    slides = makeSlides(tmp_path / 'wsi', ['hang_a', 'ok_b'])
+    pool = DeCartPool(decart, 'done', workers=2, timeout=2, retries=0, stall=None)
+    t0 = time.perf_counter()
+    results = {os.path.basename(r.wsf): r for r in pool.run(slides)}
+    assert time.perf_counter() - t0 < 30
+    assert not results['hang_a.svs'].ok
+    assert results['hang_a.svs'].returncode is None
+    assert results['ok_b.svs'].ok
+
+def test_stalled_slide_is_killed(decart, tmp_path):
+    slides = makeSlides(tmp_path / 'wsi', ['hang_a'])
+    pool = DeCartPool(decart, 'done', workers=1, timeout=60, retries=0, stall=2)
+    t0 = time.perf_counter()
+    result = next(pool.run(slides))
+    assert time.perf_counter() - t0 < 30
+    assert not result.ok and result.returncode is None
+
+@pytest.mark.parametrize('workers', [1, 3])
+def test_concurrency(decart, tmp_path, monkeypatch, workers):
+    ## at most 'workers' DeCart processes run at the same time
+    monkeypatch.setenv('STUB_DECART_SECONDS', '1.0')
+    slides = makeSlides(tmp_path / 'wsi', [f'ok_{i}' for i in range(6)])
+    pool = DeCartPool(decart, 'done', workers=workers, timeout=30, retries=0)
+    results = list(pool.run(slides))
+    assert len(results) == 6 and all(r.ok for r in results)
+    runs = readRuns(tmp_path / 'wsi')
+    assert len(runs) == 6
+    events = sorted([(start, 1) for start, _ in runs] + [(end, -1) for _, end in runs])
+    running, peak = 0, 0
+    for _, delta in events:
+        running += delta
+        peak = max(peak, running)
+    assert peak == workers
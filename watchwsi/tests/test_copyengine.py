@@ -0,0 +1,75 @@
+## watchcch.copyengine.copyFileChunked: resume from <dst>.part + <dst>.part.json journal
+##
+import os
+import hashlib
+import pytest
+from watchcch.copyengine import copyFileChunked, writeJournal
+
+CHUNK = 4096
+
+@pytest.fixture
+def source(tmp_path):
+    src = tmp_path / 'src' / 'a.svs'
+    src.parent.mkdir()
+    src.write_bytes(os.urandom(25 * CHUNK + 123))
+    return src
+
+def copyAndCount(src, dst):
+    ## returns (digest, bytes read from the source in this call)
+    copied = []
+    digest = copyFileChunked(str(src), str(dst), chunksize=CHUNK, retries=0, progress=copied.append)
+    return digest, sum(copied)
+
+def writePart(src, dst, data, offset):
+    st = os.stat(src)
+    dst.parent.mkdir(exist_ok=True)
+    (dst.parent / f'{dst.name}.part').write_bytes(data)
+    writeJournal(f'{dst}.part.json', {'src': str(src), 'size': st.st_size, 'mtime': st.st_mtime, 'offset': offset})
+
+def test_copy(source, tmp_path):
+    dst = tmp_path / 'dst' / 'a.svs'
+    dst.parent.mkdir()
+    digest, nbytes = copyAndCount(source, dst)
+    assert digest == hashlib.sha256(source.read_bytes()).hexdigest()
+    assert nbytes == source.stat().st_size
+    assert dst.read_bytes() == source.read_bytes()
+    assert not os.path.exists(f'{dst}.part') and not os.path.exists(f'{dst}.part.json')
+
+def test_resume_from_truncated_part(source, tmp_path):
+    ## the journal is ahead of the .part file, resume from the end of the .part file
+    dst = tmp_path / 'dst' / 'a.svs'
+    data = source.read_bytes()
+    writePart(source, dst, data[:10 * CHUNK + 7], offset=16 * CHUNK)
+    digest, nbytes = copyAndCount(source, dst)
+    assert digest == hashlib.sha256(data).hexdigest()
+    assert nbytes == len(data) - (10 * CHUNK + 7)
+    assert dst.read_bytes() == data
+
+def test_resume_from_journal_offset(source, tmp_path):
+    ## bytes after the journal offset are written again
+    dst = tmp_path / 'dst' / 'a.svs'
+    data = source.read_bytes()
+    writePart(source, dst, data[:16 * CHUNK] + b'\x00' * CHUNK, offset=16 * CHUNK)
+    digest, nbytes = copyAndCount(source, dst)
+    assert nbytes == len(data) - 16 * CHUNK
+    assert dst.read_bytes() == data
+
+def test_part_not_matching_source(source, tmp_path):
+    ## the journal offset was written but the data never reached the disk
+    dst = tmp_path / 'dst' / 'a.svs'
+    data = source.read_bytes()
+    writePart(source, dst, b'\x00' * (16 * CHUNK), offset=16 * CHUNK)
+    digest, nbytes = copyAndCount(source, dst)
+    assert digest == hashlib.sha256(data).hexdigest()
+    assert nbytes == len(data)
+    assert dst.read_bytes() == data
+
+def test_journal_of_other_source(source, tmp_path):
+    dst = tmp_path / 'dst' / 'a.svs'
+    data = source.read_bytes()
+    writePart(source, dst, data[:16 * CHUNK], offset=16 * CHUNK)
+    source.write_bytes(data[::-1])
+    os.utime(source, (1, 1))
+    digest, nbytes = copyAndCount(source, dst)
+    assert nbytes == len(data)
+    assert dst.read_bytes() == data[::-1]
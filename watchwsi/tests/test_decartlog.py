@@ -0,0 +1,77 @@
+## watchcch.decartlog.DeCartLogTailer: incremental reads, log rotation and truncation
+##
+import os
+import threading
+from datetime import datetime
+from watchcch.decartlog import DeCartLogTailer
+
+def debugLine(minute, level='info', msg='tile processed'):
+    ## debug.log of DeCart 2.8.x, timestamp at position 0
+    return f'2026-10-19T10:{minute:02d}:00.000 [{level}] {msg}\n'
+
+def appendLog(logpath, text):
+    with open(logpath, 'a', newline='') as fh:
+        fh.write(text)
+
+def test_appended_lines_only(tmp_path):
+    logpath = tmp_path / 'debug.log'
+    appendLog(logpath, debugLine(0, 'error', 'old error'))
+    tailer = DeCartLogTailer(logpath, 0)
+    assert [line for _, line in tailer.poll()] == ['2026-10-19T10:00:00.000 [error] old error']
+    assert tailer.poll() == []
+    appendLog(logpath, debugLine(1) + debugLine(2, 'error', 'new error'))
+    assert [dt for dt, _ in tailer.poll()] == [datetime(2026, 10, 19, 10, 2)]
+    assert len(tailer.errors) == 2
+
+def test_incomplete_line(tmp_path):
+    logpath = tmp_path / 'debug.log'
+    tailer = DeCartLogTailer(logpath, 0)
+    assert tailer.poll() == []          ## no log file yet
+    line = debugLine(3, 'error', 'split line')
+    appendLog(logpath, line[:20])
+    assert tailer.poll() == []
+    appendLog(logpath, line[20:])
+    assert [line for _, line in tailer.poll()] == [line.rstrip('\n')]
+
+def test_rotation(tmp_path):
+    logpath = tmp_path / 'debug.log'
+    appendLog(logpath, debugLine(0) * 50)
+    tailer = DeCartLogTailer(logpath, 0)
+    tailer.poll()
+    ## rotated: renamed away (the inode is not reused), a new shorter log is started
+    os.replace(logpath, tmp_path / 'debug.log.1')
+    appendLog(logpath, debugLine(5, 'error', 'after rotation'))
+    assert [line for _, line in tailer.poll()] == ['2026-10-19T10:05:00.000 [error] after rotation']
+
+def test_truncation(tmp_path):
+    logpath = tmp_path / 'debug.log'
+    appendLog(logpath, debugLine(0) * 50)
+    tailer = DeCartLogTailer(logpath, 0)
+    tailer.poll()
+    with open(logpath, 'w', newline='') as fh:
+        fh.write(debugLine(6, 'error', 'after truncation'))
+    assert [line for _, line in tailer.poll()] == ['2026-10-19T10:06:00.000 [error] after truncation']
+
+def test_backlog_skips_partial_first_line(tmp_path):
+    logpath = tmp_path / 'decart.log'
+    ## decart.log of DeCart 2.7.x, timestamp after 'time='
+    lines = [f'time=2026-10-19T10:{m:02d}:00+08:00 level=error msg="slide {m} failed"\n' for m in range(10)]
+    appendLog(logpath, ''.join(lines))
+    tailer = DeCartLogTailer(logpath, 5, backlog=len(lines[-1]) * 2 + 5)
+    assert [line for _, line in tailer.poll()] == [line.rstrip('\n') for line in lines[-2:]]
+
+def test_subscriber_thread(tmp_path):
+    logpath = tmp_path / 'debug.log'
+    appendLog(logpath, debugLine(0))
+    tailer = DeCartLogTailer(logpath, 0)
+    received = []
+    notified = threading.Event()
+    tailer.subscribe(lambda dt, line: (received.append(dt), notified.set()))
+    tailer.start(interval=0.05)
+    try:
+        appendLog(logpath, debugLine(7, 'error', 'subscriber'))
+        assert notified.wait(5)
+    finally:
+        tailer.stop()
+    assert received == [datetime(2026, 10, 19, 10, 7)]
+    assert tailer.errorsSince(datetime(2026, 10, 19, 10, 6)) == ['2026-10-19T10:07:00.000 [error] subscriber']
@@ -0,0 +1,60 @@
+## watchcch.jobjournal.JobJournal: slide states survive a restart of the watcher
+##
+import sqlite3
+import pytest
+from watchcch.jobjournal import JobJournal
+
+@pytest.fixture
+def dbname(tmp_path):
+    return str(tmp_path / 'watchwsi_journal.db')
+
+def test_resume_unfinished(dbname):
+    journal = JobJournal(dbname)
+    journal.transition('a.svs', 'discovered', preset='uro')
+    journal.transition('b.svs', 'discovered', preset='thy')
+    journal.transition('c.svs', 'discovered', preset='uro')
+    journal.transition('a.svs', 'copied')
+    journal.transition('a.svs', 'inferring')
+    journal.transition('b.svs', 'copied')
+    journal.transition('b.svs', 'done')
+    journal.transition('b.svs', 'archived')
+    journal.transition('c.svs', 'failed')
+    journal.close()
+    ## restarted watcher
+    journal = JobJournal(dbname)
+    unfinished = journal.unfinished()
+    assert [(job['path'], job['state'], job['preset']) for job in unfinished] == [('a.svs', 'inferring', 'uro')]
+    assert unfinished[0]['copied'] is not None
+    journal.close()
+
+def test_rediscovered_counts_attempts(dbname):
+    journal = JobJournal(dbname)
+    journal.transition('a.svs', 'discovered', preset='uro')
+    journal.transition('a.svs', 'copied')
+    journal.transition('a.svs', 'discovered')
+    job = journal.get('a.svs')
+    assert job['state'] == 'discovered' and job['attempts'] == 2 and job['preset'] == 'uro'
+    assert journal.get('b.svs') is None
+    journal.close()
+
+def test_unknown_state(dbname):
+    journal = JobJournal(dbname)
+    journal.transition('a.svs', 'copying')
+    assert journal.get('a.svs') is None
+    journal.close()
+
+def test_failed_transition_is_rolled_back(dbname):
+    ## another connection holds the write lock, the transition fails and leaves no transaction open
+    journal = JobJournal(dbname)
+    journal.dbconn.execute('PRAGMA busy_timeout=100')
+    journal.transition('a.svs', 'discovered')
+    other = sqlite3.connect(dbname, isolation_level=None)
+    other.execute('BEGIN IMMEDIATE')
+    journal.transition('a.svs', 'copied')
+    assert not journal.dbconn.in_transaction
+    other.execute('ROLLBACK')
+    other.close()
+    assert journal.get('a.svs')['state'] == 'discovered'
+    journal.transition('a.svs', 'copied')
+    assert journal.get('a.svs')['state'] == 'copied'
+    journal.close()
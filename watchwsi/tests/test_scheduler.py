@@ -0,0 +1,106 @@
+## watchcch.scheduler.SlideScheduler: preset batching, fairness, max-wait, STAT preemption and aging
+##   times are given explicitly (found/now), no slide files are needed
+##
+import pytest
+from watchcch.scheduler import SlideJob, SlideScheduler, getSlidePriority
+
+T0 = 10000.0
+
+def queueSlides(scheduler, preset, names, found=T0, priority='routine'):
+    for name in names:
+        scheduler.add(SlideJob(f'{preset}/{name}.svs', preset, found=found, priority=priority))
+
+def names(jobs):
+    return [job.path.split('/')[-1][:-4] for job in jobs]
+
+def test_duplicate_slide_is_queued_once():
+    scheduler = SlideScheduler()
+    assert scheduler.add(SlideJob('uro/a.svs', 'uro', found=T0))
+    assert not scheduler.add(SlideJob('uro/a.svs', 'uro', found=T0 + 1))
+    assert scheduler.pending() == 1
+
+def test_keep_current_preset_then_fairness():
+    scheduler = SlideScheduler(max_batch=2, max_wait=3600, max_consecutive=2)
+    queueSlides(scheduler, 'uro', [f'u{i}' for i in range(8)], found=T0)
+    queueSlides(scheduler, 'thy', ['t0'], found=T0 + 10)
+    presets = []
+    current = 'uro'
+    for i in range(4):
+        current, jobs = scheduler.nextBatch(current, now=T0 + 60 + i)
+        presets.append(current)
+        scheduler.done(jobs, now=T0 + 61 + i)
+    ## two consecutive uro batches, then the waiting thy preset gets its turn
+    assert presets == ['uro', 'uro', 'thy', 'uro']
+
+def test_overdue_preset_is_served_next():
+    scheduler = SlideScheduler(max_batch=2, max_wait=600, max_consecutive=10)
+    queueSlides(scheduler, 'uro', ['u0', 'u1', 'u2', 'u3'], found=T0 + 500)
+    queueSlides(scheduler, 'thy', ['t0'], found=T0)
+    preset, _ = scheduler.nextBatch('uro', now=T0 + 599)
+    assert preset == 'uro'
+    preset, jobs = scheduler.nextBatch('uro', now=T0 + 600)
+    assert preset == 'thy' and names(jobs) == ['t0']
+
+def test_stat_preempts_current_preset_and_fairness():
+    scheduler = SlideScheduler(max_batch=5, max_wait=3600, max_consecutive=1)
+    queueSlides(scheduler, 'uro', ['u0', 'u1'], found=T0)
+    queueSlides(scheduler, 'thy', ['t0'], found=T0 + 5)
+    queueSlides(scheduler, 'thy', ['t1'], found=T0 + 10, priority='stat')
+    preset, jobs = scheduler.nextBatch('uro', now=T0 + 20)
+    assert preset == 'thy'
+    ## STAT slide first within the preset
+    assert names(jobs) == ['t1', 't0']
+    ## a STAT slide of the running preset keeps it, even past the fairness bound
+    queueSlides(scheduler, 'thy', ['t2'], found=T0 + 30, priority='stat')
+    preset, jobs = scheduler.nextBatch('thy', now=T0 + 40)
+    assert preset == 'thy' and names(jobs) == ['t2']
+    preset, jobs = scheduler.nextBatch('thy', now=T0 + 50)
+    assert preset == 'uro'
+
+@pytest.mark.parametrize('aging, expected', [(0, ['urgent', 'routine']), (100, ['routine', 'urgent'])])
+def test_aging(aging, expected):
+    ## a routine slide waiting 3 aging periods is at level 0, ahead of a new urgent slide
+    scheduler = SlideScheduler(max_batch=5, max_wait=3600, aging=aging)
+    queueSlides(scheduler, 'uro', ['routine'], found=T0, priority='routine')
+    queueSlides(scheduler, 'uro', ['urgent'], found=T0 + 290, priority='urgent')
+    _, jobs = scheduler.nextBatch('uro', now=T0 + 300)
+    assert names(jobs) == expected
+
+def test_sjf_keeps_overdue_slides_in_front():
+    predicted = {'long': 900, 'short': 60, 'old': 1200}
+    scheduler = SlideScheduler(max_batch=5, max_wait=600, policy='sjf',
+                               predictor=lambda job: predicted[job.path.split('/')[-1][:-4]])
+    queueSlides(scheduler, 'uro', ['old'], found=T0)
+    queueSlides(scheduler, 'uro', ['long', 'short'], found=T0 + 500)
+    _, jobs = scheduler.nextBatch('uro', now=T0 + 700)
+    assert names(jobs) == ['old', 'short', 'long']
+
+def test_slide_by_slide_dispatch():
+    scheduler = SlideScheduler(max_batch=4, max_wait=3600, max_consecutive=1)
+    queueSlides(scheduler, 'uro', [f'u{i}' for i in range(6)], found=T0)
+    queueSlides(scheduler, 'thy', ['t0'], found=T0 + 1)
+    presets = [scheduler.nextBatch('uro', now=T0 + 10 + i, limit=1)[0] for i in range(5)]
+    ## one slide at a time, 'max_batch' slides count as one batch for the fairness bound
+    assert presets == ['uro', 'uro', 'uro', 'uro', 'thy']
+
+def test_latency_stats():
+    scheduler = SlideScheduler(report_every=0)
+    queueSlides(scheduler, 'uro', ['a'], found=T0, priority='stat')
+    queueSlides(scheduler, 'uro', ['b'], found=T0)
+    _, jobs = scheduler.nextBatch('uro', now=T0 + 10)
+    scheduler.done(jobs, now=T0 + 110)
+    stats = scheduler.latencyStats()
+    assert stats['stat'] == {'slides': 1, 'wait': {'p50': 10, 'p95': 10, 'max': 10},
+                             'total': {'p50': 110, 'p95': 110, 'max': 110}}
+    assert stats['routine']['slides'] == 1
+
+def test_slide_priority(tmp_path):
+    (tmp_path / 'stat').mkdir()
+    assert getSlidePriority(str(tmp_path / 'stat' / 'a.svs')) == 'stat'
+    assert getSlidePriority(str(tmp_path / 'STAT_b.svs')) == 'stat'
+    assert getSlidePriority(str(tmp_path / 'c-urgent.ndpi')) == 'urgent'
+    assert getSlidePriority(str(tmp_path / 'statistics.svs')) == 'routine'
+    (tmp_path / 'd.priority').write_text('urgent\n')
+    assert getSlidePriority(str(tmp_path / 'd.svs')) == 'urgent'
+    (tmp_path / 'e.stat').write_text('')
+    assert getSlidePriority(str(tmp_path / 'e.svs')) == 'stat'
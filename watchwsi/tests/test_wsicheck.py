@@ -0,0 +1,77 @@
+## watchcch.wsicheck tiers on small hand-made files:
+##   magic: file signature only, structure: first TIFF IFD, ZIP end of central directory, MRXS data files
+##
+import struct
+import pytest
+from watchcch.wsicheck import WSIValidator, checkMagic
+
+def writeTIFF(path, tags=(256, 257)):
+    ## little endian classic TIFF, first IFD right after the header
+    entries = b''.join(struct.pack('<HHII', tag, 4, 1, 1024) for tag in tags)
+    path.write_bytes(b'II*\x00' + struct.pack('<I', 8) + struct.pack('<H', len(tags)) + entries + b'\x00' * 4)
+    return str(path)
+
+def writeMRXS(folder, name, datafiles, slidedat_head='[GENERAL]'):
+    (folder / f'{name}.mrxs').write_bytes(b'\x00\x01 no fixed header')
+    datafolder = folder / name
+    datafolder.mkdir()
+    lines = [slidedat_head, 'SLIDE_ID = 1', '[DATAFILE]', f'FILE_COUNT = {len(datafiles)}']
+    lines += [f'FILE_{i} = {f}' for i, f in enumerate(datafiles)]
+    (datafolder / 'Slidedat.ini').write_text('\n'.join(lines) + '\n', encoding='utf-8-sig')
+    (datafolder / 'Index.dat').write_bytes(b'index')
+    return str(folder / f'{name}.mrxs')
+
+@pytest.mark.parametrize('level', ['magic', 'structure'])
+def test_valid_tiff(tmp_path, level):
+    assert WSIValidator(level).validate(writeTIFF(tmp_path / 'a.svs')) == (True, None)
+
+def test_tiff_tiers(tmp_path):
+    ## a TIFF header without image width/length passes 'magic' only
+    wsf = writeTIFF(tmp_path / 'a.svs', tags=(270,))
+    assert WSIValidator('magic').validate(wsf)[0]
+    ok, reason = WSIValidator('structure').validate(wsf)
+    assert not ok and 'width/length' in reason
+
+def test_not_a_tiff(tmp_path):
+    wsf = tmp_path / 'a.ndpi'
+    wsf.write_bytes(b'%PDF-1.4' + b'\x00' * 64)
+    assert WSIValidator('magic').validate(str(wsf)) == (False, 'not a TIFF file')
+
+def test_empty_file(tmp_path):
+    wsf = tmp_path / 'a.svs'
+    wsf.write_bytes(b'')
+    assert WSIValidator('magic').validate(str(wsf)) == (False, 'empty file')
+
+def test_incomplete_zip(tmp_path):
+    wsf = tmp_path / 'a.zip'
+    wsf.write_bytes(b'PK\x03\x04' + b'\x00' * 256)
+    assert WSIValidator('magic').validate(str(wsf))[0]
+    ok, reason = WSIValidator('structure').validate(str(wsf))
+    assert not ok and 'central directory' in reason
+
+def test_mrxs_without_bracket_header(tmp_path):
+    ## the .mrxs file itself does not start with '[', it is validated through <name>/Slidedat.ini
+    wsf = writeMRXS(tmp_path, 'a', ['Data0000.dat'])
+    (tmp_path / 'a' / 'Data0000.dat').write_bytes(b'data')
+    assert checkMagic(wsf, 'mrxs') is None
+    assert WSIValidator('structure').validate(wsf) == (True, None)
+
+def test_mrxs_missing_data_file(tmp_path):
+    wsf = writeMRXS(tmp_path, 'a', ['Data0000.dat', 'Data0001.dat'])
+    (tmp_path / 'a' / 'Data0000.dat').write_bytes(b'data')
+    assert WSIValidator('magic').validate(wsf)[0]
+    validator = WSIValidator('structure')
+    ok, reason = validator.validate(wsf)
+    assert not ok and 'Data0001.dat' in reason
+    ## the data file arrives, the cached result is not used for the changed data folder
+    (tmp_path / 'a' / 'Data0001.dat').write_bytes(b'data')
+    assert validator.validate(wsf) == (True, None)
+
+def test_mrxs_without_data_folder(tmp_path):
+    wsf = tmp_path / 'a.mrxs'
+    wsf.write_bytes(b'\x00\x01')
+    assert WSIValidator('magic').validate(str(wsf)) == (False, 'MRXS data folder does not exist')
+
+def test_mrxs_bad_slidedat(tmp_path):
+    wsf = writeMRXS(tmp_path, 'a', [], slidedat_head='not an ini file')
+    assert checkMagic(wsf, 'mrxs') == 'MRXS Slidedat.ini is not an ini file'
@@ -0,0 +1,327 @@
+'''
+benchwatch runs startMonitorFolders against local temporary folders, no drive mapping, DeCart or real slides:
+   (1) SimulatedScanner drops fake WSI files (valid TIFF header, configurable sizes) at a configurable rate,
+       written in chunks at scanner speed, into aixuro/aixthy scanner folders
+   (2) StubDeCart infers one slide at a time from the DeCart watch folder, writes done/<slide>.med/.aix
+       after base + per-GB seconds, writes DeCart debug.log lines, optionally fails slides
+   (3) report: end-to-end latency percentiles (slide written -> .aix in image storage), throughput,
+       busy/idle seconds per pipeline stage, DeCart utilization, transfer throughput
+e.g. python -m watchcch.benchwatch --slides 40 --rate 6 --policy sjf --json sjf.json
+'''
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import struct
+import argparse
+import tempfile
+import threading
+from datetime import datetime
+from loguru import logger
+from . import watchwsi
+from .copyengine import TRANSFERS
+from amatools.folderwatch import FolderSnapshot
+from .scheduler import percentile
+
+PRESETS = {'AIxURO': 'aixuro', 'AIxTHY': 'aixthy'}
+WSI_EXTENSIONS = ['svs', 'ndpi', 'mrxs', 'tif', 'zip', 'tiff']
+
+def writeFakeWSI(fname, size, chunk=4*2**20, mbps=0):
+    ## little-endian TIFF with one IFD (width/length), padded to 'size' bytes; passes wsicheck 'structure'
+    ifd = struct.pack('<H', 2) + struct.pack('<HHII', 256, 4, 1, 100000) + struct.pack('<HHII', 257, 4, 1, 80000) + struct.pack('<I', 0)
+    head = b'II*\x00' + struct.pack('<I', 8) + ifd
+    block = random.randbytes(chunk) if hasattr(random, 'randbytes') else os.urandom(chunk)
+    t0 = time.perf_counter()
+    written = 0
+    with open(fname, 'wb') as fh:
+        fh.write(head)
+        written = len(head)
+        while written < size:
+            n = min(chunk, size - written)
+            fh.write(block[:n])
+            written += n
+            if mbps:
+                ## scanner writes the slide while scanning, the watcher must wait until it is complete
+                ahead = written / (mbps * 2**20) - (time.perf_counter() - t0)
+                if ahead > 0:
+                    time.sleep(ahead)
+    return written
+
+def writeFakeMED(fname, metadata, padding=0):
+    ## asar archive with metadata.json, as read by completion.readMEDmetadata
+    body = json.dumps(metadata).encode()
+    header = json.dumps({'files': {'metadata.json': {'offset': '0', 'size': len(body)}}}).encode()
+    padded = header + b'\x00' * (-len(header) % 4)
+    with open(fname, 'wb') as fh:
+        fh.write(struct.pack('<4I', 4, 8 + len(padded), 4 + len(padded), len(header)) + padded + body)
+        fh.write(b'\x00' * padding)
+
+##---------------------------------------------------------
+## simulated scanner
+##---------------------------------------------------------
+class SimulatedScanner:
+    def __init__(self, scannerhome, slides=20, rate=6.0, size_mb=(50, 300), mbps=100, thy_ratio=0.3, stat_ratio=0.0):
+        self.scannerhome = scannerhome
+        self.slides = slides
+        self.rate = rate            ## slides per minute, exponential inter-arrival times; 0: all at once
+        self.size_mb = size_mb
+        self.mbps = mbps            ## scanner write speed, 0: as fast as possible
+        self.thy_ratio = thy_ratio
+        self.stat_ratio = stat_ratio
+        self.written = {}           ## stem -> (preset, bytes, priority, time written)
+        self.lock = threading.Lock()
+        self.thread = None
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='bench-scanner', daemon=True)
+        self.thread.start()
+    def run(self):
+        for ii in range(self.slides):
+            if self.rate and ii:
+                time.sleep(random.expovariate(self.rate / 60))
+            preset = 'AIxTHY' if random.random() < self.thy_ratio else 'AIxURO'
+            priority = 'stat' if random.random() < self.stat_ratio else 'routine'
+            stem = f"{'STAT_' if priority == 'stat' else ''}bench{ii:04d}_{preset.lower()}"
+            ext = 'ndpi' if preset == 'AIxTHY' else 'svs'
+            size = int(random.uniform(*self.size_mb) * 2**20)
+            fname = os.path.join(self.scannerhome, PRESETS[preset], f'{stem}.{ext}')
+            writeFakeWSI(fname, size, mbps=self.mbps)
+            with self.lock:
+                self.written[stem] = (preset, size, priority, time.time())
+            logger.debug(f'[scanner] {os.path.basename(fname)} written ({size/2**20:,.0f} MB)')
+    def done(self):
+        return self.thread is not None and not self.thread.is_alive()
+
+##---------------------------------------------------------
+## stub DeCart
+##---------------------------------------------------------
+class StubDeCart:
+    def __init__(self, watchfolder, logfile, infer_seconds=20.0, seconds_per_gb=30.0, switch_seconds=5.0,
+                 fail_ratio=0.0, med_mb=5, poll=0.5):
+        self.watchfolder = watchfolder
+        self.donefolder = os.path.join(watchfolder, 'done')
+        self.logfile = logfile
+        self.infer_seconds = infer_seconds
+        self.seconds_per_gb = seconds_per_gb
+        self.switch_seconds = switch_seconds
+        self.fail_ratio = fail_ratio
+        self.med_mb = med_mb
+        self.poll = poll
+        self.preset = None
+        self.busy = 0.0
+        self.inferred = 0
+        self.failed = 0
+        self.switches = 0
+        self.stopped = threading.Event()
+        self.thread = None
+        os.makedirs(self.donefolder, exist_ok=True)
+        os.makedirs(os.path.dirname(logfile), exist_ok=True)
+    def log(self, message):
+        with open(self.logfile, 'a') as fh:
+            fh.write(f"{datetime.now().strftime('%Y-%m-%dT%H:%M:%S')} {message}\n")
+    def switchPreset(self, preset):
+        ## as updateDeCartConfig: stop DeCart, update config.yaml, restart
+        if preset != self.preset:
+            time.sleep(self.switch_seconds)
+            self.preset = preset
+            self.switches += 1
+            self.log(f'info preset {preset}')
+        return True
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='bench-decart', daemon=True)
+        self.thread.start()
+    def stop(self):
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+    def run(self):
+        while not self.stopped.is_set():
+            slides = FolderSnapshot(self.watchfolder, WSI_EXTENSIONS).files
+            if len(slides) == 0:
+                self.stopped.wait(self.poll)
+                continue
+            ## one slide at a time, in the order the slides were copied
+            wsi = min(slides, key=lambda path: slides[path][1])
+            self.infer(wsi, slides[wsi][0])
+    def infer(self, wsi, size):
+        fname = os.path.basename(wsi)
+        stem = os.path.splitext(fname)[0]
+        t0 = time.perf_counter()
+        self.log(f'info convert {fname}')
+        time.sleep(self.infer_seconds + self.seconds_per_gb * size / 2**30)
+        if random.random() < self.fail_ratio:
+            self.log(f'error failed to process {fname}')
+            self.failed += 1
+        else:
+            writeFakeMED(os.path.join(self.donefolder, f'{stem}.med'),
+                         {'SizeZ': 1 if self.preset == 'AIxTHY' else 7, 'Width': 100000, 'Height': 80000},
+                         padding=int(self.med_mb * 2**20))
+            with open(os.path.join(self.donefolder, f'{stem}.aix'), 'wb') as fh:
+                fh.write(os.urandom(64 * 1024))
+            self.log(f'info processed {fname}')
+            self.inferred += 1
+        try:
+            os.remove(wsi)
+        except OSError as e:
+            logger.warning(f'[decart] can not remove {fname}: {e}')
+        self.busy += time.perf_counter() - t0
+
+##---------------------------------------------------------
+## benchmark
+##---------------------------------------------------------
+def createBenchConfig(workdir, overrides=None):
+    ## config-watchwsi.json with every folder under workdir, drives are plain folders (no mapping)
+    folders = {name: os.path.join(workdir, name) for name in ['scanner', 'storage', 'qcapi', 'decartwatch', 'decart']}
+    for folder in folders.values():
+        os.makedirs(folder, exist_ok=True)
+    for sub in PRESETS.values():
+        os.makedirs(os.path.join(folders['scanner'], sub), exist_ok=True)
+    decartyaml = os.path.join(folders['decart'], 'config.yaml')
+    with open(decartyaml, 'w') as fh:
+        fh.write(f"preset: aixuro\nwatch: {folders['decartwatch']}\n")
+    args = {'driveX': workdir, 'driveY': workdir, 'homeX': workdir, 'homeY': workdir,
+            'userX': '', 'passX': '', 'userY': '', 'passY': '',
+            'driveXhome': folders['scanner'], 'driveYhome': folders['storage'], 'home_qcapi': folders['qcapi'],
+            'decartpath': folders['decart'], 'decart_ver': 'bench', 'decart_exe': '', 'decartyaml': decartyaml,
+            'watch_settle_seconds': 2, 'watch_poll_seconds': 1, 'watch_idle_seconds': 2}
+    args.update(overrides if overrides else {})
+    configfile = os.path.join(workdir, 'config-watchwsi.json')
+    with open(configfile, 'w') as fh:
+        json.dump(args, fh, indent=2)
+    return configfile, args
+
+def collectResults(scanner, storage, failedfolder, results):
+    ## slide is done when its .aix is in image storage, or the slide was moved to failedWSI
+    arrived = {}
+    for sub in PRESETS.values():
+        for folder, extensions, state in [(os.path.join(storage, sub), ['aix'], 'ok'),
+                                          (os.path.join(failedfolder, sub, 'failedWSI'), WSI_EXTENSIONS, 'failed')]:
+            if os.path.isdir(folder):
+                arrived.update({os.path.splitext(os.path.basename(p))[0]: state for p in FolderSnapshot(folder, extensions).files})
+    now = time.time()
+    with scanner.lock:
+        written = dict(scanner.written)
+    for stem, state in arrived.items():
+        if stem in written and stem not in results:
+            results[stem] = (state, now - written[stem][3])
+
+def runBenchmark(opts):
+    random.seed(opts.seed)
+    workdir = opts.workdir if opts.workdir else tempfile.mkdtemp(prefix='benchwatch-')
+    os.makedirs(workdir, exist_ok=True)
+    ## LOCALAPPDATA: watchwsi log, DeCart debug.log and inference history stay in workdir
+    os.environ['LOCALAPPDATA'] = os.path.join(workdir, 'localappdata')
+    watchwsi.INFERENCE_HISTORY = os.path.join(workdir, 'localappdata', 'ama_qcapi', 'inference_history.json')
+    overrides = {'pipeline_depth': opts.depth, 'batch_policy': opts.policy}
+    if opts.config:
+        with open(opts.config, 'r') as fh:
+            overrides.update(json.load(fh))
+    configfile, args = createBenchConfig(workdir, overrides)
+    decart = StubDeCart(os.path.join(workdir, 'decartwatch'), os.path.join(workdir, 'localappdata', 'decart', 'debug.log'),
+                        infer_seconds=opts.infer_seconds, seconds_per_gb=opts.infer_seconds_per_gb,
+                        switch_seconds=opts.switch_seconds, fail_ratio=opts.fail_ratio)
+    scanner = SimulatedScanner(args['driveXhome'], slides=opts.slides, rate=opts.rate, size_mb=(opts.min_mb, opts.max_mb),
+                               mbps=opts.scanner_mbps, thy_ratio=opts.thy_ratio, stat_ratio=opts.stat_ratio)
+    stop = threading.Event()
+    stats = {}
+    def watch():
+        stats.update(watchwsi.startMonitorFolders(configfile, 'benchwatch.log', switchPreset=decart.switchPreset, stop=stop) or {})
+    watcher = threading.Thread(target=watch, name='bench-watcher', daemon=True)
+    t0 = time.time()
+    decart.start()
+    watcher.start()
+    scanner.start()
+    results = {}
+    while time.time() - t0 < opts.timeout:
+        time.sleep(1)
+        collectResults(scanner, args['driveYhome'], os.path.join(workdir, 'qcapi', 'wsifile'), results)
+        if scanner.done() and len(results) >= len(scanner.written):
+            break
+        if not watcher.is_alive():
+            logger.error('startMonitorFolders stopped before all slides were processed')
+            break
+    elapsed = time.time() - t0
+    stop.set()
+    watcher.join(max(args['watch_idle_seconds'] * 5, 30))
+    decart.stop()
+    report = summarizeBenchmark(scanner, decart, results, stats, elapsed, opts)
+    if not opts.keep and not opts.workdir:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return report
+
+def summarizeBenchmark(scanner, decart, results, stats, elapsed, opts):
+    latency = [seconds for state, seconds in results.values() if state == 'ok']
+    totalbytes = sum(scanner.written[stem][1] for stem, (state, _) in results.items() if state == 'ok')
+    report = {'slides': len(scanner.written), 'completed': len(latency),
+              'failed': sum(1 for state, _ in results.values() if state == 'failed'),
+              'elapsed_seconds': elapsed, 'slides_per_hour': len(latency) / elapsed * 3600 if elapsed else 0,
+              'mb_per_second': totalbytes / 2**20 / elapsed if elapsed else 0,
+              'latency': {f'p{q}': percentile(latency, q/100) for q in [50, 90, 95]} if latency else {},
+              'latency_by_priority': {},
+              'stages': stats.get('stages', {}), 'scheduler': stats.get('latency', {}),
+              'decart': {'busy_seconds': decart.busy, 'utilization': decart.busy / elapsed if elapsed else 0,
+                         'inferred': decart.inferred, 'failed': decart.failed, 'preset_switches': decart.switches},
+              'transfers': TRANSFERS.throughput(),
+              'options': vars(opts)}
+    if latency:
+        report['latency']['max'] = max(latency)
+    for priority in ['stat', 'routine']:
+        values = [seconds for stem, (state, seconds) in results.items() if state == 'ok' and scanner.written[stem][2] == priority]
+        if values:
+            report['latency_by_priority'][priority] = {'slides': len(values), 'p50': percentile(values, 0.5), 'p95': percentile(values, 0.95)}
+    return report
+
+def printBenchmark(report):
+    print('-'*80)
+    print(f"slides {report['completed']}/{report['slides']} completed, {report['failed']} failed in {report['elapsed_seconds']:,.1f} seconds")
+    print(f"throughput {report['slides_per_hour']:,.1f} slides/hour, {report['mb_per_second']:,.1f} MB/s")
+    if report['latency']:
+        print('end-to-end latency (seconds) ' + ', '.join(f'{k} {v:,.1f}' for k, v in report['latency'].items()))
+    for priority, stat in report['latency_by_priority'].items():
+        print(f"  {priority:<8} {stat['slides']:>4} slides, p50 {stat['p50']:,.1f}, p95 {stat['p95']:,.1f}")
+    if report['stages']:
+        print(f"{'stage':<10}{'slides':>8}{'busy(s)':>10}{'idle(s)':>10}{'idle %':>8}")
+        for stage, stat in report['stages'].items():
+            total = stat['busy'] + stat['idle']
+            print(f"{stage:<10}{stat['slides']:>8}{stat['busy']:>10,.1f}{stat['idle']:>10,.1f}{100*stat['idle']/total if total else 0:>8,.1f}")
+    d = report['decart']
+    print(f"DeCart busy {d['busy_seconds']:,.1f} seconds ({100*d['utilization']:,.1f}%), {d['preset_switches']} preset switches")
+    for traffic, stat in report['transfers'].items():
+        print(f"transfer {traffic}: {stat['files']} files, {stat['bytes']/2**20:,.0f} MB, throttled {stat['throttled_seconds']:,.1f} seconds")
+    print('-'*80)
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark watchwsi with a simulated scanner and a stub DeCart')
+    parser.add_argument('-n', '--slides', type=int, default=20, help='number of slides the scanner writes')
+    parser.add_argument('-r', '--rate', type=float, default=6.0, help='slides per minute, 0: all at once')
+    parser.add_argument('--min-mb', type=float, default=50)
+    parser.add_argument('--max-mb', type=float, default=300)
+    parser.add_argument('--scanner-mbps', type=float, default=100, help='scanner write speed, 0: unlimited')
+    parser.add_argument('--thy-ratio', type=float, default=0.3, help='fraction of AIxTHY slides')
+    parser.add_argument('--stat-ratio', type=float, default=0.0, help='fraction of STAT slides')
+    parser.add_argument('--infer-seconds', type=float, default=20.0, help='stub DeCart seconds per slide')
+    parser.add_argument('--infer-seconds-per-gb', type=float, default=30.0, help='stub DeCart seconds per GB')
+    parser.add_argument('--switch-seconds', type=float, default=5.0, help='seconds to switch DeCart preset')
+    parser.add_argument('--fail-ratio', type=float, default=0.0, help='fraction of slides DeCart fails')
+    parser.add_argument('--policy', default='fifo', choices=['fifo', 'sjf'])
+    parser.add_argument('--depth', type=int, default=2, help='pipeline depth, 0: batch by batch')
+    parser.add_argument('-c', '--config', default=None, help='JSON with watchwsi settings to override')
+    parser.add_argument('-w', '--workdir', default=None, help='working folder (kept), default: temporary folder')
+    parser.add_argument('--keep', action='store_true', help='keep the temporary folder')
+    parser.add_argument('--timeout', type=float, default=3600)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', default=None, help='save the report to this JSON file')
+    parser.add_argument('-v', '--verbose', action='store_true')
+    opts = parser.parse_args()
+    logger.remove()
+    logger.add(sys.stderr, level='DEBUG' if opts.verbose else 'WARNING')
+    report = runBenchmark(opts)
+    printBenchmark(report)
+    if opts.json:
+        with open(opts.json, 'w') as fh:
+            json.dump(report, fh, indent=2, default=str)
+        print(f'[INFO] report saved to {opts.json}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,133 @@
+'''
+completion detects DeCart model inference completion of a slide by events instead of 120-second polling:
+   (1) done folder changes (watchdog observer if installed, otherwise short polling)
+   (2) DeCart log errors pushed by decartlog.DeCartLogTailer, which tails the log in its own thread
+   (3) .med/.aix must be completely written (size stable, readable) before a slide is done
+per-slide timeout is predicted by inferencemodel.InferenceModel from past runs
+'''
+import os
+import json
+import time
+import struct
+import threading
+from datetime import datetime
+from loguru import logger
+from .decartlog import getDeCartLogTailer
+from .inferencemodel import getInferenceModel, slideFileSize, DEFAULT_MINUTES_PER_WSI
+try:
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+    HAS_WATCHDOG = True
+except ImportError:
+    HAS_WATCHDOG = False
+    FileSystemEventHandler = object
+
+def readMEDmetadata(medfile):
+    ## .med is an asar archive, read metadata.json only
+    try:
+        with open(medfile, 'rb') as fmed:
+            _, header_size, _, json_len = struct.unpack('<4I', fmed.read(16))
+            header = json.loads(fmed.read(json_len))
+            entry = header['files']['metadata.json']
+            fmed.seek(8 + header_size + int(entry['offset']))
+            return json.loads(fmed.read(entry['size']))
+    except Exception as e:
+        logger.debug(f'can not read metadata.json from {os.path.basename(medfile)}: {e}')
+        return None
+
+class _WakeUpHandler(FileSystemEventHandler):
+    def __init__(self, wakeup):
+        self.wakeup = wakeup
+    def on_any_event(self, event):
+        self.wakeup.set()
+
+class CompletionWatcher:
+    def __init__(self, watchfolder, model2025, history=None, poll_interval=5, settle=2, decart_version=None):
+        self.donefolder = os.path.join(watchfolder, 'done')
+        self.history = history      ## inferencemodel.InferenceModel
+        self.decart_version = decart_version
+        self.poll_interval = poll_interval
+        self.settle = settle
+        self.wakeup = threading.Event()
+        self.lastdone = None        ## DeCart infers one slide at a time, the next one starts after this
+        self.tailer = getDeCartLogTailer(model2025)
+        self.tailer.subscribe(lambda dt, line: self.wakeup.set())
+        self.tailer.start()
+        self.observer = None
+        if HAS_WATCHDOG and os.path.isdir(self.donefolder):
+            try:
+                self.observer = Observer()
+                self.observer.schedule(_WakeUpHandler(self.wakeup), self.donefolder, recursive=False)
+                self.observer.daemon = True
+                self.observer.start()
+            except Exception as e:
+                logger.warning(f'file system events unavailable for {self.donefolder} ({e}), polling every {poll_interval} seconds')
+                self.observer = None
+    def outputsReady(self, stem):
+        ## both .med and .aix exist, size unchanged for 'settle' seconds and readable
+        outputs = [os.path.join(self.donefolder, f'{stem}.{ext}') for ext in ['med', 'aix']]
+        if not all(os.path.isfile(f) for f in outputs):
+            return False
+        sizes = [os.path.getsize(f) for f in outputs]
+        time.sleep(self.settle)
+        if sizes != [os.path.getsize(f) for f in outputs] or 0 in sizes:
+            return False
+        try:
+            for f in outputs:
+                with open(f, 'rb') as fh:
+                    fh.read(1)
+        except OSError:
+            return False    ## still locked by DeCart
+        return True
+    def waitForSlide(self, wsi, dt_anchor, preset=None):
+        ## returns True when inference completed, False if DeCart reported an error for this slide
+        stem = os.path.splitext(os.path.basename(wsi))[0]
+        fname = os.path.basename(wsi)
+        since = max(dt_anchor, self.lastdone) if self.lastdone else dt_anchor
+        filesize = slideFileSize(wsi) or None
+        if self.history:
+            predicted = self.history.predictSeconds(filesize=filesize, model=preset, decart=self.decart_version)
+            expected = self.history.expectedSeconds(filesize=filesize, model=preset, decart=self.decart_version)
+        else:
+            predicted = expected = DEFAULT_MINUTES_PER_WSI * 60
+        logger.trace(f'{fname}: inference expected in {predicted:,.0f} seconds, timeout {expected:,.0f} seconds')
+        extended = 0
+        while True:
+            self.wakeup.clear()
+            if self.outputsReady(stem):
+                now = datetime.now()
+                seconds = (now - since).total_seconds()
+                logger.info(f'{stem}.aix inference completed ({seconds:,.0f} seconds)')
+                if self.history:
+                    metadata = readMEDmetadata(os.path.join(self.donefolder, f'{stem}.med')) or {}
+                    pixels = metadata['Width'] * metadata['Height'] if 'Width' in metadata and 'Height' in metadata else None
+                    self.history.record(seconds, sizez=metadata.get('SizeZ'), pixels=pixels, filesize=filesize,
+                                        model=preset, decart=self.decart_version)
+                self.lastdone = now
+                return True
+            errlog = self.tailer.errorsSince(dt_anchor)
+            if any(fname in line for line in errlog):
+                for errmsg in errlog:
+                    logger.error(errmsg)
+                self.lastdone = datetime.now()
+                return False
+            waited = (datetime.now() - since).total_seconds()
+            if waited > expected:
+                if len(errlog) > 0:
+                    logger.warning(f'model inference of {fname} exceeds expected {expected:,.0f} seconds, DeCart reported errors')
+                    for errmsg in errlog:
+                        logger.error(errmsg)
+                    return False
+                extended += 1
+                expected += max(predicted, DEFAULT_MINUTES_PER_WSI * 60)
+                logger.warning(f'model inference of {fname} takes {waited:,.0f} seconds, wait until {expected:,.0f} seconds ({extended})')
+            self.wakeup.wait(self.poll_interval)
+
+_WATCHERS = {}
+
+def getCompletionWatcher(watchfolder, model2025, historyfile=None, decart_version=None):
+    key = (watchfolder, model2025)
+    if key not in _WATCHERS:
+        history = getInferenceModel(historyfile) if historyfile else None
+        _WATCHERS[key] = CompletionWatcher(watchfolder, model2025, history, decart_version=decart_version)
+    return _WATCHERS[key]
@@ -0,0 +1,444 @@
+'''
+copyengine copies a WSI file from scanner share in large chunks:
+   (1) checksum (sha256) computed while copying, destination verified before rename
+   (2) written to <dst>.part, renamed to <dst> only when complete, DeCart never sees a partial file
+   (3) <dst>.part.json journal keeps the copied offset, an interrupted copy resumes from there
+TransferManager copies/moves many files with a bounded thread pool and per-destination limits
+fanoutCopyFile reads a file once and writes it to several destinations at the same time
+Throttle limits the bandwidth of a traffic class ('scanner', 'storage') by a token bucket,
+the limit follows a time-of-day policy, e.g. slower during clinical hours
+'''
+import os
+import json
+import time
+import shutil
+import queue
+import hashlib
+import threading
+from collections import deque
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from loguru import logger
+
+COPY_CHUNK = 8 * 1024 * 1024        ## multiple of 1 MB, aligned to disk/SMB block size
+JOURNAL_EVERY = 8                   ## update journal every 8 chunks (64 MB)
+
+def readJournal(jrnfile):
+    try:
+        with open(jrnfile, 'r') as jf:
+            return json.load(jf)
+    except (OSError, ValueError):
+        return None
+
+def writeJournal(jrnfile, journal):
+    tmpjrn = f'{jrnfile}.tmp'
+    with open(tmpjrn, 'w') as jf:
+        json.dump(journal, jf)
+    os.replace(tmpjrn, jrnfile)
+
+def hashFile(fname, length=None, chunksize=COPY_CHUNK):
+    hasher = hashlib.sha256()
+    remain = length
+    with open(fname, 'rb') as fh:
+        while remain is None or remain > 0:
+            buf = fh.read(chunksize if remain is None else min(chunksize, remain))
+            if not buf:
+                break
+            hasher.update(buf)
+            if remain is not None:
+                remain -= len(buf)
+    return hasher
+
+def copyFileChunked(src, dst, chunksize=COPY_CHUNK, retries=5, verify=True, progress=None):
+    ## returns sha256 hex digest of the copied file, None if copy failed
+    tmpfile, jrnfile = f'{dst}.part', f'{dst}.part.json'
+    src_stat = os.stat(src)
+    srcinfo = {'src': src, 'size': src_stat.st_size, 'mtime': src_stat.st_mtime}
+    ## resume if journal matches this source file; the .part file may be shorter than the journal offset
+    ## (e.g. power loss), resume from the part of it which is the same as the source
+    offset = 0
+    journal = readJournal(jrnfile)
+    if journal and all(journal.get(k) == v for k, v in srcinfo.items()) and os.path.isfile(tmpfile):
+        offset = min(journal.get('offset', 0), os.path.getsize(tmpfile))
+    hasher = hashFile(tmpfile, offset) if offset else hashlib.sha256()
+    if offset and hashFile(src, offset).digest() != hasher.digest():
+        logger.warning(f'{os.path.basename(tmpfile)} does not match {os.path.basename(src)}, copy from the beginning')
+        offset, hasher = 0, hashlib.sha256()
+    elif offset:
+        logger.info(f'resume copying {os.path.basename(src)} from {offset/2**20:,.0f} MB')
+    attempt = 0
+    while True:
+        try:
+            with open(src, 'rb') as fsrc, open(tmpfile, 'r+b' if offset else 'wb') as fdst:
+                fsrc.seek(offset)
+                fdst.seek(offset)
+                fdst.truncate()
+                nchunk = 0
+                while True:
+                    buf = fsrc.read(chunksize)
+                    if not buf:
+                        break
+                    fdst.write(buf)
+                    hasher.update(buf)
+                    offset += len(buf)
+                    nchunk += 1
+                    if nchunk % JOURNAL_EVERY == 0:
+                        ## the journal offset must not be ahead of the data on disk
+                        fdst.flush()
+                        os.fsync(fdst.fileno())
+                        writeJournal(jrnfile, dict(srcinfo, offset=offset))
+                    if progress:
+                        progress(len(buf))
+                fdst.flush()
+                os.fsync(fdst.fileno())
+            break
+        except OSError as e:
+            attempt += 1
+            if attempt > retries:
+                logger.error(f'copying {os.path.basename(src)} failed after {retries} retries: {e}')
+                writeJournal(jrnfile, dict(srcinfo, offset=offset))
+                return None
+            ## e.g. SMB connection dropped, wait and continue from the last written offset
+            logger.warning(f'copying {os.path.basename(src)} interrupted at {offset/2**20:,.0f} MB ({e}), retry {attempt}/{retries}')
+            time.sleep(min(2 ** attempt, 30))
+            offset = os.path.getsize(tmpfile) if os.path.isfile(tmpfile) else 0
+            hasher = hashFile(tmpfile, offset) if offset else hashlib.sha256()
+    digest = hasher.hexdigest()
+    if offset != srcinfo['size']:
+        logger.error(f'{os.path.basename(src)} size changed while copying ({offset} != {srcinfo["size"]})')
+        return None
+    ## the hash only proves the temp file is what was read, the source must not have been rewritten meanwhile
+    src_stat = os.stat(src)
+    if src_stat.st_size != srcinfo['size'] or src_stat.st_mtime != srcinfo['mtime']:
+        logger.error(f'{os.path.basename(src)} was modified while copying, the copy is discarded')
+        os.remove(tmpfile)
+        if os.path.isfile(jrnfile):
+            os.remove(jrnfile)
+        return None
+    if verify and hashFile(tmpfile).hexdigest() != digest:
+        logger.error(f'checksum of {os.path.basename(dst)} does not match {os.path.basename(src)}')
+        os.remove(tmpfile)
+        if os.path.isfile(jrnfile):
+            os.remove(jrnfile)
+        return None
+    shutil.copymode(src, tmpfile)
+    os.replace(tmpfile, dst)
+    if os.path.isfile(jrnfile):
+        os.remove(jrnfile)
+    return digest
+
+##---------------------------------------------------------
+## read once, write to several destinations (e.g. local backup + image storage)
+##---------------------------------------------------------
+def fanoutCopyFile(src, dsts, chunksize=COPY_CHUNK, removesrc=False, progress=None):
+    ## returns sha256 hex digest if every destination was written and verified, otherwise None
+    ## the source is removed (removesrc) only after all destinations were verified
+    tmpfiles = [f'{dst}.part' for dst in dsts]
+    queues = [queue.Queue(maxsize=4) for _ in dsts]
+    errors = [None for _ in dsts]
+    def writer(ii):
+        fdst = None
+        try:
+            fdst = open(tmpfiles[ii], 'wb')
+        except OSError as e:
+            errors[ii] = e
+        while True:     ## keep consuming, a failed destination must not block the reader
+            buf = queues[ii].get()
+            if buf is None:
+                break
+            if errors[ii] is None:
+                try:
+                    fdst.write(buf)
+                except OSError as e:
+                    errors[ii] = e
+        if fdst:
+            try:
+                fdst.flush()
+                os.fsync(fdst.fileno())
+                fdst.close()
+            except OSError as e:
+                errors[ii] = errors[ii] or e
+    writers = [threading.Thread(target=writer, args=(ii,), daemon=True) for ii in range(len(dsts))]
+    for thread in writers:
+        thread.start()
+    hasher = hashlib.sha256()
+    readerror = None
+    try:
+        with open(src, 'rb') as fsrc:
+            while True:
+                buf = fsrc.read(chunksize)
+                if not buf:
+                    break
+                hasher.update(buf)
+                for q in queues:
+                    q.put(buf)
+                if progress:
+                    progress(len(buf))
+    except OSError as e:
+        readerror = e
+    for q in queues:
+        q.put(None)
+    for thread in writers:
+        thread.join()
+    digest = hasher.hexdigest()
+    allverified = readerror is None
+    if readerror:
+        logger.error(f'reading {os.path.basename(src)} failed: {readerror}')
+    for ii, dst in enumerate(dsts):
+        verified = readerror is None and errors[ii] is None and hashFile(tmpfiles[ii]).hexdigest() == digest
+        if verified:
+            shutil.copymode(src, tmpfiles[ii])
+            os.replace(tmpfiles[ii], dst)
+        else:
+            allverified = False
+            if errors[ii]:
+                logger.error(f'writing {dst} failed: {errors[ii]}')
+            elif readerror is None:
+                logger.error(f'checksum of {dst} does not match {os.path.basename(src)}')
+            if os.path.isfile(tmpfiles[ii]):
+                os.remove(tmpfiles[ii])
+    if not allverified:
+        return None
+    if removesrc:
+        os.remove(src)
+    return digest
+
+##---------------------------------------------------------
+## bandwidth throttling: token bucket, time-of-day policy
+##---------------------------------------------------------
+class TokenBucket:
+    def __init__(self, rate=0, burst=None):
+        self.lock = threading.Lock()
+        self.setRate(rate, burst)
+    def setRate(self, rate, burst=None):
+        ## rate: bytes per second, 0: unlimited
+        with self.lock:
+            self.rate = rate
+            self.burst = burst if burst else max(rate, COPY_CHUNK)
+            self.tokens = self.burst
+            self.stamp = time.monotonic()
+    def consume(self, nbytes):
+        ## blocks until nbytes may pass, returns seconds waited
+        with self.lock:
+            if not self.rate:
+                return 0.0
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+            ## tokens can go negative, the next callers wait until the debt is paid
+            self.tokens -= nbytes
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+def minuteOfDay(hhmm):
+    hh, mm = hhmm.split(':')
+    return int(hh) * 60 + int(mm)
+
+class BandwidthPolicy:
+    ## rules: [{'from': '07:30', 'to': '18:00', 'mb_per_second': 40, 'weekdays': [0, 1, 2, 3, 4]}, ...]
+    ## first matching rule wins, 'to' earlier than 'from' spans midnight, weekdays 0 is Monday (all days if omitted)
+    ## limits are MB/s (2**20 bytes), 0: unlimited; 'default' applies outside of all rules
+    def __init__(self, rules=None, default=0):
+        self.rules = rules if rules else []
+        self.default = default
+    def limitAt(self, dt=None):
+        dt = dt if dt else datetime.now()
+        minute = dt.hour * 60 + dt.minute
+        for rule in self.rules:
+            start, end = minuteOfDay(rule.get('from', '00:00')), minuteOfDay(rule.get('to', '24:00'))
+            inside = start <= minute < end if start <= end else (minute >= start or minute < end)
+            if rule.get('weekdays') is not None:
+                ## a window spanning midnight belongs to the weekday it started
+                weekday = (dt.weekday() - 1) % 7 if start > end and minute < end else dt.weekday()
+                inside = inside and weekday in rule['weekdays']
+            if inside:
+                return rule.get('mb_per_second', 0)
+        return self.default
+
+class Throttle:
+    ## bandwidth limit and throughput counters of one traffic class
+    def __init__(self, name, policy=None, recheck=60):
+        self.name = name
+        self.policy = policy if policy else BandwidthPolicy()
+        self.recheck = recheck      ## seconds between policy evaluations
+        self.bucket = TokenBucket()
+        self.lock = threading.Lock()
+        self.limit = None
+        self.checked = 0
+        self.started = time.monotonic()
+        self.counters = {'bytes': 0, 'files': 0, 'throttled_seconds': 0.0}
+        self.recent = deque()       ## (monotonic time, bytes) of the last minute
+    def setPolicy(self, policy):
+        self.policy = policy
+        self.checked = 0
+    def applyPolicy(self, now):
+        if now - self.checked < self.recheck:
+            return
+        self.checked = now
+        limit = self.policy.limitAt()
+        if limit != self.limit:
+            logger.info(f"{self.name} transfer bandwidth {'unlimited' if not limit else f'{limit:,} MB/s'}")
+            self.limit = limit
+            self.bucket.setRate(int(limit * 2**20))
+    def consume(self, nbytes):
+        now = time.monotonic()
+        with self.lock:
+            self.applyPolicy(now)
+        waited = self.bucket.consume(nbytes)
+        with self.lock:
+            self.counters['bytes'] += nbytes
+            self.counters['throttled_seconds'] += waited
+            self.recent.append((now + waited, nbytes))
+            while self.recent and self.recent[0][0] < now - 60:
+                self.recent.popleft()
+    def fileDone(self):
+        with self.lock:
+            self.counters['files'] += 1
+    def stats(self):
+        with self.lock:
+            now = time.monotonic()
+            recent = sum(n for t, n in self.recent if t >= now - 60)
+            elapsed = max(now - self.started, 1e-6)
+            return dict(self.counters, limit_mb_per_second=self.limit or 0,
+                        mb_per_second=self.counters['bytes'] / 2**20 / elapsed,
+                        recent_mb_per_second=recent / 2**20 / min(elapsed, 60))
+
+##---------------------------------------------------------
+## parallel transfer of many files (mrxs .dat files, batch of WSI, .med/.aix backup)
+##---------------------------------------------------------
+def destinationKey(dst):
+    ## X:, \\server\share or the top folder, files to the same destination share a concurrency limit
+    drive, rest = os.path.splitdrive(os.path.abspath(dst))
+    if drive:
+        return drive.lower()
+    parts = [p for p in rest.split(os.sep) if p]
+    return parts[0] if parts else os.sep
+
+class TransferManager:
+    def __init__(self, max_workers=8, per_destination=4, report_every=30):
+        self.lock = threading.Lock()
+        self.report_every = report_every
+        self.throttles = {}     ## traffic class -> Throttle
+        self.setLimits(max_workers, per_destination)
+    def setLimits(self, max_workers, per_destination):
+        if getattr(self, 'executor', None):
+            self.executor.shutdown(wait=False)
+        self.max_workers = max_workers
+        self.per_destination = per_destination
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='transfer')
+        self.slots = {}
+    def setBandwidth(self, traffic, rules=None, default=0):
+        ## e.g. setBandwidth('storage', [{'from': '07:30', 'to': '18:00', 'mb_per_second': 40}])
+        self.throttle(traffic).setPolicy(BandwidthPolicy(rules, default))
+    def throttle(self, traffic):
+        with self.lock:
+            if traffic not in self.throttles:
+                self.throttles[traffic] = Throttle(traffic)
+            return self.throttles[traffic]
+    def throughput(self):
+        ## {traffic class: {'bytes', 'files', 'throttled_seconds', 'limit_mb_per_second', 'mb_per_second', 'recent_mb_per_second'}}
+        return {traffic: throttle.stats() for traffic, throttle in list(self.throttles.items())}
+    def reportThroughput(self):
+        for traffic, stat in self.throughput().items():
+            logger.info(f"[transfer] {traffic}: {stat['files']:,} files, {stat['bytes']/2**30:,.1f} GB, "
+                        f"{stat['mb_per_second']:,.1f} MB/s average, {stat['recent_mb_per_second']:,.1f} MB/s last minute, "
+                        f"throttled {stat['throttled_seconds']:,.0f} seconds")
+    def destinationSlot(self, dst):
+        key = destinationKey(dst)
+        with self.lock:
+            if key not in self.slots:
+                self.slots[key] = threading.BoundedSemaphore(self.per_destination)
+            return self.slots[key]
+    def transferFiles(self, pairs, action='copy', traffic=None):
+        ## pairs: [(src, dst)], returns {src: True/False}; do not call from a transfer thread
+        ## traffic: bandwidth class of these transfers, e.g. 'scanner', None: unlimited
+        throttle = self.throttle(traffic) if traffic else None
+        total = sum(os.path.getsize(src) for src, _ in pairs if os.path.isfile(src))
+        done = {'bytes': 0, 'files': 0}
+        t0 = time.perf_counter()
+        lastreport = [t0]
+        def progress(nbytes, throttled=True):
+            if throttle and throttled:
+                throttle.consume(nbytes)
+            with self.lock:
+                done['bytes'] += nbytes
+                now = time.perf_counter()
+                if now - lastreport[0] >= self.report_every:
+                    lastreport[0] = now
+                    logger.info(f"{action} {done['bytes']/2**20:,.0f} of {total/2**20:,.0f} MB, "
+                                f"{done['files']}/{len(pairs)} files, {done['bytes']/2**20/(now-t0):,.1f} MB/s")
+        def transferOne(src, dst):
+            with self.destinationSlot(dst):
+                if action == 'move':
+                    size = os.path.getsize(src)
+                    ## a move within the same volume is a rename, no bandwidth used
+                    samevolume = os.stat(src).st_dev == os.stat(os.path.dirname(os.path.abspath(dst))).st_dev
+                    shutil.move(src, dst)
+                    progress(size, throttled=not samevolume)
+                    ok = True
+                else:
+                    ok = copyFileChunked(src, dst, progress=progress) is not None
+            with self.lock:
+                done['files'] += 1
+            if throttle and ok:
+                throttle.fileDone()
+            return ok
+        results = {}
+        futures = {self.executor.submit(transferOne, src, dst): src for src, dst in pairs}
+        for future in as_completed(futures):
+            src = futures[future]
+            try:
+                results[src] = future.result()
+            except Exception as e:
+                logger.error(f'{action} {os.path.basename(src)} failed: {e}')
+                results[src] = False
+        elapsed = time.perf_counter() - t0
+        if len(pairs):
+            logger.trace(f"{action} {sum(results.values())}/{len(pairs)} files, {total/2**20:,.0f} MB in {elapsed:,.1f} seconds "
+                         f"({total/2**20/max(elapsed, 1e-6):,.1f} MB/s)")
+        return results
+    def fanoutFiles(self, items, removesrc=False, traffic=None):
+        ## items: [(src, [dst1, dst2, ...])], returns {src: True/False}
+        throttle = self.throttle(traffic) if traffic else None
+        def fanoutOne(src, dsts):
+            ## take destination slots in a fixed order, no deadlock between files
+            slots = sorted({destinationKey(dst): self.destinationSlot(dst) for dst in dsts}.items())
+            for _, slot in slots:
+                slot.acquire()
+            try:
+                ok = fanoutCopyFile(src, dsts, removesrc=removesrc, progress=throttle.consume if throttle else None) is not None
+                if throttle and ok:
+                    throttle.fileDone()
+                return ok
+            finally:
+                for _, slot in reversed(slots):
+                    slot.release()
+        t0 = time.perf_counter()
+        results = {}
+        futures = {self.executor.submit(fanoutOne, src, dsts): src for src, dsts in items}
+        for future in as_completed(futures):
+            src = futures[future]
+            try:
+                results[src] = future.result()
+            except Exception as e:
+                logger.error(f'fan-out {os.path.basename(src)} failed: {e}')
+                results[src] = False
+        if len(items):
+            logger.trace(f'fan-out {sum(results.values())}/{len(items)} files in {time.perf_counter()-t0:,.1f} seconds')
+        return results
+    def copyFiles(self, pairs, traffic=None):
+        return self.transferFiles(pairs, 'copy', traffic)
+    def moveFiles(self, pairs, traffic=None):
+        return self.transferFiles(pairs, 'move', traffic)
+    def copyTree(self, srcdir, dstdir, traffic=None):
+        pairs = []
+        for root, _, files in os.walk(srcdir):
+            thisdst = os.path.join(dstdir, os.path.relpath(root, srcdir))
+            os.makedirs(thisdst, exist_ok=True)
+            pairs += [(os.path.join(root, f), os.path.join(thisdst, f)) for f in files]
+        results = self.copyFiles(pairs, traffic)
+        return all(results.values())
+
+TRANSFERS = TransferManager()
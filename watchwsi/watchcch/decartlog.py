@@ -0,0 +1,122 @@
+'''
+decartlog tails DeCart log (decart.log of 2.7.x service, debug.log of 2.8.x) incrementally:
+   (1) remembers byte offset and inode, only appended lines are read and parsed
+   (2) log rotation (new inode) or truncation (size < offset) restarts from the beginning
+   (3) error lines are kept with their timestamps and pushed to subscribers
+   (4) start() tails the log in its own thread, subscribers are notified within 'interval' seconds
+       while the caller is blocked, e.g. CompletionWatcher.waitForSlide()
+'''
+import os
+import threading
+from pathlib import Path
+from datetime import datetime
+from loguru import logger
+
+TIME_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+def getDeCartLogPath(model2025):
+    if model2025:
+        return Path(os.getenv('LOCALAPPDATA', '')) / 'decart' / 'debug.log', 0
+    return Path(r'c:\ProgramData') / 'decart' / 'decart.log', 5
+
+class DeCartLogTailer:
+    def __init__(self, logpath, tspos, backlog=8*1024*1024, keep=1000):
+        self.logpath = Path(logpath)
+        self.tspos = tspos          ## 5 for decart.log ('time=2025-...'), 0 for debug.log
+        self.backlog = backlog      ## first read starts at most 'backlog' bytes before the end
+        self.keep = keep
+        self.offset = None
+        self.inode = None
+        self.partial = b''
+        self.errors = []            ## [(datetime, line)]
+        self.subscribers = []
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+    def subscribe(self, callback):
+        ## callback(dt, line) is called for every new error line, from the tailing thread after start()
+        with self.lock:
+            self.subscribers.append(callback)
+    def start(self, interval=2.0):
+        ## only one os.stat() per interval while nothing is appended
+        if self.thread and self.thread.is_alive():
+            return
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.run, args=(interval,), name='decart-log', daemon=True)
+        self.thread.start()
+    def run(self, interval):
+        while not self.stopped.wait(interval):
+            try:
+                self.poll()
+            except Exception as e:
+                logger.warning(f'tailing {self.logpath.name} failed: {e}')
+    def stop(self):
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+    def parseLine(self, line):
+        ## cheap checks first, strptime only for error lines
+        if 'error' not in line:
+            return None
+        if self.tspos == 5 and line[0:4] != 'time':
+            return None
+        if self.tspos == 0 and line[0:2] != '20':
+            return None
+        try:
+            return datetime.strptime(line[self.tspos:self.tspos+19], TIME_FORMAT)
+        except ValueError:
+            return None
+    def poll(self):
+        ## read appended lines, returns new error lines [(datetime, line)]
+        with self.lock:
+            try:
+                st = os.stat(self.logpath)
+            except OSError:
+                return []
+            if self.offset is None:
+                self.offset = max(st.st_size - self.backlog, 0)
+                self.inode = st.st_ino
+                self.partial = b''
+                skipfirst = self.offset > 0
+            elif st.st_ino != self.inode or st.st_size < self.offset:
+                logger.debug(f'{self.logpath.name} was rotated or truncated, read from the beginning')
+                self.offset, self.inode, self.partial = 0, st.st_ino, b''
+                skipfirst = False
+            else:
+                skipfirst = False
+            if st.st_size == self.offset:
+                return []
+            with open(self.logpath, 'rb') as flog:
+                flog.seek(self.offset)
+                data = flog.read(st.st_size - self.offset)
+            self.offset += len(data)
+            lines = (self.partial + data).split(b'\n')
+            self.partial = lines.pop()      ## last line may be incomplete
+            if skipfirst and len(lines):
+                lines.pop(0)
+            newerrors = []
+            for raw in lines:
+                line = raw.decode('utf-8', errors='replace').rstrip('\r')
+                dt = self.parseLine(line)
+                if dt:
+                    newerrors.append((dt, line))
+            if newerrors:
+                self.errors = (self.errors + newerrors)[-self.keep:]
+            subscribers = list(self.subscribers)
+        for dt, line in newerrors:
+            for callback in subscribers:
+                callback(dt, line)
+        return newerrors
+    def errorsSince(self, anchor_dt):
+        self.poll()
+        return [line for dt, line in self.errors if dt > anchor_dt]
+
+_TAILERS = {}
+
+def getDeCartLogTailer(model2025):
+    logpath, tspos = getDeCartLogPath(model2025)
+    key = str(logpath)
+    if key not in _TAILERS:
+        _TAILERS[key] = DeCartLogTailer(logpath, tspos)
+    return _TAILERS[key]
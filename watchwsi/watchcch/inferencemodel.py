@@ -0,0 +1,137 @@
+'''
+inferencemodel learns the expected DeCart inference duration of a slide from past runs:
+   (1) least squares per model preset and DeCart version: seconds ~ a + b * GB + c * SizeZ * gigapixels
+   (2) before inference only the file size is known, the model falls back to seconds ~ a + b * GB
+   (3) the timeout is the prediction scaled by the 95% quantile of actual/predicted ratios
+used by completion.CompletionWatcher (per-slide timeout) and scheduler.SlideScheduler (shortest job first)
+'''
+import os
+import json
+import threading
+from loguru import logger
+
+DEFAULT_MINUTES_PER_WSI = 10    ## roughly, 10 minutes for a 7-layer WSI file; more than 30 minutes for a 21-layer WSI
+
+def quantile(values, q):
+    values = sorted(values)
+    return values[min(int(q * len(values)), len(values)-1)]
+
+def slideFileSize(wsi):
+    ## .mrxs: slide file plus its data folder
+    size = os.path.getsize(wsi) if os.path.isfile(wsi) else 0
+    stem, ext = os.path.splitext(wsi)
+    if ext.lower() == '.mrxs' and os.path.isdir(stem):
+        size += sum(entry.stat().st_size for entry in os.scandir(stem) if entry.is_file())
+    return size
+
+def solveLinear(A, b):
+    ## Gaussian elimination with partial pivoting, A is a small square matrix
+    n = len(b)
+    M = [list(A[i]) + [b[i]] for i in range(n)]
+    for col in range(n):
+        pivot = max(range(col, n), key=lambda r: abs(M[r][col]))
+        if abs(M[pivot][col]) < 1e-12:
+            return None
+        M[col], M[pivot] = M[pivot], M[col]
+        for r in range(col+1, n):
+            f = M[r][col] / M[col][col]
+            for c in range(col, n+1):
+                M[r][c] -= f * M[col][c]
+    x = [0.0] * n
+    for r in range(n-1, -1, -1):
+        x[r] = (M[r][n] - sum(M[r][c] * x[c] for c in range(r+1, n))) / M[r][r]
+    return x
+
+def fitLeastSquares(X, y, ridge=1e-6):
+    n = len(X[0])
+    A = [[sum(row[i] * row[j] for row in X) + (ridge if i == j else 0.0) for j in range(n)] for i in range(n)]
+    b = [sum(row[i] * yy for row, yy in zip(X, y)) for i in range(n)]
+    return solveLinear(A, b)
+
+class InferenceModel:
+    def __init__(self, fname, keep=500, minsamples=5):
+        self.fname = fname
+        self.keep = keep
+        self.minsamples = minsamples
+        self.lock = threading.Lock()
+        self.samples = []       ## [{'seconds', 'sizez', 'pixels', 'filesize', 'model', 'decart'}]
+        self.fitted = {}        ## (model, decart, full) -> (coef, floor, ratio95) or None, cleared on record()
+        try:
+            with open(fname, 'r') as fh:
+                self.samples = json.load(fh)['samples']
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+    def record(self, seconds, sizez=None, pixels=None, filesize=None, model=None, decart=None):
+        with self.lock:
+            self.samples.append({'seconds': round(seconds, 1), 'sizez': sizez, 'pixels': pixels,
+                                 'filesize': filesize, 'model': model, 'decart': decart})
+            del self.samples[:-self.keep]
+            ## len(self.samples) stays at 'keep' once the history is full, invalidate every fitted model
+            self.fitted.clear()
+            try:
+                tmpfile = f'{self.fname}.tmp'
+                with open(tmpfile, 'w') as fh:
+                    json.dump({'samples': self.samples}, fh)
+                os.replace(tmpfile, self.fname)
+            except OSError as e:
+                logger.warning(f'can not save inference history {self.fname}: {e}')
+    def features(self, sample, full):
+        gb = (sample.get('filesize') or 0) / 2**30
+        if full:
+            return [1.0, gb, (sample.get('sizez') or 1) * (sample.get('pixels') or 0) / 1e9]
+        return [1.0, gb]
+    def group(self, model, decart, full):
+        ## most specific group with enough samples: model+version, model, all
+        usable = [s for s in self.samples if s.get('filesize') and (not full or (s.get('sizez') and s.get('pixels')))]
+        for cond in [lambda s: s.get('model') == model and s.get('decart') == decart,
+                     lambda s: s.get('model') == model,
+                     lambda s: True]:
+            group = [s for s in usable if cond(s)]
+            if len(group) >= self.minsamples:
+                return group
+        return []
+    def fit(self, model, decart, full):
+        key = (model, decart, full)
+        if key in self.fitted:
+            return self.fitted[key]
+        self.fitted[key] = None
+        group = self.group(model, decart, full)
+        if len(group) == 0:
+            return None
+        coef = fitLeastSquares([self.features(s, full) for s in group], [s['seconds'] for s in group])
+        if coef is None:
+            return None
+        floor = min(s['seconds'] for s in group)
+        predict = lambda s: max(sum(c * x for c, x in zip(coef, self.features(s, full))), floor)
+        ratio95 = max(quantile([s['seconds'] / predict(s) for s in group], 0.95), 1.0)
+        self.fitted[key] = (coef, floor, ratio95)
+        return self.fitted[key]
+    def estimate(self, filesize=None, sizez=None, pixels=None, model=None, decart=None):
+        ## (predicted seconds, 95% ratio), None if there is no usable history
+        if not filesize:
+            return None
+        sample = {'filesize': filesize, 'sizez': sizez, 'pixels': pixels}
+        with self.lock:
+            for full in ([True, False] if sizez and pixels else [False]):
+                fitted = self.fit(model, decart, full)
+                if fitted:
+                    coef, floor, ratio95 = fitted
+                    return max(sum(c * x for c, x in zip(coef, self.features(sample, full))), floor), ratio95
+        return None
+    def predictSeconds(self, filesize=None, sizez=None, pixels=None, model=None, decart=None):
+        ## typical duration, e.g. shortest job first
+        estimated = self.estimate(filesize, sizez, pixels, model, decart)
+        return estimated[0] if estimated else DEFAULT_MINUTES_PER_WSI * 60
+    def expectedSeconds(self, filesize=None, sizez=None, pixels=None, model=None, decart=None, margin=1.2):
+        ## upper bound of a normal run, used as timeout
+        estimated = self.estimate(filesize, sizez, pixels, model, decart)
+        if estimated:
+            return estimated[0] * estimated[1] * margin
+        return DEFAULT_MINUTES_PER_WSI * 60
+
+_MODELS = {}
+
+def getInferenceModel(fname):
+    if fname not in _MODELS:
+        _MODELS[fname] = InferenceModel(fname)
+    return _MODELS[fname]
@@ -0,0 +1,63 @@
+'''
+jobjournal keeps the state of every slide in a small sqlite3 database (write-ahead log mode),
+a restarted watcher resumes in-flight slides instead of copying and inferring them again
+   discovered -> copied -> inferring -> done -> archived
+                                             -> failed
+'''
+import os
+import time
+import sqlite3
+import threading
+from loguru import logger
+
+JOB_STATES = ['discovered', 'copied', 'inferring', 'done', 'archived', 'failed']
+JOB_FINISHED = ['archived', 'failed']
+
+class JobJournal:
+    def __init__(self, dbname):
+        self.dbname = dbname
+        self.lock = threading.Lock()
+        self.dbconn = sqlite3.connect(dbname, check_same_thread=False, isolation_level=None)
+        self.dbconn.row_factory = sqlite3.Row
+        self.dbconn.execute('PRAGMA journal_mode=WAL')
+        self.dbconn.execute('PRAGMA synchronous=NORMAL')
+        self.dbconn.execute("CREATE TABLE IF NOT EXISTS jobs ( \
+            path TEXT PRIMARY KEY, preset TEXT, state TEXT NOT NULL, \
+            discovered REAL, copied REAL, updated REAL, attempts INTEGER NOT NULL DEFAULT 0)")
+        self.dbconn.execute("CREATE TABLE IF NOT EXISTS events ( \
+            path TEXT NOT NULL, state TEXT NOT NULL, ts REAL NOT NULL, info TEXT)")
+        self.dbconn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_state ON jobs (state)")
+    def transition(self, path, state, preset=None, info=None):
+        if state not in JOB_STATES:
+            logger.error(f'unknown job state {state} of {os.path.basename(path)}')
+            return
+        now = time.time()
+        with self.lock:
+            try:
+                self.dbconn.execute('BEGIN')
+                self.dbconn.execute("INSERT INTO jobs (path, preset, state, discovered, updated) VALUES (?, ?, ?, ?, ?) \
+                    ON CONFLICT(path) DO UPDATE SET state=excluded.state, updated=excluded.updated, \
+                    preset=COALESCE(excluded.preset, jobs.preset)", (path, preset, state, now, now))
+                if state == 'discovered':
+                    self.dbconn.execute('UPDATE jobs SET attempts=attempts+1, discovered=? WHERE path=?', (now, path))
+                elif state == 'copied':
+                    self.dbconn.execute('UPDATE jobs SET copied=? WHERE path=?', (now, path))
+                self.dbconn.execute('INSERT INTO events (path, state, ts, info) VALUES (?, ?, ?, ?)', (path, state, now, info))
+                self.dbconn.execute('COMMIT')
+            except sqlite3.Error as e:
+                ## BEGIN itself may have failed, there is nothing to roll back then
+                if self.dbconn.in_transaction:
+                    self.dbconn.execute('ROLLBACK')
+                logger.error(f'job journal: {os.path.basename(path)} -> {state} failed, {e}')
+    def get(self, path):
+        with self.lock:
+            row = self.dbconn.execute('SELECT * FROM jobs WHERE path=?', (path,)).fetchone()
+        return dict(row) if row else None
+    def unfinished(self):
+        with self.lock:
+            rows = self.dbconn.execute(f"SELECT * FROM jobs WHERE state NOT IN ({', '.join('?' * len(JOB_FINISHED))}) \
+                ORDER BY discovered", JOB_FINISHED).fetchall()
+        return [dict(row) for row in rows]
+    def close(self):
+        with self.lock:
+            self.dbconn.close()
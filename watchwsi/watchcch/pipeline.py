@@ -0,0 +1,97 @@
+'''
+pipeline runs the slide workflow as 4 stages, one thread each, with bounded queues in between:
+   copy-in -> inference-wait -> output harvest -> backup/move
+slide N+1 is copied to DeCart watch folder while slide N is inferred and slide N-1 is archived
+'''
+import os
+import time
+import queue
+import threading
+from datetime import timedelta
+from loguru import logger
+
+STAGES = ['copy', 'inference', 'harvest', 'archive']
+
+class SlideTask:
+    def __init__(self, path, preset, ondone=None):
+        self.path = path
+        self.preset = preset
+        self.ondone = ondone
+        self.copied = False
+        self.completed = False
+        self.dt_anchor = None
+        self.t0 = time.perf_counter()
+
+class SlidePipeline:
+    def __init__(self, copyfunc, waitfunc, harvestfunc, archivefunc, depth=2):
+        ## copyfunc(task) -> bool, waitfunc(task) -> bool, harvestfunc(task) -> bool, archivefunc(task)
+        self.funcs = {'copy': copyfunc, 'inference': waitfunc, 'harvest': harvestfunc, 'archive': archivefunc}
+        ## bounded queues: at most 'depth' slides copied ahead of DeCart
+        self.queues = {stage: queue.Queue(maxsize=depth) for stage in STAGES}
+        self.inflight = 0
+        self.tracked = set()    ## paths of submitted slides not yet archived
+        self.lock = threading.Condition()
+        self.busy = {stage: 0.0 for stage in STAGES}
+        self.count = {stage: 0 for stage in STAGES}
+        self.started = None
+        self.threads = []
+    def start(self):
+        self.started = time.perf_counter()
+        for ii, stage in enumerate(STAGES):
+            nextq = self.queues[STAGES[ii+1]] if ii+1 < len(STAGES) else None
+            thread = threading.Thread(target=self.runStage, args=(stage, nextq), name=f'pipeline-{stage}', daemon=True)
+            thread.start()
+            self.threads.append(thread)
+    def runStage(self, stage, nextq):
+        thisq = self.queues[stage]
+        while True:
+            task = thisq.get()
+            if task is None:
+                if nextq:
+                    nextq.put(None)
+                break
+            t0 = time.perf_counter()
+            try:
+                ok = self.funcs[stage](task)
+            except Exception as e:
+                logger.error(f'[pipeline] {stage} of {os.path.basename(task.path)} failed: {e}')
+                ok = False
+            self.busy[stage] += time.perf_counter() - t0
+            self.count[stage] += 1
+            ## a failed slide skips to archive stage: failed inference is moved to failedWSI,
+            ## failed copy stays in the scanner folder and is queued again
+            if nextq is None:
+                self.finish(task)
+            elif ok:
+                nextq.put(task)
+            else:
+                self.queues['archive'].put(task)
+    def finish(self, task):
+        if task.ondone:
+            task.ondone(task)
+        logger.info(f'{os.path.basename(task.path)} ({task.preset}) done in {timedelta(seconds=time.perf_counter()-task.t0)}')
+        with self.lock:
+            self.inflight -= 1
+            self.tracked.discard(task.path)
+            self.lock.notify_all()
+    def submit(self, path, preset, ondone=None):
+        ## blocks while the copy queue is full
+        with self.lock:
+            self.inflight += 1
+            self.tracked.add(path)
+        self.queues['copy'].put(SlideTask(path, preset, ondone))
+    def tracking(self):
+        with self.lock:
+            return set(self.tracked)
+    def drain(self, timeout=None):
+        ## wait until all submitted slides were archived, e.g. before switching DeCart preset
+        with self.lock:
+            return self.lock.wait_for(lambda: self.inflight == 0, timeout)
+    def stop(self):
+        self.queues['copy'].put(None)
+        for thread in self.threads:
+            thread.join()
+    def stageStats(self):
+        elapsed = time.perf_counter() - self.started if self.started else 0.0
+        return {stage: {'slides': self.count[stage], 'busy': self.busy[stage],
+                        'idle': max(elapsed - self.busy[stage], 0.0)} for stage in STAGES}
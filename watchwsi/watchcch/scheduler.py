@@ -0,0 +1,185 @@
+'''
+scheduler queues slides of both scanner folders and groups them by model preset:
+   (1) keep running the current preset while it has slides, switching DeCart preset costs minutes
+   (2) fairness: at most 'max_consecutive' batches of one preset while the other preset is waiting
+   (3) max-wait: a preset whose oldest slide waited more than 'max_wait' seconds is served next
+   (4) policy 'sjf': within a preset, slides with the shortest predicted inference time go first,
+       slides waiting longer than 'max_wait' keep their place at the front
+   (5) priority: STAT slides go first, even before the current preset and the fairness bound,
+       routine slides are aged one level up every 'aging' seconds so they still progress
+'''
+import os
+import re
+import time
+from loguru import logger
+
+PRIORITY_LEVELS = {'stat': 0, 'urgent': 1, 'routine': 2}
+
+def getSlidePriority(path, default='routine'):
+    ## (1) sidecar file: <slide>.priority containing stat/urgent/routine, or an empty <slide>.stat
+    ## (2) subfolder of the scanner folder: .../aixuro/stat/slide.svs
+    ## (3) filename token: STAT_slide.svs, slide-urgent.ndpi
+    stem = os.path.splitext(path)[0]
+    for sidecar in [f'{stem}.priority', f'{path}.priority']:
+        if os.path.isfile(sidecar):
+            try:
+                with open(sidecar, 'r') as fh:
+                    level = fh.read().strip().lower()
+                if level in PRIORITY_LEVELS:
+                    return level
+            except OSError as e:
+                logger.debug(f'can not read {sidecar}: {e}')
+    if os.path.isfile(f'{stem}.stat'):
+        return 'stat'
+    parent = os.path.basename(os.path.dirname(path)).lower()
+    if parent in PRIORITY_LEVELS:
+        return parent
+    tokens = re.split(r'[_\-\s\.]+', os.path.basename(stem).lower())
+    for level in ['stat', 'urgent']:
+        if level in tokens:
+            return level
+    return default
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(int(q * len(values)), len(values)-1)]
+
+class SlideJob:
+    def __init__(self, path, preset, found=None, priority='routine'):
+        self.path = path
+        self.preset = preset
+        self.found = found if found else time.time()
+        self.priority = priority if priority in PRIORITY_LEVELS else 'routine'
+        self.level = PRIORITY_LEVELS[self.priority]
+        self.predicted = None   ## predicted inference seconds (policy 'sjf')
+        self.dispatched = None
+    def waited(self, now=None):
+        return (now if now else time.time()) - self.found
+    def __repr__(self):
+        return f'SlideJob({os.path.basename(self.path)}, {self.preset}, {self.priority})'
+
+class SlideScheduler:
+    def __init__(self, max_batch=20, max_wait=1800, max_consecutive=3, policy='fifo', predictor=None,
+                 aging=900, report_every=50):
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.max_consecutive = max_consecutive
+        self.policy = policy if predictor else 'fifo'
+        self.predictor = predictor      ## predictor(job) -> seconds
+        self.aging = aging              ## seconds to age one priority level, 0: no aging
+        self.report_every = report_every
+        self.queue = {}         ## preset -> [SlideJob]
+        self.queued = set()     ## paths already in queue or in a running batch
+        self.last_preset = None
+        self.consecutive = 0
+        self.latency = {level: {'wait': [], 'total': []} for level in PRIORITY_LEVELS}
+        self.ndone = 0
+    def add(self, job):
+        if job.path in self.queued:
+            return False
+        self.queue.setdefault(job.preset, []).append(job)
+        self.queued.add(job.path)
+        if job.level == 0:
+            logger.info(f'STAT slide {os.path.basename(job.path)} ({job.preset}) queued')
+        return True
+    def discardMissing(self):
+        ## slides removed from scanner folder before being scheduled
+        for preset, jobs in self.queue.items():
+            missing = [job for job in jobs if os.path.exists(job.path) == False]
+            for job in missing:
+                jobs.remove(job)
+                self.queued.discard(job.path)
+                logger.debug(f'{os.path.basename(job.path)} disappeared from scanner folder, removed from queue')
+    def pending(self, preset=None):
+        if preset:
+            return len(self.queue.get(preset, []))
+        return sum(len(jobs) for jobs in self.queue.values())
+    def effectiveLevel(self, job, now):
+        if self.aging <= 0:
+            return job.level
+        return max(job.level - int(job.waited(now) // self.aging), 0)
+    def choosePreset(self, current_preset, now=None):
+        now = now if now else time.time()
+        waiting = {preset: max(job.waited(now) for job in jobs) for preset, jobs in self.queue.items() if len(jobs)}
+        if len(waiting) == 0:
+            return None
+        ## STAT slides preempt the running preset and the fairness bound
+        stat = {preset: max(job.waited(now) for job in jobs if job.level == 0)
+                for preset, jobs in self.queue.items() if any(job.level == 0 for job in jobs)}
+        if stat:
+            return current_preset if current_preset in stat else max(stat, key=stat.get)
+        others = {preset: waited for preset, waited in waiting.items() if preset != current_preset}
+        ## max-wait bound: the other preset has waited too long
+        overdue = {preset: waited for preset, waited in others.items() if waited >= self.max_wait}
+        if overdue:
+            return max(overdue, key=overdue.get)
+        if current_preset in waiting:
+            ## fairness bound: give the other preset a turn after max_consecutive batches
+            if not others or self.consecutive < self.max_consecutive:
+                return current_preset
+        return max(others, key=others.get) if others else current_preset
+    def orderQueue(self, preset, now):
+        ## priority (aged) first; then overdue slides oldest first, then shortest predicted ('sjf') or oldest
+        jobs = self.queue[preset]
+        if self.policy == 'sjf':
+            for job in jobs:
+                if job.predicted is None:
+                    try:
+                        job.predicted = self.predictor(job)
+                    except Exception as e:
+                        logger.debug(f'can not predict inference time of {os.path.basename(job.path)}: {e}')
+                        job.predicted = float('inf')
+        def sortkey(job):
+            overdue = job.waited(now) >= self.max_wait
+            order = job.predicted if self.policy == 'sjf' and not overdue else job.found
+            return (self.effectiveLevel(job, now), not overdue, order)
+        jobs.sort(key=sortkey)
+    def nextBatch(self, current_preset, now=None, limit=None):
+        ## limit: dispatch at most 'limit' slides, e.g. 1 to re-check priorities between slides
+        now = now if now else time.time()
+        preset = self.choosePreset(current_preset, now)
+        if preset is None:
+            return None, []
+        self.orderQueue(preset, now)
+        jobs = self.queue[preset][:min(self.max_batch, limit) if limit else self.max_batch]
+        del self.queue[preset][:len(jobs)]
+        ## slide-by-slide dispatch counts 'max_batch' slides as one batch for the fairness bound
+        step = 1 if limit is None else len(jobs) / self.max_batch
+        if preset == self.last_preset:
+            self.consecutive += step
+        else:
+            self.last_preset, self.consecutive = preset, step
+        for job in jobs:
+            job.dispatched = now
+            self.latency[job.priority]['wait'].append(job.waited(now))
+        logger.trace(f'next batch: {len(jobs)} {preset} slides, {self.pending()} slides still queued')
+        return preset, jobs
+    def done(self, jobs, now=None):
+        now = now if now else time.time()
+        for job in jobs:
+            self.queued.discard(job.path)
+            self.latency[job.priority]['total'].append(job.waited(now))
+            del self.latency[job.priority]['total'][:-1000]
+            del self.latency[job.priority]['wait'][:-1000]
+            if job.level == 0:
+                logger.info(f'STAT slide {os.path.basename(job.path)} done in {job.waited(now):,.0f} seconds '
+                            f'(queued {(job.dispatched or now) - job.found:,.0f} seconds)')
+            self.ndone += 1
+            if self.report_every and self.ndone % self.report_every == 0:
+                self.reportLatency()
+    def latencyStats(self):
+        ## per priority: slides, p50/p95/max seconds from found to dispatched ('wait') and to done ('total')
+        stats = {}
+        for level, samples in self.latency.items():
+            if len(samples['total']) == 0 and len(samples['wait']) == 0:
+                continue
+            stats[level] = {'slides': len(samples['total'])}
+            for name, values in samples.items():
+                if len(values):
+                    stats[level][name] = {'p50': percentile(values, 0.5), 'p95': percentile(values, 0.95), 'max': max(values)}
+        return stats
+    def reportLatency(self):
+        for level, stat in self.latencyStats().items():
+            parts = [f"{name} p50 {stat[name]['p50']:,.0f}s p95 {stat[name]['p95']:,.0f}s max {stat[name]['max']:,.0f}s"
+                     for name in ['wait', 'total'] if name in stat]
+            logger.info(f"[latency] {level}: {stat['slides']} slides, {', '.join(parts)}")
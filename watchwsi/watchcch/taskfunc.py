@@ -27,7 +27,7 @@ def stopTask(pid):
         proc.wait(timeout=3)
         logger.info(f"Process {pid} terminated.")
     except Exception as e:
-        logger.errro(f"Failed to terminate process {pid}: {e}")
+        logger.error(f"Failed to terminate process {pid}: {e}")
 
 def restartTask(command):
     try:
@@ -36,84 +36,97 @@ def restartTask(command):
     except Exception as e:
         logger.error(f"Failed to restart task: {e}")
 
-def stopDeCart(isService):
+DECART_SERVICE = 'AIxMed DeCart'
+
+def getDeCartServiceStatus(servicename=DECART_SERVICE):
+    ## 'running', 'stopped', 'start_pending', 'stop_pending', ... or None if unknown
+    if not hasattr(psutil, 'win_service_iter'):
+        return None
+    try:
+        for service in psutil.win_service_iter():
+            if servicename in (service.name(), service.display_name()):
+                return service.status()
+    except Exception as e:
+        logger.debug(f'can not query {servicename} service status: {e}')
+    return None
+
+def isDeCartReady(isService, running):
+    ## running=True: decart.exe is up (and the service reports running), running=False: everything is down
     decartPID = getRunningTaskPID('decart.exe')
-    if isService:  ## decart is running as a service (2.7.x)
-        ## NET STOP DeCart services if decart version is 2.7.x
-        while True:
+    status = getDeCartServiceStatus() if isService else None
+    if running:
+        return decartPID is not None and status in (None, 'running')
+    return decartPID is None and status in (None, 'stopped')
+
+def waitForDeCart(isService, running, timeout=60, interval=0.5):
+    ## poll process/service state, returns as soon as DeCart is up (running=True) or down (running=False)
+    t0 = time.perf_counter()
+    while True:
+        if isDeCartReady(isService, running):
+            logger.trace(f"DeCart is {'up' if running else 'down'} after {time.perf_counter()-t0:,.1f} seconds")
+            return True
+        if time.perf_counter() - t0 > timeout:
+            return False
+        time.sleep(interval)
+
+def stopDeCart(isService, timeout=60, retries=3):
+    for attempt in range(retries):
+        if isService:  ## decart is running as a service (2.7.x)
+            ## NET STOP DeCart services if decart version is 2.7.x
             try:
-                stopcmd = ["NET", "STOP", "AIxMed DeCart"]
-                stopdecart = subprocess.Popen(stopcmd, 
-                                      stdout=subprocess.PIPE,   # capture standard output
-                                      stderr=subprocess.PIPE,   # capture standard error
-                                      text=True)
-                '''
-                #stdout, stderr = stopdecart.communicate()
-                if stopdecart.returncode == 0:
-                    logger.info('DeCart service temporarily stopped')
-                else:
-                    logger.warning(f'{stopdecart.returncode}: can not STOP DeCart service??')
-                '''
+                stopcmd = ["NET", "STOP", DECART_SERVICE]
+                subprocess.Popen(stopcmd,
+                                 stdout=subprocess.PIPE,   # capture standard output
+                                 stderr=subprocess.PIPE,   # capture standard error
+                                 text=True)
             except Exception as e:
                 logger.error(f'an error occurred: {str(e)}')
-            # check process status
-            decartSTOP = getRunningTaskPID('decart.exe')
-            if decartSTOP:
-                logger.error(f'DeCart is still running, pid: {decartSTOP}')
-                time.sleep(15)
-            else:
-                logger.info('DeCart temporarily stopped')
-                break
-    else:   ## decart is running as a task (2.8.x)
-        #decartPID = getRunningTaskPID('decart.exe')
-        stopTask(decartPID)
-        logger.info('DeCart service temporarily stopped')
-        # check process status
-        decartSTOP = getRunningTaskPID('decart.exe')
-        if decartSTOP:
-            logger.error(f'DeCart is still running, pid: {decartSTOP}')
-        else:
+        else:   ## decart is running as a task (2.8.x)
+            decartPID = getRunningTaskPID('decart.exe')
+            if decartPID:
+                stopTask(decartPID)
+        if waitForDeCart(isService, False, timeout):
             logger.info('DeCart temporarily stopped')
+            return True
+        logger.error(f"DeCart is still running, pid: {getRunningTaskPID('decart.exe')} ({attempt+1}/{retries})")
+    return False
 
-def restartDeCart(isService, decartexe):
-    if isService:   ## decart is running as a service
-        ## NET START DeCart services if decart version is 2.7.x
-        while True:
+def restartDeCart(isService, decartexe, timeout=120, retries=3):
+    for attempt in range(retries):
+        if isService:   ## decart is running as a service
+            ## NET START DeCart services if decart version is 2.7.x
             try:
-                startcmd = ["NET", "START", "AIxMed DeCart"]
-                startdecart = subprocess.Popen(startcmd, 
-                                          stdout=subprocess.PIPE,   # capture standard output
-                                          stderr=subprocess.PIPE,   # capture standard error
-                                          text=True)
-                '''
-                #stdout, stderr = startdecart.communicate()
-                if stopdecart.returncode == 0:
-                    logger.info('DeCart service re-started')
-                else:
-                    logger.warning(f'{stopdecart.returncode}: can not re-start DeCart service')
-                '''
+                startcmd = ["NET", "START", DECART_SERVICE]
+                subprocess.Popen(startcmd,
+                                 stdout=subprocess.PIPE,   # capture standard output
+                                 stderr=subprocess.PIPE,   # capture standard error
+                                 text=True)
             except Exception as e:
                 logger.error(f'an error occurred: {str(e)}')
-            ## check service
+        elif getRunningTaskPID('decart.exe') is None:   ## decart is running as a task, do not start it twice
+            logger.info('try restarting DeCart task')
+            restartTask([decartexe])
+        if waitForDeCart(isService, True, timeout):
             decartPID = getRunningTaskPID('decart.exe')
-            if decartPID:
+            try:
                 decart = psutil.Process(decartPID)
                 logger.info(f'{decart.name()} (pid={decart.pid}) is {decart.status()} now')
-                break
-            else:
-                ## not restart yet
-                time.sleep(15)
-    else:   ## decart is running as a task
-        decartbin = [decartexe]
-        logger.info('try restarting DeCart task')
-        restartTask(decartbin)
-        # check process status
-        decartPID = getRunningTaskPID('decart.exe')
-        if decartPID:
-            decart_process = psutil.Process(decartPID)
-            logger.info(f'DeCart is {decart_process.status()} now')
-        else:
-            logger.error('failed to re-start DeCart ')
+            except (psutil.NoSuchProcess, psutil.AccessDenied, TypeError):
+                logger.info('DeCart re-started')
+            return True
+        logger.error(f'failed to re-start DeCart ({attempt+1}/{retries})')
+    return False
+
+def reconfigureDeCart(isService, decartexe, writeconfig):
+    ## stop DeCart, writeconfig() while it is down, start it again; no fixed delays
+    t0 = time.perf_counter()
+    if not stopDeCart(isService):
+        logger.error('DeCart did not stop, config.yaml is not updated')
+        return False
+    writeconfig()
+    isOK = restartDeCart(isService, decartexe)
+    logger.info(f'DeCart re-configured in {time.perf_counter()-t0:,.1f} seconds')
+    return isOK
 
 ## -------------------------------------------------------------- 
 ##  sample code from querying Copilot
@@ -9,9 +9,23 @@ import glob
 import shutil
 import json, yaml
 import time
+import queue
 from datetime import timedelta, datetime
-import win32wnet, pywintypes
-from .taskfunc import stopDeCart, restartDeCart
+try:
+    import win32wnet, pywintypes
+    HAS_WIN32 = True
+except ImportError:     ## not Windows, e.g. benchmark on local folders (benchwatch.py)
+    HAS_WIN32 = False
+from .taskfunc import reconfigureDeCart
+from amatools.folderwatch import FolderWatcher, FolderSnapshot
+from .scheduler import SlideJob, SlideScheduler, getSlidePriority
+from .pipeline import SlidePipeline
+from .copyengine import TRANSFERS
+from .decartlog import getDeCartLogTailer
+from .completion import getCompletionWatcher
+from .inferencemodel import getInferenceModel, slideFileSize
+from .jobjournal import JobJournal, JOB_FINISHED
+from .wsicheck import WSI_VALIDATOR
 from loguru import logger
 
 ##---------------------------------------------------------
@@ -101,52 +115,13 @@ def initConfig4WatchWSI(configfile=None):
 ##---------------------------------------------------------
 ## check whether 'error' was in decart.log
 ##---------------------------------------------------------
-def errorRules(line, tspos, anchor_dt):
-    tf = '%Y-%m-%dT%H:%M:%S'
-    #errstr = 'error: exist status 1'
-    if tspos == 5:      ## decart.log
-        isError = line and line[0:4] == 'time' and datetime.strptime(line[tspos:tspos+19], tf) > anchor_dt and 'error' in line
-    else:       ## debug.log
-        isError = line and line[0:2] == '20' and datetime.strptime(line[tspos:tspos+19], tf) > anchor_dt and 'error' in line
-    return isError
-
 def errorInDeCartlog(model2025, anchor_dt):
-    if model2025:
-        decartlog = Path(os.getenv('LOCALAPPDATA')) / 'decart' / 'debug.log'
-        tspos = 0
-    else:
-        decartlog = Path(r'c:\ProgramData') / 'decart' / 'decart.log'
-        tspos = 5
-    if decartlog.exists() == False:
-        logger.error(f'{str(decartlog)} does not exist')
+    ## only lines appended since the last check are read (see decartlog.DeCartLogTailer)
+    tailer = getDeCartLogTailer(model2025)
+    if tailer.logpath.exists() == False:
+        logger.error(f'{str(tailer.logpath)} does not exist')
         return True
-    ## load decart log
-    contents = decartlog.read_text()
-    lines = contents.splitlines()
-    tformat = '%Y-%m-%dT%H:%M:%S'
-    #nowDate = datetime.now().strftime('%Y-%m-%d')
-    log_today = filter(lambda x: errorRules(x, tspos, anchor_dt), lines)
-    errlog = list(log_today)
-    return errlog
-    #errlog = []
-    #for rr in todaylogs:
-    #    dt = datetime.strptime(rr[tspos:tspos+19], tformat)
-    #    #logger.debug(f'-{anchor_dt}-{dt}-{dt>anchor_dt}-{'error' in rr}:: {rr}')
-    #    if (dt > anchor_dt):
-    #        errlog.append(rr[tspos:])
-    '''
-    logstr = []
-    for rr in lines:
-        if (not model2025 and len(rr) > 5 and rr[0:4] == 'time') or (model2025 and len(rr) and rr[0:2] == '20'):
-            dt = datetime.strptime(rr[tspos:tspos+19], tformat)
-            logger.debug(f'-{anchor_dt}-{dt}-{dt>anchor_dt}-{'error' in rr}:: {rr}')
-            if (dt > anchor_dt) and ('errro' in rr): 
-                logstr.append(rr[tspos:])
-    '''
-    # find error that DeCart failed to model inference
-    #if len(errlog) > 0:
-    #    logger.debug(f'{len(errlog) errors found!)}')
-    #return errlog
+    return tailer.errorsSince(anchor_dt)
 
 ##---------------------------------------------------------
 ## update config.yaml (model / watch folder)
@@ -171,19 +146,18 @@ def updateDeCartConfig(decartYaml, decartEXE, thismodel=None, watchfolder=None):
         if thismodel and conf['preset'].lower() != thismodel.lower():
             conf['preset'] = thismodel.lower()
             bUpdate = True
-        if watchfolder and os.path.exists(watchfolder):
+        if watchfolder and os.path.exists(watchfolder) and conf.get('watch') != watchfolder:
             conf['watch'] = watchfolder
             bUpdate = True
         if bUpdate:
-            ## STOP DeCart service (2.7.x) or END DeCart process (2.8.x)
-            stopDeCart(is_a_service)
-            time.sleep(10)
-            # update decart.yaml
-            with open(decartYaml, 'w') as newyaml:
-                yaml.dump(conf, newyaml)
-            time.sleep(30)
-            ## restart DeCart
-            restartDeCart(is_a_service, decartEXE)
+            ## STOP DeCart service (2.7.x) or END DeCart process (2.8.x), update decart.yaml and restart DeCart,
+            ## each step proceeds as soon as DeCart is really down/up
+            def writeDeCartYaml():
+                with open(decartYaml, 'w') as newyaml:
+                    yaml.dump(conf, newyaml)
+            if not reconfigureDeCart(is_a_service, decartEXE, writeDeCartYaml):
+                logger.error(f'failed to switch DeCart to {conf["preset"]}')
+                isOK = False
             #
             logger.info(f'spent {timedelta(seconds=time.perf_counter()-t0)} to update config.yaml')
     if not bUpdate:
@@ -194,6 +168,10 @@ def updateDeCartConfig(decartYaml, decartEXE, thismodel=None, watchfolder=None):
 ##  map //{ip}/filepath to local drive (Windows only) 
 ## -------------------------------------------------------------- 
 def mapWindowsPCasLocalDrive(drive_letter, dir4scanned_wsi, username, password):
+    if not HAS_WIN32:
+        if os.path.exists(dir4scanned_wsi) == False:
+            logger.error(f'{dir4scanned_wsi} is not accessible, can not map {drive_letter} without pywin32')
+        return
     if os.path.exists(drive_letter) == False:    ## check if already connected
         #win32wnet.WNetAddConnection2(0, drive_letter, dir4scanned_wsi, None, username, password)
         #logger.info(f'{dir4scanned_wsi} is connected to {drive_letter}')
@@ -234,8 +212,8 @@ def backupAnalyzedImageFiles(srcpath, dstpath, wsilist, wsicompleted, modelname,
     if mkdirFAILED:
         logger.error(f'mkdir({backup_medaix}) failed, can not backup .med/.aix files')
         return
+    pairs = []
     for ii in range(len(wsicompleted)):
-    ##for wsi in wsilist:
         if wsicompleted[ii] == False:
             continue
         wfile = os.path.basename(wsilist[ii])
@@ -244,104 +222,83 @@ def backupAnalyzedImageFiles(srcpath, dstpath, wsilist, wsicompleted, modelname,
         if os.path.isfile(os.path.join(srcpath, afile)) == False:
             logger.warning(f'{os.path.join(srcpath, afile)} does not exist!')
         else:
-            if backuptype.lower() == 'copy':
-                try:
-                    shutil.copy(os.path.join(srcpath, mfile), os.path.join(backup_medaix, mfile))
-                    shutil.copy(os.path.join(srcpath, afile), os.path.join(backup_medaix, afile))
-                except PermissionError:
-                    logger.error(f'insufficient permission to copy the file')
-                except OSError as e:
-                    logger.error(f'OS error occurred: {e}')
-            elif backuptype.lower() == 'move':
-                try:
-                    shutil.move(os.path.join(srcpath, mfile), os.path.join(backup_medaix, mfile))
-                    shutil.move(os.path.join(srcpath, afile), os.path.join(backup_medaix, afile))
-                except PermissionError:
-                    logger.error(f'permission denied while accessing the moving files')
-                except shutil.Error as e:
-                    logger.error(f'an error occurred: {e}')
-                except Exception as e:
-                    logger.error(f'failed to move analyzed images: {e}')
-                #logger.trace(f'{mfile} was moved to {dstpath}')
+            pairs += [(os.path.join(srcpath, f), os.path.join(backup_medaix, f)) for f in [mfile, afile]]
+    ## .med/.aix files are copied/moved in parallel
+    if backuptype.lower() == 'copy':
+        results = TRANSFERS.copyFiles(pairs, traffic='storage')
+    elif backuptype.lower() == 'move':
+        results = TRANSFERS.moveFiles(pairs, traffic='storage')
+    else:
+        results = {}
+    for src, ok in results.items():
+        if not ok:
+            logger.error(f'failed to {backuptype} {os.path.basename(src)} to {backup_medaix}')
     logger.info(f'{backuptype} {len(wsicompleted)} .med/.aix files to {dstpath} completed!')
 
+def fanoutAnalyzedImageFiles(srcpath, dstpaths, wsilist, wsicompleted, modelname):
+    ## read each .med/.aix once and write to all dstpaths (local backup, image storage) concurrently,
+    ## the file in DeCart done folder is removed only after every copy was verified
+    backupdirs = []
+    for dstpath in dstpaths:
+        backup_medaix = os.path.join(dstpath, modelname.lower())
+        if os.path.exists(dstpath) == False:        ## lost connection to dstpath
+            logger.error(f'lost connection to {dstpath}, unable to backup files')
+            continue
+        try:
+            os.makedirs(backup_medaix, exist_ok=True)
+        except OSError as e:
+            logger.error(f'mkdir({backup_medaix}) failed, can not backup .med/.aix files: {e}')
+            continue
+        backupdirs.append(backup_medaix)
+    if len(backupdirs) == 0:
+        return {}
+    items = []
+    for ii in range(len(wsicompleted)):
+        if wsicompleted[ii] == False:
+            continue
+        wfile = os.path.basename(wsilist[ii])
+        mfile = f'{os.path.splitext(wfile)[0]}.med'
+        afile = f'{os.path.splitext(wfile)[0]}.aix'
+        if os.path.isfile(os.path.join(srcpath, afile)) == False:
+            logger.warning(f'{os.path.join(srcpath, afile)} does not exist!')
+        else:
+            items += [(os.path.join(srcpath, f), [os.path.join(d, f) for d in backupdirs]) for f in [mfile, afile]]
+    ## keep the source if one of the destinations is not reachable
+    results = TRANSFERS.fanoutFiles(items, removesrc=len(backupdirs) == len(dstpaths), traffic='storage')
+    for src, ok in results.items():
+        if not ok:
+            logger.error(f'failed to backup {os.path.basename(src)}, kept in {srcpath}')
+    logger.info(f'backup {sum(results.values())} .med/.aix files to {", ".join(backupdirs)} completed!')
+    return results
+
 ##---------------------------------------------------------
-## check WSI file availability using openslide-python
+## check WSI file availability: signature and partial-read structure check,
+## full openslide-python only if wsi_check is 'openslide' (see wsicheck.py)
 ##---------------------------------------------------------
-import openslide
-from openslide import OpenSlideError
-
 def checkWSIavailable(wsi):
-    isWSI = True
-    if os.path.splitext(wsi)[0].lower() == '.zip':
-        logger.debug('openslide-python can not veryify *.zip WSI file')
-    else:
-        ## can openslide open this wsi file??
-        try:
-            # Attempt to open a slide file
-            slide = openslide.OpenSlide(wsi)
-        except FileNotFoundError:
-            logger.error(f'{os.path.basename(wsi)} file was not found.')
-            isWSI = False
-        except OpenSlideError as e:
-            logger.error(f"OpenSlideError: {e} - {os.path.basename(wsi)}")
-            isWSI = False
-        except Exception as e:
-            logger.error(f"An unexpected error occurred ({os.path.basename(wsi)}): {e}")
-            isWSI = False
+    isWSI, reason = WSI_VALIDATOR.validate(wsi)
+    if not isWSI:
+        logger.error(f'{os.path.basename(wsi)} is not a valid WSI file: {reason}')
     return isWSI
 
 ##---------------------------------------------------------
 ## check model inference completed, or not
 ##---------------------------------------------------------
-def checkDeCartCompletion(wsilist, watchfolder, wsicompleted, model2025, dt_anchor):
-    Inference_a_WSI = 10    ## roughly, 10 minutes for a 7-layer WSI file; more than 30 minutes for a 21-layer WSI
+INFERENCE_HISTORY = os.path.join(os.getenv('LOCALAPPDATA', ''), 'ama_qcapi', 'inference_history.json')
+
+def checkDeCartCompletion(wsilist, watchfolder, wsicompleted, model2025, dt_anchor, preset=None, decart_version=None):
+    ## woken up by done-folder events and DeCart log errors, per-slide timeout predicted from past runs
     howmanywsi = len(wsilist)
-    expectedInferenceTime = howmanywsi * Inference_a_WSI * 60
-    errorfound = False
     if len(wsicompleted) != howmanywsi:
         logger.error(f'({wsicompleted}) does not match wsilist length: {howmanywsi}')
         return True  # error found
-    t0 = time.perf_counter()
-    while True:     ## forever loop to wait for model inference completion
-        if sum(wsicompleted) == howmanywsi:
-            errorfound = False
-            break
-        else:
-            for i, wsi in enumerate(wsilist):
-                if wsicompleted[i] == False:
-                    thiswsi = Path(wsi)
-                    thisaix = Path(watchfolder) / 'done' / f'{thiswsi.stem}.aix'
-                    if thisaix.exists():
-                        logger.info(f'{str(thisaix)} inference completed')
-                        wsicompleted[i] = True
-                    else:
-                        logger.debug(f'still waiting {str(thisaix)}')
-            ## check consumed time
-            consumedtime = time.perf_counter()-t0
-            if consumedtime > expectedInferenceTime:
-                logger.warning(f'model inference time ({consumedtime}) exceeds expected time {expectedInferenceTime} seconds; anchor is {dt_anchor}')
-                errlog = errorInDeCartlog(model2025, dt_anchor)
-                if len(errlog) > 0:
-                    ## dump decart error messages to log
-                    for errmsg in errlog:
-                        logger.error(errmsg)
-                    errorfound = True
-                    break
-                else:
-                    #t0 = time.perf_counter()
-                    expectedInferenceTime += (len(wsicompleted)-sum(wsicompleted)) * 10 * 60
-            else:
-                logger.info(f'{sum(wsicompleted)} of {len(wsicompleted)} files analysis completed')
-                time.sleep(120)
-    if errorfound:
-        for i in range(len(wsilist)):
-            fname = os.path.basename(wsilist[i])
-            errorwsi = list(filter(lambda x: fname in x, errlog))
-            if len(errorwsi):
-                logger.debug(f'{wsilist[i]} -- {errorwsi}')
-                wsicompleted[i] = False
-    return errorfound
+    completion = getCompletionWatcher(watchfolder, model2025, INFERENCE_HISTORY, decart_version)
+    ## DeCart analyzes the slides in the order they were copied
+    for i, wsi in enumerate(wsilist):
+        if wsicompleted[i] == False:
+            wsicompleted[i] = completion.waitForSlide(wsi, dt_anchor, preset)
+            logger.info(f'{sum(wsicompleted)} of {howmanywsi} files analysis completed')
+    return sum(wsicompleted) != howmanywsi
 
 ##---------------------------------------------------------
 ## connect to scanner/decart watch folders
@@ -360,478 +317,371 @@ def connect2scanner_and_imagestorage(args):
 ## start monitoring scanner/decart watch folders 
 ##---------------------------------------------------------
 def checkCopyWSIcompleted(srcwsi, dstwsi):
+    ## chunked copy to a temp name, verified by checksum, renamed when complete (no stat polling)
     filecopied = False
-    escape_seconds = 0
     if checkWSIavailable(srcwsi):
-        src_stat = os.stat(srcwsi)
         try:
-            shutil.copy(srcwsi, dstwsi)
-            filecopied = True
+            t0 = time.perf_counter()
+            if TRANSFERS.copyFiles([(srcwsi, dstwsi)], traffic='scanner')[srcwsi]:
+                filecopied = True
+                logger.trace(f'copied {os.path.basename(srcwsi)} in {time.perf_counter()-t0:,.1f} seconds')
         except PermissionError:
             logger.error(f'insufficient permission to copy the file {os.path.basename(srcwsi)}')
         except OSError as e:
             logger.error(f'OS error occurred ({os.path.basename(srcwsi)}): {e}')
-        # check the filesize is identical
-        if filecopied:
-            while True:
-                dst_stat = os.stat(dstwsi)
-                if src_stat.st_size == dst_stat.st_size and src_stat.st_mtime <= dst_stat.st_mtime:
-                    filecopied = True
-                    break
-                time.sleep(10)
-                escape_seconds += 10
-                if escape_seconds > 1200:    ## 20 minutes
-                    logger.error(f'copying {srcwsi} to DeCart watch folder more than {escape_seconds} seconds!!')
     return filecopied
 
-def OLD_checkCopyWSIcompleted(srcwsi, dstwsi):
-    filecopied = False
-    if checkWSIavailable(srcwsi):
-        escape_seconds = 0
-        shutil.copy(srcwsi, dstwsi)
-        while True:
-            src_stat = os.stat(srcwsi)
-            dst_stat = os.stat(dstwsi)
-            if src_stat.st_size == dst_stat.st_size and src_stat.st_mtime <= dst_stat.st_mtime:
-                filecopied = True
-                break
-            time.sleep(10)
-            escape_seconds += 10
-            if escape_seconds > 1200:    ## 20 minutes
-                logger.error(f'copying {srcwsi} to DeCart watch folder more than {escape_seconds} seconds!!')
-    return filecopied
+def removeFileQuietly(file):
+    if os.path.exists(file):
+        try:
+            os.unlink(file)
+            logger.trace(f'os.unlink({file})')
+        except FileNotFoundError:
+            logger.error(f'{file} does not exist')
+        except PermissionError:
+            logger.error(f'permission denied: unable to delete {file}')
+        except OSError as e:
+            logger.error(f'error occurred while deleting {file}: {e}')
+
+def copySlide2DeCart(wfile, decartWatch):
+    wsitype = os.path.splitext(wfile)[1].lower()[1:]
+    try:
+        if wsitype == 'mrxs':
+            dirmrxs = os.path.splitext(wfile)[0]
+            if not TRANSFERS.copyTree(dirmrxs, os.path.join(decartWatch, os.path.split(dirmrxs)[1]), traffic='scanner'):
+                logger.error(f'failed to copy {dirmrxs} to {decartWatch}')
+                return False
+        if checkCopyWSIcompleted(wfile, os.path.join(decartWatch, os.path.basename(wfile))):
+            logger.trace(f"Copied: {os.path.basename(wfile)} → {decartWatch}")
+            return True
+        logger.debug(f'{os.path.basename(wfile)} was moved!')
+    except Exception as e:
+        logger.error(f"Copy failed: {os.path.basename(wfile)} → {decartWatch} | Error: {str(e)}")
+    return False
+
+def archiveAnalyzedSlides(args, modelname, wsilist, wsicompleted, errorfound, decartWatch):
+    ## backup .med/.aix and WSI files of a batch, returns False if image storage is not reachable
+    srcMEDAIX = os.path.join(decartWatch, 'done')
+    dstMEDAIX = args['driveYhome']
+    folderWSIbackup = args['folderwsifile']
+    ## copy .med/.aix to local backup folder
+    backupWSI = os.path.join(folderWSIbackup, modelname.lower())
+    if os.path.exists(backupWSI) == False:
+        os.makedirs(backupWSI)
+    ## check destination folder (network) still connected
+    dstModel = os.path.join(dstMEDAIX, modelname.lower())
+    if os.path.exists(dstModel) == False:
+        try:
+            os.makedirs(dstModel)
+        except OSError as e:
+            logger.error(f'failed to create {dstModel}: {e}')
+            return False
+    if errorfound:      ## partial wsi files were completed
+        logger.debug(f'result of model inference: {wsicompleted}')
+        failed_wsi = os.path.join(backupWSI, 'failedWSI')
+        if os.path.exists(failed_wsi) == False:
+            os.makedirs(failed_wsi)
+        ## .med/.aix of completed slides to local folder and image storage
+        fanoutAnalyzedImageFiles(srcMEDAIX, [folderWSIbackup, dstMEDAIX], wsilist, wsicompleted, modelname)
+        for i, file in enumerate(wsilist):
+            wfile = os.path.basename(file)
+            if wsicompleted[i]:
+                ## local wsi backup folder
+                localwsibackup = backupWSI
+            else:       ## decart failed to model inference this file
+                localwsibackup = failed_wsi
+                ## delete failed WSI from decart watch folder
+                removeFileQuietly(os.path.join(decartWatch, wfile))
+            ## move wsi files to local backup folder, for now
+            try:
+                shutil.move(file, os.path.join(localwsibackup, wfile))
+                logger.trace(f'move {file} to {os.path.join(localwsibackup, wfile)}')
+            except PermissionError:
+                logger.error(f'Permission denied when moving {file}')
+            except OSError as e:
+                logger.error(f'Error occurred while moving file: {e}')
+            ## delete if still exist
+            removeFileQuietly(file)
+            ## I don't know why??
+            if os.path.exists(file):
+                logger.error(f'[FATAL] why {file} still existed !!????')
+                newfile = f'{file}.err'
+                try:
+                    os.rename(file, newfile)
+                except FileExistsError:
+                    logger.error("The new file name already exists.")
+                except OSError as e:
+                    logger.error(f"Error: {e}")
+    else:   ## all wsi files were analyzed completed
+        fanoutAnalyzedImageFiles(srcMEDAIX, [args['foldermedaix'], dstMEDAIX], wsilist, wsicompleted, modelname)
+        ## move wsi files to local backup folder, for now
+        for file in wsilist:
+            try:
+                shutil.move(file, os.path.join(backupWSI, os.path.basename(file)))
+            except PermissionError:
+                logger.error(f'Permission denied when moving {file}')
+            except OSError as e:
+                logger.error(f'Error occurred while moving file: {e}')
+            finally:
+                logger.debug(f'{file} was shutil.move to {backupWSI}')
+            ## delete if still exist
+            removeFileQuietly(file)
+    return True
+
+def journalState(journal, path, state, preset=None, info=None):
+    if journal:
+        journal.transition(path, state, preset, info)
+
+def resumeCopiedSlide(journal, wfile, decartWatch):
+    ## slide copied before the watcher was restarted: do not copy again, DeCart already has it
+    job = journal.get(wfile) if journal else None
+    if not job or job['state'] not in ['copied', 'inferring', 'done'] or not job['copied']:
+        return None
+    stem, dstwsi = os.path.splitext(os.path.basename(wfile))[0], os.path.join(decartWatch, os.path.basename(wfile))
+    inWatch = os.path.isfile(dstwsi) and os.path.getsize(dstwsi) == os.path.getsize(wfile)
+    inDone = os.path.isfile(os.path.join(decartWatch, 'done', f'{stem}.aix'))
+    if inWatch or inDone:
+        logger.info(f"resume {os.path.basename(wfile)} ({job['state']}), copied at {datetime.fromtimestamp(job['copied'])}")
+        return datetime.fromtimestamp(job['copied'])-timedelta(seconds=0.5)
+    return None
 
-def startMonitorFolders(configfile, logfile):
+def copySlides2DeCart(wsilist, decartWatch):
+    ## copy a batch of slides in parallel, returns copied slides
+    ## mrxs data folders go first, DeCart must not see a .mrxs file before its .dat files
+    datapairs, slidepairs, slidefiles = [], [], {}
+    for wfile in wsilist:
+        if not checkWSIavailable(wfile):
+            continue
+        slidefiles[wfile] = [wfile]
+        slidepairs.append((wfile, os.path.join(decartWatch, os.path.basename(wfile))))
+        if os.path.splitext(wfile)[1].lower() == '.mrxs':
+            dirmrxs = os.path.splitext(wfile)[0]
+            for root, _, files in os.walk(dirmrxs):
+                thisdst = os.path.join(decartWatch, os.path.relpath(root, os.path.dirname(dirmrxs)))
+                os.makedirs(thisdst, exist_ok=True)
+                for f in files:
+                    datapairs.append((os.path.join(root, f), os.path.join(thisdst, f)))
+                    slidefiles[wfile].append(os.path.join(root, f))
+    results = TRANSFERS.copyFiles(datapairs, traffic='scanner')
+    ## skip slides whose data folder failed
+    slidepairs = [(src, dst) for src, dst in slidepairs if all(results.get(f, False) for f in slidefiles[src][1:])]
+    results.update(TRANSFERS.copyFiles(slidepairs, traffic='scanner'))
+    copied = []
+    for wfile in wsilist:
+        if wfile in slidefiles and all(results.get(f, False) for f in slidefiles[wfile]):
+            logger.trace(f"Copied: {os.path.basename(wfile)} → {decartWatch}")
+            copied.append(wfile)
+        elif wfile in slidefiles:
+            logger.error(f"Copy failed: {os.path.basename(wfile)} → {decartWatch}")
+    return copied
+
+def processSlideBatch(args, modelname, wsilist, decartWatch, journal=None):
+    ## copy a batch of slides to DeCart watch folder, wait for model inference, then backup
+    t0 = time.perf_counter()
+    logger.trace(f"found {len(wsilist)} {modelname} slide images at {time.strftime('%Y-%m-%d %H:%M:%S')}")
+    dt_anchor = datetime.now()-timedelta(seconds=0.5)      ## for check decart log
+    resumed = {}
+    for wfile in wsilist:
+        anchor = resumeCopiedSlide(journal, wfile, decartWatch)
+        if anchor:
+            resumed[wfile] = anchor
+    copied = copySlides2DeCart([wfile for wfile in wsilist if wfile not in resumed], decartWatch)
+    for wfile in copied:
+        journalState(journal, wfile, 'copied')
+    if resumed:
+        dt_anchor = min(list(resumed.values()) + [dt_anchor])
+    copied = [wfile for wfile in wsilist if wfile in resumed or wfile in copied]
+    logger.debug(f'{len(copied)} WSI files were copied to DeCart watch folder')
+    if len(copied) == 0:
+        return
+    logger.debug(f'start tracing decart.log from {dt_anchor} ...')
+    wsicompleted = [False for _ in range(len(copied))]
+    isModel2025 = False if 'ProgramData' in args['decartyaml'] else True
+    for wfile in copied:
+        journalState(journal, wfile, 'inferring')
+    errorfound = checkDeCartCompletion(copied, decartWatch, wsicompleted, isModel2025, dt_anchor, modelname, args.get('decart_ver'))
+    for wfile, completed in zip(copied, wsicompleted):
+        journalState(journal, wfile, 'done' if completed else 'failed')
+    if archiveAnalyzedSlides(args, modelname, copied, wsicompleted, errorfound, decartWatch):
+        for wfile, completed in zip(copied, wsicompleted):
+            if completed:
+                journalState(journal, wfile, 'archived')
+        consumed_time = f'{timedelta(seconds=time.perf_counter()-t0)}'
+        logger.info(f'processed {len(copied)} {modelname} slides with {consumed_time[:-3]}')
+    else:
+        logger.error(f"lost network connection, can not access {args['driveYhome']}")
+
+##---------------------------------------------------------
+## pipeline stages: copy-in -> inference-wait -> output harvest -> backup/move
+##---------------------------------------------------------
+def pipelineCopy(task, decartWatch, journal=None):
+    task.dt_anchor = resumeCopiedSlide(journal, task.path, decartWatch)
+    if task.dt_anchor:
+        task.copied = True
+        return True
+    task.copied = copySlide2DeCart(task.path, decartWatch)
+    if task.copied:
+        task.dt_anchor = datetime.now()-timedelta(seconds=0.5)      ## for check decart log
+        journalState(journal, task.path, 'copied')
+    return task.copied
+
+def pipelineWaitInference(task, args, decartWatch, journal=None):
+    journalState(journal, task.path, 'inferring')
+    completed = [False]
+    isModel2025 = False if 'ProgramData' in args['decartyaml'] else True
+    checkDeCartCompletion([task.path], decartWatch, completed, isModel2025, task.dt_anchor, task.preset, args.get('decart_ver'))
+    task.completed = completed[0]
+    return task.completed
+
+def pipelineHarvest(task, decartWatch, timeout=60, journal=None):
+    ## .med/.aix of this slide should be in done folder and no longer growing
+    stem = os.path.splitext(os.path.basename(task.path))[0]
+    outputs = [os.path.join(decartWatch, 'done', f'{stem}.{ext}') for ext in ['med', 'aix']]
+    lastsize = None
+    t0 = time.perf_counter()
+    while time.perf_counter()-t0 < timeout:
+        if all(os.path.isfile(f) for f in outputs):
+            thissize = [os.path.getsize(f) for f in outputs]
+            if thissize == lastsize:
+                journalState(journal, task.path, 'done')
+                return True
+            lastsize = thissize
+        time.sleep(1)
+    logger.warning(f'.med/.aix of {stem} are missing or still being written after {timeout} seconds')
+    task.completed = False
+    return False
+
+def pipelineArchive(task, args, decartWatch, journal=None):
+    if not task.copied:
+        ## as in processSlideBatch(), the slide stays in the scanner folder and is copied again next time
+        logger.warning(f'{os.path.basename(task.path)} was not copied to DeCart watch folder, will retry')
+        journalState(journal, task.path, 'failed', info='copy failed')
+        return
+    archiveAnalyzedSlides(args, task.preset, [task.path], [task.completed], not task.completed, decartWatch)
+    journalState(journal, task.path, 'archived' if task.completed else 'failed')
+
+def startMonitorFolders(configfile, logfile, switchPreset=None, stop=None):
+    ## stop: threading.Event to end the watch loop, returns stage and latency statistics when stopped
     MonitorLogger(logfname=logfile)
     ## init environment
     args = initConfig4WatchWSI(configfile)
     # connect Leica Aperio AT2 to X:, and connect scanner local storage to Y:
     connect2scanner_and_imagestorage(args)
-    ## monitor scanner shared folders
-    scannerURO = os.path.join(args['driveXhome'], 'aixuro')
-    scannerTHY = os.path.join(args['driveXhome'], 'aixthy')
+    ## monitor scanner shared folders, one folder per model preset
+    scanners = {'AIxURO': os.path.join(args['driveXhome'], 'aixuro'),
+                'AIxTHY': os.path.join(args['driveXhome'], 'aixthy')}
     ## monitor decart watch folder
     decartWatch = args['decartwatch']
-    #print(decartWatch)
-    if os.path.exists(scannerURO) == False or \
-       os.path.exists(scannerTHY) == False or \
+    if os.path.exists(scanners['AIxURO']) == False or \
+       os.path.exists(scanners['AIxTHY']) == False or \
        os.path.exists(decartWatch) == False:
-        #qclog('ERROR', 'one of scanner watch folders or decart watch folder does not exist')
         logger.error('one of scanner watch folders or decart watch folder does not exist')
         return False
-    ## monitor decart DONE folder
-    srcMEDAIX = os.path.join(decartWatch, 'done')
-    dstMEDAIX = args['driveYhome']
-    folderBackup = args['foldermedaix']
-    folderWSIbackup = args['folderwsifile']
     MONITORED_WSI = ['svs', 'ndpi', 'mrxs', 'tif', 'zip', 'tiff']
+    ## rush cases can also be dropped into a 'stat' or 'urgent' subfolder of a scanner folder
+    watched = [(preset, folder) for preset, folder in scanners.items()]
+    watched += [(preset, os.path.join(folder, level)) for preset, folder in scanners.items()
+                for level in ['stat', 'urgent'] if os.path.isdir(os.path.join(folder, level))]
+    TRANSFERS.setLimits(args.get('copy_workers', 8), args.get('copy_per_destination', 4))
+    ## bandwidth per traffic class, 'scanner' (slides to DeCart) and 'storage' (.med/.aix to image storage), e.g.
+    ## "bandwidth": {"storage": {"default": 0, "rules": [{"from": "07:30", "to": "18:00", "mb_per_second": 40}]}}
+    for traffic, policy in args.get('bandwidth', {}).items():
+        TRANSFERS.setBandwidth(traffic, policy.get('rules', []), policy.get('default', 0))
+    ## wsi_check: 'magic', 'structure' (default) or 'openslide'
+    WSI_VALIDATOR.setLevel(args.get('wsi_check', 'structure'))
+    ## switching DeCart preset stops/restarts DeCart, can be replaced (e.g. benchmark with a stub DeCart)
+    if switchPreset is None:
+        switchPreset = lambda preset: updateDeCartConfig(args['decartyaml'], args['decart_exe'], thismodel=preset)
+    ## event-driven watcher, polling as fallback for network shares
+    watcher = FolderWatcher([folder for _, folder in watched], MONITORED_WSI,
+                            settle=args.get('watch_settle_seconds', 5), poll_interval=args.get('watch_poll_seconds', 30))
+    watcher.start()
+    ## slides of both folders are queued and batched by model preset,
+    ## batch_policy 'sjf' starts slides with the shortest predicted inference time first
+    inferencemodel = getInferenceModel(INFERENCE_HISTORY)
+    predictor = lambda job: inferencemodel.predictSeconds(filesize=slideFileSize(job.path), model=job.preset, decart=args.get('decart_ver'))
+    scheduler = SlideScheduler(max_batch=args.get('batch_max_slides', 20),
+                               max_wait=args.get('batch_max_wait_minutes', 30)*60,
+                               max_consecutive=args.get('batch_max_consecutive', 3),
+                               policy=args.get('batch_policy', 'fifo'), predictor=predictor,
+                               aging=args.get('priority_aging_minutes', 15)*60)
+    current_preset = None
+    ## job journal: slides in flight when the watcher stopped are resumed first
+    journal = JobJournal(os.path.join(args['home_qcapi'], 'watchwsi_journal.db'))
+    for job in journal.unfinished():
+        if os.path.exists(job['path']):
+            scheduler.add(SlideJob(job['path'], job['preset'], found=job['discovered'], priority=getSlidePriority(job['path'])))
+            logger.info(f"resume {os.path.basename(job['path'])}: {job['state']}")
+        else:
+            journalState(journal, job['path'], 'archived', info='not in scanner folder after restart')
+    ## copy / inference / archive of consecutive slides overlap, pipeline_depth=0 processes batch by batch
+    pipeline = None
+    finished = queue.SimpleQueue()
+    if args.get('pipeline_depth', 2) > 0:
+        pipeline = SlidePipeline(lambda task: pipelineCopy(task, decartWatch, journal),
+                                 lambda task: pipelineWaitInference(task, args, decartWatch, journal),
+                                 lambda task: pipelineHarvest(task, decartWatch, journal=journal),
+                                 lambda task: pipelineArchive(task, args, decartWatch, journal),
+                                 depth=args.get('pipeline_depth', 2))
+        pipeline.start()
     ## forever watch loop
     logger.trace(f"👀 Monitoring scanner folders", 'startMonitorFolders')
-    configYAML = args['decartyaml']
-    byebye = False
-    while True:
-        ## forever watch loop for urine slide till new thyroid WSI found
-        logger.trace(f'watching urine WSI folder {scannerURO}...')
-        while True:
-            if os.path.exists(scannerURO) == False:
-                logger.warning(f'lost connection to {scannerURO}, try re-connecting ...')
-                ## connect scanner/image storage again (once)
-                xok, yok = connect2scanner_and_imagestorage(args)
-                if not xok or not yok:
-                    logger.error(f'lost connection to {scannerURO}, watchwsi.exe will be shutdown')
-                    byebye = True
-                    break
-            bWSIfound = False
-            # monitor aixuro folder in scanner
-            flist = glob.glob(os.path.join(scannerURO, '*'))
-            flist.sort()
-            wsilist = []
-            for file in flist:
-                wsitype = os.path.splitext(file)[1].lower()[1:]
-                if os.path.isfile(file) and wsitype in MONITORED_WSI:
-                    wsilist.append(file)
-            howmany = len(wsilist)
-            if howmany > 0:
-                t0 = time.perf_counter()
-                #dt_anchor = datetime.now()-timedelta(seconds=1)      ## for check decart log
-                anchortime = True
-                logger.trace(f"found {howmany} urine slide images at {time.strftime('%Y-%m-%d %H:%M:%S')}")
-                if updateDeCartConfig(configYAML, args['decart_exe'], thismodel='AIxURO'):
-                    logger.info('model product is AIxURO')
-                else:
-                    logger.error('something wrong while updating model to AIxURO, will stop watchwsi.exe')
-                    print('[ERROR] STOP watchwsi.exe')
-                    byebye = True
-                    break
-                filecopied = [False for _ in range(howmany)]
-                for ii in range(howmany):
-                    wfile = wsilist[ii]
-                    wsitype = os.path.splitext(wfile)[1].lower()[1:]
-                    try:
-                        #shutil.copy(file, decartWatch)
-                        if wsitype == 'mrxs':
-                            dirmrxs = os.path.splitext(wfile)[0]
-                            shutil.copytree(dirmrxs, os.path.join(decartWatch, os.path.split(dirmrxs)[1]))
-                        if checkCopyWSIcompleted(wfile, os.path.join(decartWatch, os.path.basename(wfile))):
-                            if anchortime:
-                                dt_anchor = datetime.now()-timedelta(seconds=0.5)      ## for check decart log
-                                anchortime = False
-                            logger.trace(f"Copied: {os.path.basename(wfile)} → {decartWatch}")
-                            filecopied[ii] = True
-                        else:
-                            #wsilist.remove(file)
-                            logger.debug(f'{os.path.basename(wfile)} was moved!')
-                    except Exception as e:
-                        logger.error(f"Copy failed: {os.path.basename(file)} → {decartWatch} | Error: {str(e)}")
-                howmany = sum(filecopied)
-                bWSIfound = True if howmany else False
-                logger.debug(f'{howmany} WSI files were copied to DeCart watch folder')
-            if bWSIfound:
-                logger.debug(f'start tracing decart.log from {dt_anchor} ...')
-                wsicompleted = []
-                for ii in range(len(filecopied)):
-                    if filecopied[ii]:
-                        wsicompleted.append(False)
-                    else:
-                        wsilist.remove(wsilist[ii])
-                logger.debug(f'waiting for {len(wsicompleted)}:({len(wsilist)}) wsi files ....')
-                isModel2025 = False if 'ProgramData' in configYAML else True
-                errorfound = checkDeCartCompletion(wsilist, decartWatch, wsicompleted, isModel2025, dt_anchor)
-                ## copy .med/.aix to local backup folder
-                backupURO = os.path.join(folderWSIbackup, 'aixuro')
-                if os.path.exists(backupURO) == False:
-                    os.makedirs(backupURO)
-                ## check destination folder (network) still connected
-                ##if os.path.exists(dstMEDAIX):
-                mkdirFAILED = False
-                dstURO = os.path.join(dstMEDAIX, 'aixuro')
-                if os.path.exists(dstURO) == False:
-                    try:
-                        os.makedirs(dstURO)
-                    except OSError as e:
-                        logger.error(f'failed to create {dstURO}: {e}')
-                        mkdirFAILED = True
-                if not mkdirFAILED:
-                    if errorfound:      ## partial wsi files were completed
-                        logger.debug(f'result of model inference: {wsicompleted}')
-                        failed_wsi = os.path.join(backupURO, 'failedWSI')
-                        if os.path.exists(failed_wsi) == False:
-                            os.makedirs(failed_wsi)
-                        for i, file in enumerate(wsilist):
-                            wfile = os.path.basename(file)
-                            mfile = f'{os.path.splitext(wfile)[0]}.med'
-                            afile = f'{os.path.splitext(wfile)[0]}.aix'
-                            if wsicompleted[i]:
-                                ## copy .med/.aix to local folder for backup
-                                try:
-                                    shutil.copy(os.path.join(srcMEDAIX, mfile), os.path.join(backupURO, mfile))
-                                    shutil.copy(os.path.join(srcMEDAIX, afile), os.path.join(backupURO, afile))
-                                except PermissionError:
-                                    logger.error(f'insufficient permission to copy the file')
-                                except OSError as e:
-                                    logger.error(f'OS error occurred: {e}')
-                                ## move .med/.aix to image storage
-                                try:
-                                    shutil.move(os.path.join(srcMEDAIX, mfile), os.path.join(dstURO, mfile))
-                                    shutil.move(os.path.join(srcMEDAIX, afile), os.path.join(dstURO, afile))
-                                except PermissionError:
-                                    logger.error(f'permission denied while accessing the moving files')
-                                except shutil.Error as e:
-                                    logger.error(f'an error occurred: {e}')
-                                except Exception as e:
-                                    logger.error(f'failed to move analyzed images: {e}')
-                                ## local wsi backup folder
-                                localwsibackup = os.path.join(folderWSIbackup, 'aixuro')
-                            else:       ## decart failed to model inference this file
-                                localwsibackup = os.path.join(folderWSIbackup, 'aixuro', 'failedWSI')
-                                ## delete failed WSI from decart watch folder
-                                failedwsi = os.path.join(decartWatch, wfile)
-                                try:
-                                    os.unlink(failedwsi)
-                                    logger.trace(f'os.unlink({failedwsi})')
-                                except FileNotFoundError:
-                                    logger.error(f'{failedwsi} does not exist')
-                                except PermissionError:
-                                    logger.error(f'permission denied: unable to delete {failedwsi}')
-                                except OSError as e:
-                                    logger.error(f'error occurred while deleting {failedwsi}: {e}')                           
-                            ## move wsi files to local backup folder, for now
-                            try:
-                                shutil.move(file, os.path.join(localwsibackup, wfile))
-                                logger.trace(f'move {file} to {os.path.join(localwsibackup, wfile)}')
-                            except PermissionError:
-                                logger.error(f'Permission denied when moving {file}')
-                            except OSError as e:
-                                logger.error(f'Error occurred while moving file: {e}')
-                            ## delete if still exist
-                            if os.path.exists(file):
-                                try:
-                                    os.unlink(file)
-                                    logger.trace(f'os.unink({file})')
-                                except FileNotFoundError:
-                                    logger.error(f'{file} does not exist')
-                                except PermissionError:
-                                    logger.error(f'permission denied: unable to delete {file}')
-                                except OSError as e:
-                                    logger.error(f'error occurred while deleting {file}: {e}')                           
-                            ## I don't know why??
-                            if os.path.exists(file):
-                                logger.error(f'[FATAL] why {file} still existed !!????')
-                                newfile = f'{file}.err'
-                                try:
-                                    os.rename(file, newfile)
-                                except FileExistsError:
-                                    logger.error("The new file name already exists.")
-                                except OSError as e:
-                                    logger.error(f"Error: {e}")
-                    else:   ## all wsi files were analyzed completed
-                        backupAnalyzedImageFiles(srcMEDAIX, folderBackup, wsilist, wsicompleted, 'AIxURO', 'copy')
-                        backupAnalyzedImageFiles(srcMEDAIX, dstMEDAIX, wsilist, wsicompleted, 'AIxURO', 'move')
-                        ## move wsi files to local backup folder, for now
-                        for file in wsilist:
-                            try:
-                                shutil.move(file, os.path.join(backupURO, os.path.basename(file)))
-                            except PermissionError:
-                                logger.error(f'Permission denied when moving {file}')
-                            except OSError as e:
-                                logger.error(f'Error occurred while moving file: {e}')
-                            finally:
-                                logger.debug(f'{file} was shutil.move to {backupURO}')
-                            ## delete if still exist
-                            if os.path.exists(file):
-                                try:
-                                    os.remove(file)
-                                except FileNotFoundError:
-                                    logger.error(f'{file} does not exist')
-                                except PermissionError:
-                                    logger.error(f'permission denied: unable to delete {file}')
-                                except OSError as e:
-                                    logger.error(f'error occurred while deleting {file}: {e}')
-                                finally:
-                                    logger.debug(f'{file} was os.remove to {backupURO}')
-                    consumed_time = f'{timedelta(seconds=time.perf_counter()-t0)}'
-                    logger.info(f'processed {howmany} urine slides with {consumed_time[:-3]}')
-                else:
-                    logger.error(f'lost network connection, can not access {dstMEDAIX}')
-            ## check decart DONE folder
-            mlist = glob.glob(os.path.join(srcMEDAIX, 'done'))
-            if len(mlist):
-                logger.warning('some .med/.aix still exist in DeCart done folder')
-                break
-            ##
-            ## goto thyroid loop if thyroid WSI found, or stay in urine loop
-            flist = glob.glob(os.path.join(scannerTHY, '*'))
-            howmany = 0
-            for file in flist:
-                wsitype = os.path.splitext(file)[1].lower()[1:]
-                if os.path.isfile(file) and wsitype in MONITORED_WSI:
-                    howmany += 1
-            if howmany > 0:     ## thyroid WSI found
+    while stop is None or not stop.is_set():
+        if any(os.path.exists(folder) == False for folder in scanners.values()):
+            logger.warning(f'lost connection to scanner folders, try re-connecting ...')
+            ## connect scanner/image storage again (once)
+            xok, yok = connect2scanner_and_imagestorage(args)
+            if not xok or not yok:
+                logger.error(f"lost connection to {args['driveXhome']}, watchwsi.exe will be shutdown")
                 break
+        ## slides archived by the pipeline can be queued again if they are still in scanner folder
+        while not finished.empty():
+            scheduler.done([finished.get()])
+        # queue WSI files which are completely written
+        for preset, folder in watched:
+            for wsi in watcher.listStableWSI(folder):
+                if wsi in scheduler.queued:
+                    continue
+                if scheduler.add(SlideJob(wsi, preset, priority=getSlidePriority(wsi))):
+                    job = journal.get(wsi)
+                    if job is None or job['state'] in JOB_FINISHED:
+                        journalState(journal, wsi, 'discovered', preset)
+        scheduler.discardMissing()
+        ## with the pipeline, slides are dispatched one by one, a STAT slide found meanwhile goes next
+        preset, jobs = scheduler.nextBatch(current_preset, limit=1 if pipeline else None)
+        if len(jobs) == 0:
+            ### wait up to 3 minutes, wake up as soon as a new WSI is completely written
+            watcher.waitForWSI(args.get('watch_idle_seconds', 180))
+            continue
+        if preset != current_preset:
+            ## DeCart preset is global, slides of the running preset have to finish first
+            if pipeline:
+                pipeline.drain()
+            if switchPreset(preset):
+                logger.info(f'model product is {preset}')
+                current_preset = preset
             else:
-                ### sleep another 3 minutes
-                time.sleep(180)
-        if byebye:
-            break
-        #
-        ## forever watch loop for urine slide till new thyroid WSI found
-        logger.trace('watching thyroid WSI folder {scannerTHY}...')
-        while True:
-            if os.path.exists(scannerTHY) == False:
-                logger.warning(f'lost connection to {scannerTHY}, try re-connecting ...')
-                ## connect scanner/image storage again (once)
-                xok, yok = connect2scanner_and_imagestorage(args)
-                if not xok or not yok:
-                    logger.error(f'lost connection to {scannerTHY}, watchwsi.exe will be shutdown')
-                    byebye = True
-                    break
-            # monitor aixthy folder in scanner
-            bWSIfound = False
-            flist = glob.glob(os.path.join(scannerTHY, '*'))
-            flist.sort()
-            wsilist = []
-            for file in flist:
-                if os.path.isfile(file) and wsitype in MONITORED_WSI:
-                    wsilist.append(file)
-            howmany = len(wsilist)
-            if howmany > 0:
-                t0 = time.perf_counter()
-                #dt_anchor = datetime.now()-timedelta(seconds=1)      ## for check decart log
-                anchortime = True
-                logger.trace(f"found {howmany} thyroid slide image at {time.strftime('%Y-%m-%d %H:%M:%S')}")
-                if updateDeCartConfig(configYAML, args['decart_exe'], thismodel='AIxTHY'):
-                    logger.info('model product is AIxTHY')
-                else:
-                    logger.error('something wrong while updating model to AIxTHY, will stop watchwsi.exe')
-                    print('[ERROR] STOP watchwsi.exe')
-                    byebye = True
-                    break
-                filecopied = [False for _ in range(howmany)]
-                for ii in range(howmany):
-                    wfile = wsilist[ii]
-                    wsitype = os.path.splitext(wfile)[1].lower()[1:]
-                    try:
-                        #shutil.copy(file, decartWatch)
-                        if wsitype == 'mrxs':
-                            dirmrxs = os.path.splitext(wfile)[0]
-                            shutil.copytree(dirmrxs, os.path.join(decartWatch, os.path.split(dirmrxs)[1]))
-                        if checkCopyWSIcompleted(wfile, os.path.join(decartWatch, os.path.basename(wfile))):
-                            if anchortime:
-                                dt_anchor = datetime.now()-timedelta(seconds=0.5)      ## for check decart log
-                                anchortime = False
-                            logger.trace(f"Copied: {os.path.basename(wfile)} → {decartWatch}")
-                            filecopied[ii] = True
-                        else:
-                            #wsilist.remove(file)
-                            logger.debug(f'{os.path.basename(wfile)} was moved!')
-                    except Exception as e:
-                        logger.error(f"Copy failed: {os.path.basename(file)} → {decartWatch} | Error: {str(e)}")
-                howmany = sum(filecopied)
-                bWSIfound = True if howmany else False
-                logger.debug(f'{howmany} WSI files were copied to DeCart watch folder')
-            if bWSIfound:
-                logger.debug(f'start tracing decart.log from {dt_anchor} ...')
-                wsicompleted = []
-                for ii in range(len(filecopied)):
-                    if filecopied[ii]:
-                        wsicompleted.append(False)
-                    else:
-                        wsilist.remove(wsilist[ii])
-                logger.debug(f'waiting for {len(wsicompleted)}:({len(wsilist)}) wsi files ....')
-                isModel2025 = False if 'ProgramData' in configYAML else True
-                errorfound = checkDeCartCompletion(wsilist, decartWatch, wsicompleted, isModel2025, dt_anchor)
-                ## copy .med/.aix to local backup folder
-                backupTHY = os.path.join(folderWSIbackup, 'aixthy')
-                if os.path.exists(backupTHY) == False:
-                    os.makedirs(backupTHY)
-                ## check destination folder (network) still connected
-                ##if os.path.exists(dstMEDAIX):
-                mkdirFAILED = False
-                dstTHY = os.path.join(dstMEDAIX, 'aixthy')
-                if os.path.exists(dstTHY) == False:
-                    try:
-                        os.makedirs(dstTHY)
-                    except OSError as e:
-                        logger.error(f'failed to create {dstTHY}: {e}')
-                        mkdirFAILED = True
-                if not mkdirFAILED:
-                    if errorfound:      ## not all wsi files were model inference completed
-                        logger.debug(f'result of model inference: {wsicompleted}')
-                        failed_wsi = os.path.join(backupTHY, 'failedWSI')
-                        if os.path.exists(failed_wsi) == False:
-                            os.makedirs(failed_wsi)
-                        for i, file in enumerate(wsilist):
-                            wfile = os.path.basename(file)
-                            mfile = f'{os.path.splitext(wfile)[0]}.med'
-                            afile = f'{os.path.splitext(wfile)[0]}.aix'
-                            if wsicompleted[i]:
-                                ## copy .med/.aix to local folder for backup
-                                try:
-                                    shutil.copy(os.path.join(srcMEDAIX, mfile), os.path.join(backupTHY, mfile))
-                                    shutil.copy(os.path.join(srcMEDAIX, afile), os.path.join(backupTHY, afile))
-                                except PermissionError:
-                                    logger.error(f'insufficient permission to copy the file')
-                                except OSError as e:
-                                    logger.error(f'OS error occurred: {e}')
-                                ## move .med/.aix to image storage
-                                try:
-                                    shutil.move(os.path.join(srcMEDAIX, mfile), os.path.join(dstTHY, mfile))
-                                    shutil.move(os.path.join(srcMEDAIX, afile), os.path.join(dstTHY, afile))
-                                except PermissionError:
-                                    logger.error(f'permission denied while accessing the moving files')
-                                except shutil.Error as e:
-                                    logger.error(f'an error occurred: {e}')
-                                except Exception as e:
-                                    logger.error(f'failed to move analyzed images: {e}')
-                                ## local wsi backup folder
-                                localwsibackup = os.path.join(folderWSIbackup, 'aixthy')
-                            else:       ## decart failed to model inference this file
-                                localwsibackup = os.path.join(folderWSIbackup, 'aixthy', 'failedWSI')
-                                ## delete failed WSI from decart watch folder
-                                failedwsi = os.path.join(decartWatch, wfile)
-                                try:
-                                    os.unlink(failedwsi)
-                                    logger.trace(f'os.unlink({failedwsi})')
-                                except FileNotFoundError:
-                                    logger.error(f'{failedwsi} does not exist')
-                                except PermissionError:
-                                    logger.error(f'permission denied: unable to delete {failedwsi}')
-                                except OSError as e:
-                                    logger.error(f'error occurred while deleting {failedwsi}: {e}')                           
-                            ## move wsi files to local backup folder, for now
-                            try:
-                                shutil.move(file, os.path.join(localwsibackup, wfile))
-                                logger.trace(f'move {file} to {os.path.join(localwsibackup, wfile)}')
-                            except PermissionError:
-                                logger.error(f'Permission denied when moving {file}')
-                            except OSError as e:
-                                logger.error(f'Error occurred while moving file: {e}')
-                            ## delete if still exist
-                            if os.path.exists(file):
-                                try:
-                                    os.unlink(file)
-                                    logger.trace(f'os.unlink({file})')
-                                except FileNotFoundError:
-                                    logger.error(f'{file} does not exist')
-                                except PermissionError:
-                                    logger.error(f'permission denied: unable to delete {file}')
-                                except OSError as e:
-                                    logger.error(f'error occurred while deleting {file}: {e}')                           
-                            ## I don't know why??
-                            if os.path.exists(file):
-                                logger.error(f'[FATAL] why {file} still existed !!????')
-                                delcmd = f'del {file}'
-                                try:
-                                    os.system(delcmd)
-                                except Exception as e:
-                                    logger.error(f"Unexpected error while deleting failed {file}: {e}")
-                    else:
-                        ## copy .med/.aix to local backup folder
-                        backupAnalyzedImageFiles(srcMEDAIX, folderBackup, wsilist, wsicompleted, 'AIxTHY', 'copy')
-                        backupAnalyzedImageFiles(srcMEDAIX, dstMEDAIX, wsilist, wsicompleted, 'AIxTHY', 'move')
-                        ## move wsi files to local backup folder, for now
-                        for file in wsilist:
-                            try:
-                                #os.rename(file, os.path.join(backupTHY, os.path.basename(file)))
-                                shutil.move(file, os.path.join(backupTHY, os.path.basename(file)))
-                            except PermissionError:
-                                logger.error(f'Permission denied when moving {file}')
-                            except OSError as e:
-                                logger.error(f'Error occurred while moving file: {e}')
-                            finally:
-                                logger.debug(f'{file} was shutil.move to {backupTHY}')
-                            ## delete if still exist
-                            if os.path.exists(file):
-                                try:
-                                    os.remove(file)
-                                except FileNotFoundError:
-                                    logger.error(f'{file} does not exist')
-                                except PermissionError:
-                                    logger.error(f'permission denied: unable to delete {file}')
-                                except OSError as e:
-                                    logger.error(f'error occurred while deleting {file}: {e}')
-                                finally:
-                                    logger.debug(f'{file} was os.remove to {backupTHY}')
-                    consumed_time = f'{timedelta(seconds=time.perf_counter()-t0)}'
-                    logger.info(f'processed {howmany} thyroid slides with {consumed_time[:-3]}')
-                else:
-                    logger.error(f'lost network connection, can not access {dstMEDAIX}')
-            ## check decart DONE folder
-            mlist = glob.glob(os.path.join(srcMEDAIX, 'done'))
-            if len(mlist):
-                logger.warning('some .med/.aix still exist in DeCart done folder')
-                break
-            ## goto thyroid loop if thyroid WSI found, or stay in urine loop
-            flist = glob.glob(os.path.join(scannerURO, '*'))
-            howmany = 0
-            for file in flist:
-                if os.path.isfile(file) and wsitype in MONITORED_WSI:
-                    howmany += 1
-            if howmany > 0:     ## urine WSI found
+                logger.error(f'something wrong while updating model to {preset}, will stop watchwsi.exe')
+                print('[ERROR] STOP watchwsi.exe')
                 break
-            else:
-                ### sleep another 3 minutes
-                time.sleep(180)
-        if byebye:
-            break
+        if pipeline:
+            for job in jobs:
+                pipeline.submit(job.path, preset, ondone=lambda task, job=job: finished.put(job))
+        else:
+            processSlideBatch(args, preset, [job.path for job in jobs], decartWatch, journal)
+            scheduler.done(jobs)
+        ## check decart DONE folder, .med/.aix of slides still tracked by the pipeline are expected there
+        leftover = list(FolderSnapshot(os.path.join(decartWatch, 'done'), ['med']).files)
+        if pipeline:
+            tracked = {os.path.splitext(os.path.basename(path))[0] for path in pipeline.tracking()}
+            leftover = [path for path in leftover if os.path.splitext(os.path.basename(path))[0] not in tracked]
+        if len(leftover):
+            logger.warning('some .med/.aix still exist in DeCart done folder')
+    if pipeline:
+        pipeline.stop()
+    TRANSFERS.reportThroughput()
+    scheduler.reportLatency()
+    watcher.stop()
+    journal.close()
+    return {'stages': pipeline.stageStats() if pipeline else {}, 'latency': scheduler.latencyStats()}
 
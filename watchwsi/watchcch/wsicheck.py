@@ -0,0 +1,190 @@
+'''
+wsicheck validates a WSI file before copying, without opening it with OpenSlide every time:
+   (1) 'magic': file signature (TIFF/BigTIFF, ZIP) and non-empty file, reads 16 bytes; for .mrxs the
+       <name>/Slidedat.ini signature, the .mrxs file itself has no fixed header
+   (2) 'structure': partial reads only, first TIFF IFD with image width/length, ZIP end of central
+       directory, MRXS Slidedat.ini/Index.dat and data files
+   (3) 'openslide': full openslide.OpenSlide(), closed right away
+results are cached per file identity (path, size, mtime, inode, .mrxs data files), a changed file is checked again
+'''
+import os
+import re
+import struct
+import threading
+from collections import OrderedDict
+from loguru import logger
+try:
+    import openslide
+    HAS_OPENSLIDE = True
+except ImportError:
+    HAS_OPENSLIDE = False
+
+CHECK_LEVELS = ['magic', 'structure', 'openslide']
+TIFF_FORMATS = ['svs', 'ndpi', 'tif', 'tiff', 'bif']
+RE_DATAFILE = re.compile(r'^FILE_\d+\s*=\s*(.+)$')
+TIFF_MAGIC = {b'II*\x00': ('<', False), b'MM\x00*': ('>', False), b'II+\x00': ('<', True), b'MM\x00+': ('>', True)}
+
+def fileIdentity(wsi):
+    st = os.stat(wsi)
+    identity = (wsi, st.st_size, st.st_mtime_ns, st.st_ino)
+    ## .mrxs: data files are still being copied into the data folder
+    datafolder = mrxsDataFolder(wsi)
+    if wsi.lower().endswith('.mrxs') and os.path.isdir(datafolder):
+        identity += tuple((e.name, e.stat().st_size, e.stat().st_mtime_ns) for e in os.scandir(datafolder) if e.is_file())
+    return identity
+
+def mrxsDataFolder(wsi):
+    return os.path.splitext(wsi)[0]
+
+##---------------------------------------------------------
+## tier 1: signature
+##---------------------------------------------------------
+def checkMagic(wsi, fmt):
+    ## returns None if ok, otherwise the reason
+    if fmt == 'mrxs':
+        return checkMRXSMagic(wsi)
+    if os.path.getsize(wsi) == 0:
+        return 'empty file'
+    with open(wsi, 'rb') as fh:
+        head = fh.read(16)
+    if fmt in TIFF_FORMATS:
+        return None if head[:4] in TIFF_MAGIC else 'not a TIFF file'
+    if fmt == 'zip':
+        return None if head[:4] == b'PK\x03\x04' else 'not a ZIP file'
+    return None
+
+def checkMRXSMagic(wsi):
+    slidedat = os.path.join(mrxsDataFolder(wsi), 'Slidedat.ini')
+    if os.path.isdir(mrxsDataFolder(wsi)) == False:
+        return 'MRXS data folder does not exist'
+    if os.path.isfile(slidedat) == False:
+        return 'MRXS Slidedat.ini does not exist'
+    with open(slidedat, 'rb') as fh:
+        head = fh.read(16)
+    if head.lstrip(b'\xef\xbb\xbf').lstrip()[:1] != b'[':
+        return 'MRXS Slidedat.ini is not an ini file'
+    return None
+
+##---------------------------------------------------------
+## tier 2: structure, partial reads
+##---------------------------------------------------------
+def checkTIFF(wsi, filesize):
+    with open(wsi, 'rb') as fh:
+        head = fh.read(16)
+        order, bigtiff = TIFF_MAGIC[head[:4]]
+        if bigtiff:
+            offset = struct.unpack(f'{order}Q', head[8:16])[0]
+            countfmt, entrysize = 'Q', 20
+        else:
+            offset = struct.unpack(f'{order}I', head[4:8])[0]
+            countfmt, entrysize = 'H', 12
+        ## NDPI larger than 4 GB keeps 32-bit offsets, the first IFD is near the beginning anyway
+        if offset < 8 or offset >= filesize:
+            return f'first IFD offset {offset} out of file'
+        fh.seek(offset)
+        raw = fh.read(struct.calcsize(countfmt))
+        if len(raw) < struct.calcsize(countfmt):
+            return 'truncated IFD'
+        count = struct.unpack(f'{order}{countfmt}', raw)[0]
+        if count == 0 or count > 4096:
+            return f'unreasonable IFD entry count {count}'
+        entries = fh.read(count * entrysize)
+        if len(entries) < count * entrysize:
+            return 'truncated IFD entries'
+    tags = {struct.unpack(f'{order}H', entries[i*entrysize:i*entrysize+2])[0] for i in range(count)}
+    if 256 not in tags or 257 not in tags:     ## ImageWidth, ImageLength
+        return 'first IFD has no image width/length'
+    return None
+
+def checkZIP(wsi, filesize):
+    ## end of central directory is within the last 64 KB + 22 bytes
+    with open(wsi, 'rb') as fh:
+        fh.seek(max(filesize - 65536 - 22, 0))
+        tail = fh.read()
+    return None if b'PK\x05\x06' in tail else 'ZIP end of central directory not found (incomplete file?)'
+
+def checkMRXS(wsi):
+    datafolder = mrxsDataFolder(wsi)
+    slidedat = os.path.join(datafolder, 'Slidedat.ini')
+    if os.path.isfile(slidedat) == False or os.path.isfile(os.path.join(datafolder, 'Index.dat')) == False:
+        return 'Slidedat.ini or Index.dat missing'
+    datafiles = []
+    with open(slidedat, 'r', encoding='utf-8-sig', errors='replace') as fh:
+        section = None
+        for line in fh:
+            line = line.strip()
+            if line.startswith('['):
+                section = line
+            elif section == '[DATAFILE]' and RE_DATAFILE.match(line):
+                datafiles.append(RE_DATAFILE.match(line).group(1).strip())
+    existing = {entry.name: entry.stat().st_size for entry in os.scandir(datafolder) if entry.is_file()}
+    missing = [f for f in datafiles if existing.get(f, 0) == 0]
+    if missing:
+        return f'{len(missing)} MRXS data files missing or empty ({missing[0]}, ...)'
+    return None
+
+def checkStructure(wsi, fmt):
+    filesize = os.path.getsize(wsi)
+    if fmt in TIFF_FORMATS:
+        return checkTIFF(wsi, filesize)
+    if fmt == 'zip':
+        return checkZIP(wsi, filesize)
+    if fmt == 'mrxs':
+        return checkMRXS(wsi)
+    return None
+
+##---------------------------------------------------------
+## tier 3: OpenSlide, handle closed deterministically
+##---------------------------------------------------------
+def checkOpenSlide(wsi, fmt):
+    if fmt == 'zip':
+        return None     ## openslide-python can not verify *.zip WSI file
+    if not HAS_OPENSLIDE:
+        logger.debug('openslide-python is not installed, skip OpenSlide check')
+        return None
+    try:
+        slide = openslide.OpenSlide(wsi)
+    except openslide.OpenSlideError as e:
+        return f'OpenSlideError: {e}'
+    slide.close()
+    return None
+
+class WSIValidator:
+    def __init__(self, level='structure', cache_size=4096):
+        self.lock = threading.Lock()
+        self.cache = OrderedDict()      ## file identity -> (ok, reason)
+        self.cache_size = cache_size
+        self.setLevel(level)
+    def setLevel(self, level):
+        if level not in CHECK_LEVELS:
+            logger.warning(f'unknown WSI check level {level}, use structure')
+            level = 'structure'
+        self.level = level
+    def validate(self, wsi):
+        ## returns (True, None) or (False, reason)
+        fmt = os.path.splitext(wsi)[1][1:].lower()
+        try:
+            key = fileIdentity(wsi) + (self.level,)
+        except OSError as e:
+            return False, f'{e.strerror}'
+        with self.lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                return self.cache[key]
+        checks = [checkMagic, checkStructure, checkOpenSlide][:CHECK_LEVELS.index(self.level)+1]
+        reason = None
+        try:
+            for check in checks:
+                reason = check(wsi, fmt)
+                if reason:
+                    break
+        except (OSError, struct.error, ValueError) as e:
+            reason = f'{type(e).__name__}: {e}'
+        result = (reason is None, reason)
+        with self.lock:
+            self.cache[key] = result
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return result
+
+WSI_VALIDATOR = WSIValidator()
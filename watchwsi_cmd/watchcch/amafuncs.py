@@ -6,15 +6,17 @@
 ##---------------------------------------------------------------------------------------------
 import os, glob
 from datetime import datetime
-from func_timeout import func_set_timeout, FunctionTimedOut
 import yaml, json
 import subprocess
+from concurrent.futures import ProcessPoolExecutor
 from loguru import logger
 from .asarlib import AsarFile
 import gzip
 import shapely.geometry
 from .metafunc import getUROaverageOfSAcells, getUROaverageOfTopCells
-from .taskfunc import stopDeCart, restartDeCart
+from .taskfunc import reconfigureDeCart
+from amatools.decartpool import DeCartPool, getSlideFileSize, DECART_STALL_SECONDS
+from amatools.folderwatch import FolderSnapshot
 
 ##---------------------------------------------------------
 ## configuration for this machine, should be customized for each machine
@@ -77,19 +79,18 @@ def updateDeCartConfig(decartYaml, decartEXE, thismodel=None, watchfolder=None):
         if thismodel and conf['preset'].lower() != thismodel.lower():
             conf['preset'] = thismodel.lower()
             bUpdate = True
-        if watchfolder and os.path.exists(watchfolder):
+        if watchfolder and os.path.exists(watchfolder) and conf.get('watch') != watchfolder:
             conf['watch'] = watchfolder
             bUpdate = True
         if bUpdate:
-            ## STOP DeCart service (2.7.x) or END DeCart process (2.8.x)
-            stopDeCart(is_a_service)
-            time.sleep(10)
-            # update decart.yaml
-            with open(decartYaml, 'w') as newyaml:
-                yaml.dump(conf, newyaml)
-            time.sleep(10)
-            ## restart DeCart
-            restartDeCart(is_a_service, decartEXE)
+            ## STOP DeCart service (2.7.x) or END DeCart process (2.8.x), update decart.yaml and restart DeCart,
+            ## each step proceeds as soon as DeCart is really down/up
+            def writeDeCartYaml():
+                with open(decartYaml, 'w') as newyaml:
+                    yaml.dump(conf, newyaml)
+            if not reconfigureDeCart(is_a_service, decartEXE, writeDeCartYaml):
+                logger.error(f'failed to switch DeCart to {conf["preset"]}')
+                return False
             #
         return True
     else:
@@ -286,68 +287,62 @@ def collectAnalysisMetadata(whichWSI):
 ##---------------------------------------------------------
 ## command line running decart
 ##---------------------------------------------------------
-@func_set_timeout(86400)    ## in case of model inference takes too long time for more than 11 layers
-def gotoModelInference(wsifiles, bin_decart, doneFolder, metaRecords, bVer1Model=False):
-    if os.environ.get('DC_SINGLE_PLANE', None) != None:
-        os.environ.pop('DC_SINGLE_PLANE')
+def harvestSlideMetadata(wsf, doneFolder, decart_version, timestamps):
+    ## runs in a worker process: decompress .aix, areas/traits, file sizes
+    workpath, wsifname = os.path.split(wsf)
+    shortname = os.path.splitext(wsifname)[0]
+    medfile = os.path.join(workpath, doneFolder, f'{shortname}.med')
+    aixfile = os.path.join(workpath, doneFolder, f'{shortname}.aix')
+    ## collect model analysis metadata
+    thismeta = collectAnalysisMetadata(os.path.splitext(medfile)[0])
+    #### filesize
+    wsifsize = round(getSlideFileSize(wsf)/(1024*1024), 4)     ## in MB
+    medfsize = round((os.path.getsize(medfile)+os.path.getsize(aixfile))/(1024*1024), 4)     ## in MB
+    thismeta['wsifname'] = wsifname
+    thismeta['wsifsize'] = wsifsize
+    thismeta['medfsize'] = medfsize
+    thismeta['decart_version'] = decart_version
+    thismeta.update(timestamps)
+    return thismeta
+
+def gotoModelInference(wsifiles, bin_decart, doneFolder, metaRecords, bVer1Model=False, workers=1, timeout=None, harvesters=2, stall=None):
     spos = bin_decart.index('decart')
     decart_version = os.path.split(bin_decart)[0][spos+6:]
-    #if bVer1Model == False:
-    #    bin_decart += ' -verbose -w'
-    for ii, wsf in enumerate(wsifiles):
+    if bVer1Model:
+        ## DeCart of version 1 models has no -verbose -w, nothing is run
+        for wsf in wsifiles:
+            logger.info('does not support out-to-date model inference')
+        return
+    ## 'workers' DeCart processes run concurrently, each slide has its own timeout
+    pool = DeCartPool(bin_decart, doneFolder, workers=workers, timeout=timeout, stall=stall or DECART_STALL_SECONDS)
+    harvester = ProcessPoolExecutor(max_workers=max(int(harvesters), 1))
+    harvests = []
+    for result in pool.run(wsifiles):
+        wsf = result.wsf
         workpath, wsifname = os.path.split(wsf)
         shortname, extension = os.path.splitext(wsifname)
-        if extension.lower() in ['.tif', '.tiff']:
-            os.environ['DC_EXTENDED_FORMAT'] = '1'
-        #cmd_decart = f'{bin_decart} {wsf}'
-        #logger.info(cmd_decart)
-        sdt = datetime.now()
-        logger.info(f"Start model inference for {wsf} ({ii+1} of {len(wsifiles)}) from {sdt.strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]} ...")
-        #os.system(cmd_decart)
-        try:
-            if bVer1Model == False:
-                logger.info(f'{bin_decart} -verbose -w {wsf}')
-                decartlog = subprocess.run([bin_decart, "-verbose", "-w", wsf], capture_output=True, text=True)
-            else:
-                logger.info('does not support out-to-date model inference')
-        except subprocess.CalledProcessError as e:
-            logger.error(f'failed while inference {os.path.basename(wsf)}, error: {e}')
-            continue
-        edt = datetime.now()
-        logger.info(f'Finish model inference for {wsf} at {edt.strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]}...')
-        analysis_timestamp = edt.timestamp() - sdt.timestamp()
-        convert_timestamp, inference_timestamp = parseDeCartLog(decartlog.stdout)
-        lines = decartlog.stdout.split('\n')
-        for _, line in enumerate(lines):
-            if line:
-                logger.info(line)
+        analysis_timestamp = result.edt.timestamp() - result.sdt.timestamp()
+        ## DeCart output was logged and parsed while it was running
+        convert_timestamp, inference_timestamp = result.convert_timestamp, result.inference_timestamp
         if convert_timestamp == 0 and inference_timestamp == 0:
             logger.warning(f'something wrong happened while model inference {os.path.basename(wsf)}')            
         ## check .med file
         medfile = os.path.join(workpath, doneFolder, f'{shortname}.med')
         aixfile = os.path.join(workpath, doneFolder, f'{shortname}.aix')
         if not os.path.exists(medfile) or not os.path.exists(aixfile):
-            logger.error(f'{medfile} does not exist!', 'ERROR')
-            return
-        ## collect model analysis metadata
-        thismeta = collectAnalysisMetadata(os.path.splitext(medfile)[0])
-        #### filesize
-        if extension.lower() == '.mrxs':
-            mrxspath = os.path.join(workpath, shortname)
-            totalfsize = sum(os.path.getsize(f'{mrxspath}\\{fd}') for fd in os.listdir(mrxspath) if os.path.isfile(f'{mrxspath}\\{fd}'))
-        else:
-            totalfsize = os.path.getsize(wsf)
-        wsifsize = round(totalfsize/(1024*1024), 4)     ## in MB
-        medfsize = round((os.path.getsize(medfile)+os.path.getsize(aixfile))/(1024*1024), 4)     ## in MB
-        thismeta['wsifname'] = wsifname
-        thismeta['wsifsize'] = wsifsize
-        thismeta['medfsize'] = medfsize
-        thismeta['decart_version'] = decart_version
-        thismeta['execution_date'] = int(sdt.timestamp())
-        thismeta['convert_timestamp'] = convert_timestamp
-        thismeta['inference_timestamp'] = inference_timestamp
-        thismeta['analysis_timestamp'] = analysis_timestamp
-        metaRecords.append(thismeta)
+            logger.error(f'{medfile} does not exist!')
+            continue
+        ## post-processing in background, the next DeCart process starts immediately
+        timestamps = {'execution_date': int(result.sdt.timestamp()), 'convert_timestamp': convert_timestamp,
+                      'inference_timestamp': inference_timestamp, 'analysis_timestamp': analysis_timestamp}
+        harvests.append(harvester.submit(harvestSlideMetadata, wsf, doneFolder, decart_version, timestamps))
+    ## join metadata of all slides for saveInferenceResult2CSV
+    for future in harvests:
+        try:
+            metaRecords.append(future.result())
+        except Exception as e:
+            logger.error(f'failed to collect analysis metadata: {e}')
+    harvester.shutdown()
 
 def doModelInference(wsipath, modelname='AIxURO', decart_version='2.7.4'):
     if not os.path.exists(wsipath):
@@ -360,13 +355,16 @@ def doModelInference(wsipath, modelname='AIxURO', decart_version='2.7.4'):
     bVer1Model = True if decartVersion in ['1.5.4', '1.6.3', '2.0.7', '2.1.2'] else False
     doneFolder = '' if decartVersion[:5] in ['2.7.3', '2.7.4', '2.7.5'] else 'done'
     cmd_decart = args['decart_exe']
+    decart_workers = args.get('decart_workers', 1)      ## concurrent DeCart processes on this host
+    decart_timeout = args.get('decart_timeout', None)   ## seconds per slide, None: by file size
+    decart_stall = args.get('decart_stall', None)       ## seconds without DeCart output, then DeCart is killed
+    metadata_workers = args.get('metadata_workers', 2)  ## processes collecting .med/.aix metadata
     medaix_metadata = []    ## metadata of model inference analysis results
     ## get the list of WSI files to be processed
     wsifiles, medfiles, zipfiles = [], [], []    ## zip files for DICOM format or zipped MRXS format
-    wsilist = glob.glob(os.path.join(wsipath, '*'))
+    ## one os.scandir() pass, only files with WSI extensions
+    wsilist = sorted(FolderSnapshot(wsipath, ['svs', 'ndpi', 'mrxs', 'bif', 'tif', 'tiff']).files)
     for _, fd in enumerate(wsilist):
-        if os.path.isfile(fd) == False:
-            continue
         wsiformat = os.path.splitext(fd)[1][1:].lower()
         #print({fd}, {wsiformat})
         if wsiformat in ['svs', 'ndpi', 'mrxs', 'bif', 'tif', 'tiff']:
@@ -395,7 +393,7 @@ def doModelInference(wsipath, modelname='AIxURO', decart_version='2.7.4'):
         howmanywsi = len(wsifiles)
         if howmanywsi > 0:
             logger.trace(f'Start model inference using decart{decart_version} model:{modelname} for {howmanywsi} WSI files...')
-            gotoModelInference(wsifiles, cmd_decart, doneFolder, medaix_metadata)
+            gotoModelInference(wsifiles, cmd_decart, doneFolder, medaix_metadata, workers=decart_workers, timeout=decart_timeout, harvesters=metadata_workers, stall=decart_stall)
         '''
         howmanyzip = len(zipfiles)
         if howmanyzip > 0:
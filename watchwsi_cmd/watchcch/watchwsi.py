@@ -9,9 +9,10 @@ import shutil
 import json, yaml
 import time
 import win32wnet, pywintypes
-from .taskfunc import stopDeCart, restartDeCart
+from .taskfunc import reconfigureDeCart
 from .metafunc import saveInferenceResult2CSV, saveAnalyzedMetadata2DB4QC
 from .amafuncs import doModelInference
+from amatools.folderwatch import FolderWatcher
 from loguru import logger
 
 ##---------------------------------------------------------
@@ -126,19 +127,18 @@ def updateRunningDeCartConfig(decartYaml, decartEXE, thismodel=None, watchfolder
         if thismodel and conf['preset'].lower() != thismodel.lower():
             conf['preset'] = thismodel.lower()
             bUpdate = True
-        if watchfolder and os.path.exists(watchfolder):
+        if watchfolder and os.path.exists(watchfolder) and conf.get('watch') != watchfolder:
             conf['watch'] = watchfolder
             bUpdate = True
         if bUpdate:
-            ## STOP DeCart service (2.7.x) or END DeCart process (2.8.x)
-            stopDeCart(is_a_service)
-            time.sleep(10)
-            # update decart.yaml
-            with open(decartYaml, 'w') as newyaml:
-                yaml.dump(conf, newyaml)
-            time.sleep(10)
-            ## restart DeCart
-            restartDeCart(is_a_service, decartEXE)
+            ## STOP DeCart service (2.7.x) or END DeCart process (2.8.x), update decart.yaml and restart DeCart,
+            ## each step proceeds as soon as DeCart is really down/up
+            def writeDeCartYaml():
+                with open(decartYaml, 'w') as newyaml:
+                    yaml.dump(conf, newyaml)
+            if not reconfigureDeCart(is_a_service, decartEXE, writeDeCartYaml):
+                logger.error(f'failed to switch DeCart to {conf["preset"]}')
+                return False
             #
         return True
     else:
@@ -192,6 +192,21 @@ def backupAnalyzedImageFiles(srcpath, dstpath, modelname, backuptype):
                 #logger.trace(f'{mfile} was moved to {dstpath}')
     logger.info(f'{len(mlist)} .med/.aix files were moved to {dstpath}')
 
+def copyWSI2DeCartWatch(wsilist, decartWatch):
+    ## wsilist: FolderWatcher.listStableWSI(), only WSI files the scanner has finished writing
+    copied = []
+    for file in wsilist:
+        try:
+            shutil.copy(file, decartWatch)
+            if os.path.splitext(file)[1].lower() == '.mrxs':
+                dirmrxs = os.path.splitext(file)[0]
+                shutil.copytree(dirmrxs, os.path.join(decartWatch, os.path.split(dirmrxs)[1]))
+            logger.trace(f"Copied: {os.path.basename(file)} → {decartWatch}")
+            copied.append(file)
+        except Exception as e:
+            logger.error(f"Copy failed: {os.path.basename(file)} → {decartWatch} | Error: {str(e)}")
+    return copied
+
 def startMonitorFolders(configfile, logfile):
     MonitorLogger(logfname=logfile)
     ## init environment
@@ -218,26 +233,17 @@ def startMonitorFolders(configfile, logfile):
     folderBackup = args['foldermedaix']
     folderWSIbackup = args['folderwsifile']
     MONITORED_WSI = ['svs', 'ndpi', 'mrxs', 'tif', 'zip']
+    ## event-driven watcher, polling as fallback for network shares
+    watcher = FolderWatcher([scannerURO, scannerTHY], MONITORED_WSI,
+                            settle=args.get('watch_settle_seconds', 5), poll_interval=args.get('watch_poll_seconds', 30))
+    watcher.start()
     while True:
         bWSIfound = False
         ## monitor AIxURO folder first
         whichmodel = 'AIxURO'
         anchortime = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(time.time()))
         #logger.trace(f"👀 Monitoring changes in: {scannerURO}, copy files created after {anchor_time}, model is {whichmodel}")
-        flist = glob.glob(os.path.join(scannerURO, '*'))
-        for file in flist:
-            wsitype = os.path.splitext(file)[1].lower()[1:]
-            if os.path.isfile(file) and wsitype in MONITORED_WSI:
-                ## found, then copy to destination folder
-                try:
-                    shutil.copy(file, decartWatch)
-                    if wsitype == 'mrxs':
-                        dirmrxs = os.path.splitext(file)[0]
-                        shutil.copytree(dirmrxs, os.path.join(decartWatch, os.path.split(dirmrxs)[1]))
-                    logger.trace(f"Copied: {os.path.basename(file)} → {decartWatch}")
-                    bWSIfound = True
-                except Exception as e:
-                    logger.error(f"Copy failed: {os.path.basename(file)} → {decartWatch} | Error: {str(e)}")
+        bWSIfound = len(copyWSI2DeCartWatch(watcher.listStableWSI(scannerURO), decartWatch)) > 0
         ## WSI files found
         if bWSIfound:
             t0 = time.perf_counter()
@@ -281,20 +287,7 @@ def startMonitorFolders(configfile, logfile):
         ##====================================================================##
         ## monitor AIxTHY folder
         whichmodel = 'AIxTHY'
-        flist = glob.glob(os.path.join(scannerTHY, '*'))
-        for file in flist:
-            wsitype = os.path.splitext(file)[1].lower()[1:]
-            if os.path.isfile(file) and wsitype in MONITORED_WSI:
-                ## found, then copy to destination folder
-                try:
-                    shutil.copy(file, decartWatch)
-                    if wsitype == 'mrxs':
-                        dirmrxs = os.path.splitext(file)[0]
-                        shutil.copytree(dirmrxs, os.path.join(decartWatch, os.path.split(dirmrxs)[1]))
-                    logger.trace(f"Copied: {os.path.basename(file)} → {decartWatch}")
-                    bWSIfound = True
-                except Exception as e:
-                    logger.error(f"Copy failed: {os.path.basename(file)} → {decartWatch} | Error: {str(e)}")
+        bWSIfound = len(copyWSI2DeCartWatch(watcher.listStableWSI(scannerTHY), decartWatch)) > 0
         ## WSI files found
         if bWSIfound:
             t0 = time.perf_counter()
@@ -335,7 +328,7 @@ def startMonitorFolders(configfile, logfile):
             logger.trace(f'{len(wsilist)} WSI files was been deleted!')
             logger.info(f'{len(aixmeta)} thyroid WSI files were processed')
         ##
-        time.sleep(300)     ## wait 5 minutes for nothing  
+        watcher.waitForWSI(300)     ## wait up to 5 minutes, wake up when a new WSI is completely written
 
 def startMonitorDeCartFolders(configfile, logfile):
     MonitorLogger(logfname=logfile)
@@ -367,6 +360,9 @@ def startMonitorDeCartFolders(configfile, logfile):
     folderBackup = args['foldermedaix']
     folderWSIbackup = args['folderwsifile']
     MONITORED_WSI = ['svs', 'ndpi', 'mrxs', 'tif']
+    watcher = FolderWatcher([scannerURO, scannerTHY], MONITORED_WSI,
+                            settle=args.get('watch_settle_seconds', 5), poll_interval=args.get('watch_poll_seconds', 30))
+    watcher.start()
     startwatch_aixuro = time.time()
     startwatch_aixthy = time.time()
     ## forever watch loop
@@ -380,7 +376,7 @@ def startMonitorDeCartFolders(configfile, logfile):
         thistime = time.time()
         anchor_time = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(thistime))
         #logger.trace(f"👀 Monitoring changes in: {scannerURO}, copy files created after {anchor_time}, model is {whichmodel}")
-        flist = glob.glob(os.path.join(scannerURO, '*'))
+        flist = watcher.listStableWSI(scannerURO)
         howmany = len(flist)
         if howmany > 0:
             t0 = time.perf_counter()
@@ -393,21 +389,7 @@ def startMonitorDeCartFolders(configfile, logfile):
                 logger.error('something wrong while updating model to AIxURO')
                 print('[ERROR] STOP watchwsi.exe')
                 break
-            for file in flist:
-                wsitype = os.path.splitext(file)[1].lower()[1:]
-                if os.path.isfile(file) and wsitype in MONITORED_WSI:
-                    ## found, then copy to destination folder
-                    try:
-                        shutil.copy(file, decartWatch)
-                        if wsitype == 'mrxs':
-                            dirmrxs = os.path.splitext(file)[0]
-                            shutil.copytree(dirmrxs, os.path.join(decartWatch, os.path.split(dirmrxs)[1]))
-                        #qclog('TRACE', f"Copied: {os.path.basename(file)} → {decartWatch}")
-                        logger.trace(f"Copied: {os.path.basename(file)} → {decartWatch}")
-                        bWSIfound = True
-                    except Exception as e:
-                        #qclog('ERROR', f"Copy failed: {os.path.basename(file)} → {decartWatch} | Error: {str(e)}")
-                        logger.error(f"Copy failed: {os.path.basename(file)} → {decartWatch} | Error: {str(e)}")
+            bWSIfound = len(copyWSI2DeCartWatch(flist, decartWatch)) > 0
         if bWSIfound:
             #time.sleep(300*howmany)     ## wait for model inference, estimated 5 minutes per slide
             while True:
@@ -426,6 +408,8 @@ def startMonitorDeCartFolders(configfile, logfile):
                 os.makedirs(backupURO)
             for file in flist:
                 shutil.move(file, os.path.join(backupURO, os.path.basename(file)))
+                if file.lower().endswith('.mrxs') and os.path.isdir(os.path.splitext(file)[0]):
+                    shutil.move(os.path.splitext(file)[0], os.path.join(backupURO, os.path.basename(os.path.splitext(file)[0])))
             #qclog('INFO', f'processed {howmany} urine slides with {time.perf_counter()-t0:0.6f} seconds')
             logger.info(f'processed {howmany} urine slides with {time.perf_counter()-t0:0.6f} seconds')
         ## check decart DONE folder
@@ -434,8 +418,8 @@ def startMonitorDeCartFolders(configfile, logfile):
             logger.warning('some .med/.aix still exist in DeCart done folder')
             break
         #
-        ### sleep another 10 minutes
-        time.sleep(600)
+        ### wait up to 10 minutes, wake up when a new WSI is completely written
+        watcher.waitForWSI(600)
         #
         # monitor aixthy folder in scanner
         bWSIfound = False
@@ -443,7 +427,7 @@ def startMonitorDeCartFolders(configfile, logfile):
         thistime = time.time()
         anchor_time = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(thistime))
         #logger.trace(f"👀 Monitoring changes in: {scannerTHY}, copy files created after {anchor_time}, model is {whichmodel}")
-        flist = glob.glob(os.path.join(scannerTHY, '*'))
+        flist = watcher.listStableWSI(scannerTHY)
         howmany = len(flist)
         if howmany > 0:
             t0 = time.perf_counter()
@@ -454,19 +438,7 @@ def startMonitorDeCartFolders(configfile, logfile):
                 logger.error('something wrong while updating model to AIxTHY')
                 print('[ERROR] STOP watchwsi.exe')
                 break
-            for file in flist:
-                wsitype = os.path.splitext(file)[1].lower()[1:]
-                if os.path.isfile(file) and wsitype in MONITORED_WSI:
-                    ## found, then copy to destination folder
-                    try:
-                        shutil.copy(file, decartWatch)
-                        if wsitype == 'mrxs':
-                            dirmrxs = os.path.splitext(file)[0]
-                            shutil.copytree(dirmrxs, os.path.join(decartWatch, os.path.split(dirmrxs)[1]))
-                        logger.trace(f"Copied: {os.path.basename(file)} → {decartWatch}")
-                        bWSIfound = True
-                    except Exception as e:
-                        logger.trace(f"Copy failed: {os.path.basename(file)} → {decartWatch} | Error: {str(e)}")
+            bWSIfound = len(copyWSI2DeCartWatch(flist, decartWatch)) > 0
         if bWSIfound:
             #time.sleep(300*howmany)     ## wait for model inference, estimated 5 minutes per slide
             while True:
@@ -485,12 +457,14 @@ def startMonitorDeCartFolders(configfile, logfile):
                 os.makedirs(backupTHY)
             for file in flist:
                 shutil.move(file, os.path.join(backupTHY, os.path.basename(file)))
+                if file.lower().endswith('.mrxs') and os.path.isdir(os.path.splitext(file)[0]):
+                    shutil.move(os.path.splitext(file)[0], os.path.join(backupTHY, os.path.basename(os.path.splitext(file)[0])))
             logger.info(f'processed {howmany} thyroid slides with {time.perf_counter()-t0:0.6f} seconds')
         ## check decart DONE folder
         mlist = glob.glob(os.path.join(srcMEDAIX, 'done'))
         if len(mlist):
             logger.warning('some .med/.aix still exist in DeCart done folder')
             break
-        ### sleep another 10 minutes
-        time.sleep(600)
+        ### wait up to 10 minutes, wake up when a new WSI is completely written
+        watcher.waitForWSI(600)
 